@@ -0,0 +1,693 @@
+import os
+import re
+import json
+import time
+import base64
+import random
+import bisect
+import hashlib
+import urllib
+import logging
+import datetime
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+from email.parser import FeedParser
+
+from oauth2client.client import AccessTokenCredentials
+
+import google_storage.core.utils as g
+
+from google_storage.core.checksums import Crc32c
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_PATH = os.path.join(g.DISCOVERY_DIR, 'storage_v1.json')
+PAGE_SIZE = 1000
+STATUS_REASONS = BaseHTTPServer.BaseHTTPRequestHandler.responses
+
+
+class FakeError(Exception):
+    '''Error returned to the client as JSON error response.
+    '''
+
+    def __init__(self, status, message=None, headers=None):
+        super(FakeError, self).__init__(message or STATUS_REASONS.get(
+            status, ('Error',)
+        )[0])
+        self.status = status
+        self.headers = headers or {}
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat()[0:-3] + 'Z'
+
+
+def _select(resource, fields):
+    '''Partial response for fields selector like "a,b(c,d)".
+    '''
+    out = {}
+    for field, sub in re.findall(r'([\w]+)(?:\(([^()]*)\))?', fields):
+        if field not in resource:
+            continue
+        value = resource[field]
+        if sub and isinstance(value, list):
+            value = [_select(v, sub) for v in value]
+        elif sub and isinstance(value, dict):
+            value = _select(value, sub)
+        out[field] = value
+    return out
+
+
+class Bucket(object):
+    '''In memory bucket with objects kept sorted by name.
+    '''
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.names = []
+        self.objects = {}
+
+    def put(self, name, resource, data):
+        if name not in self.objects:
+            bisect.insort(self.names, name)
+        self.objects[name] = (resource, data)
+
+    def remove(self, name):
+        del self.objects[name]
+        del self.names[bisect.bisect_left(self.names, name)]
+
+
+class FakeGCS(object):
+    '''In-process fake of the Cloud Storage JSON API. Serves discovery,
+    JSON, upload, media download and batch endpoints over HTTP on localhost,
+    so GSStorageHandler can be pointed at it unchanged.
+
+    Knobs simulate the network: latency is added to every HTTP request,
+    bandwidth caps every connection and error_rate fails random requests
+    with error_status. Batched sub-requests are failed separately, the
+    discovery document never fails.
+    '''
+
+    def __init__(
+        self, latency=0, bandwidth=None, error_rate=0, error_status=503,
+        seed=None, host='127.0.0.1', port=0
+    ):
+        '''Constructor
+        :param latency: Seconds added to every HTTP request
+        :type latency: float
+        :param bandwidth: Bytes per second per connection, unlimited if None
+        :type bandwidth: int
+        :param error_rate: Probability of a request failing
+        :type error_rate: float
+        :param error_status: Status of failed requests
+        :type error_status: int
+        :param seed: Seed of the error injection
+        :type seed: int
+        :param host: Interface to listen on
+        :type host: str
+        :param port: Port to listen on, any free one if 0
+        :type port: int
+        '''
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.buckets = {}
+        self.stats = {
+            'requests': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+            'connections': 0
+        }
+        self._random = random.Random(seed)
+        self._injected = []
+        self._uploads = {}
+        self._generation = int(time.time() * 1000000)
+        self._lock = threading.RLock()
+        self._server = _Server((host, port), _RequestHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%s/' % (host, port)
+
+    @property
+    def discovery_url(self):
+        return self.url + 'discovery/v1/apis/{api}/{apiVersion}/rest'
+
+    def start(self):
+        '''Serve requests in a background thread.
+        '''
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,)
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving and close the socket.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def handler(self, handler_class=g.GSStorageHandler, discovery=False):
+        '''Storage handler talking to this server.
+        :param handler_class: Class of the handler
+        :type handler_class: type
+        :param discovery: Fetch discovery document from the server instead
+                          of using the bundled one.
+        :type discovery: bool
+        :retunrs: New handler
+        :rtype: GSStorageHandler
+        '''
+        credentials = AccessTokenCredentials('fake-token', 'fakegcs')
+        if discovery:
+            return handler_class(
+                credentials=credentials, discovery_url=self.discovery_url
+            )
+        return handler_class(credentials=credentials, root_url=self.url)
+
+    def inject_errors(self, count=1, status=503, headers=None):
+        '''Fail next count requests with status.
+        '''
+        with self._lock:
+            self._injected.extend([(status, headers)] * count)
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def add_bucket(self, name):
+        with self._lock:
+            if name in self.buckets:
+                raise FakeError(409, 'Bucket %s already exists' % name)
+            bucket = Bucket({
+                'kind': 'storage#bucket',
+                'id': name,
+                'name': name,
+                'selfLink': self.url + 'storage/v1/b/' + name,
+                'projectNumber': '1',
+                'metageneration': '1',
+                'location': 'EU',
+                'storageClass': 'STANDARD',
+                'etag': 'CAE=',
+                'timeCreated': _now(),
+            })
+            self.buckets[name] = bucket
+            return bucket
+
+    def add_object(self, bucket, name, data, content_type=None, metadata=None):
+        '''Store object directly, without going through HTTP.
+        :retunrs: Object resource
+        :rtype: dict
+        '''
+        md5 = base64.b64encode(hashlib.md5(data).digest())
+        crc = Crc32c(data).b64digest()
+        with self._lock:
+            self._generation += 1
+            resource = {
+                'kind': 'storage#object',
+                'id': '%s/%s/%s' % (bucket, name, self._generation),
+                'selfLink': '%sstorage/v1/b/%s/o/%s' % (
+                    self.url, bucket, urllib.quote(name, '')
+                ),
+                'mediaLink': '%sdownload/storage/v1/b/%s/o/%s?alt=media' % (
+                    self.url, bucket, urllib.quote(name, '')
+                ),
+                'name': name,
+                'bucket': bucket,
+                'generation': str(self._generation),
+                'metageneration': '1',
+                'contentType': content_type or g.DEFAULT_MIMETYPE,
+                'storageClass': 'STANDARD',
+                'size': str(len(data)),
+                'md5Hash': md5,
+                'crc32c': crc,
+                'etag': 'CAE=',
+                'timeCreated': _now(),
+                'updated': _now(),
+            }
+            if metadata:
+                resource['metadata'] = dict(metadata)
+            self._bucket(bucket).put(name, resource, data)
+            return resource
+
+    def get_object(self, bucket, name, generation=None):
+        '''Object resource and data.
+        :retunrs: Tuple (resource, data)
+        :rtype: tuple
+        '''
+        with self._lock:
+            try:
+                resource, data = self._bucket(bucket).objects[name]
+            except KeyError:
+                raise FakeError(404, 'No such object: %s/%s' % (bucket, name))
+        if generation and generation != resource['generation']:
+            raise FakeError(404, 'No such object: %s/%s#%s' % (
+                bucket, name, generation
+            ))
+        return resource, data
+
+    def _bucket(self, name):
+        try:
+            return self.buckets[name]
+        except KeyError:
+            raise FakeError(404, 'No such bucket: %s' % name)
+
+    def _should_fail(self):
+        with self._lock:
+            if self._injected:
+                return self._injected.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status, None
+        return None
+
+    def _throttle(self, size):
+        if self.bandwidth and size:
+            time.sleep(float(size) / self.bandwidth)
+
+    def dispatch(self, method, url, headers, body):
+        '''Handle single API request.
+        :param method: HTTP method
+        :type method: str
+        :param url: Path with query
+        :type url: str
+        :param headers: Request headers with lower case names
+        :type headers: dict
+        :param body: Request body
+        :type body: str
+        :retunrs: Tuple (status, headers, body)
+        :rtype: tuple
+        '''
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_in'] += len(body)
+        parsed = urlparse.urlparse(url)
+        query = dict(
+            (k, v[-1]) for k, v in urlparse.parse_qs(
+                parsed.query, keep_blank_values=True
+            ).iteritems()
+        )
+        parts = [urllib.unquote(p) for p in parsed.path.split('/')[1:]]
+
+        try:
+            failure = None
+            if parts[:1] != ['discovery']:
+                failure = self._should_fail()
+            if failure is not None:
+                status, fail_headers = failure
+                raise FakeError(status, headers=fail_headers)
+            status, out_headers, content = self._route(
+                method, parts, query, headers, body
+            )
+        except FakeError, e:
+            with self._lock:
+                self.stats['errors'] += 1
+            status = e.status
+            out_headers = dict(e.headers)
+            out_headers['content-type'] = 'application/json'
+            content = json.dumps({'error': {
+                'code': e.status, 'message': str(e),
+                'errors': [{'message': str(e)}]
+            }})
+
+        if isinstance(content, (dict, list)):
+            if 'fields' in query and status < 300:
+                content = _select(content, query['fields'])
+            content = json.dumps(content)
+            out_headers.setdefault('content-type', 'application/json')
+
+        with self._lock:
+            self.stats['bytes_out'] += len(content)
+        return status, out_headers, content
+
+    def _route(self, method, parts, query, headers, body):
+        if parts[:2] == ['discovery', 'v1']:
+            return self._discovery()
+        if parts[:1] == ['batch']:
+            return self._batch(headers, body)
+        if parts[:3] == ['upload', 'storage', 'v1']:
+            return self._upload(method, parts[3:], query, headers, body)
+        if parts[:3] == ['storage', 'v1', 'b']:
+            return self._json(method, parts[3:], query, headers, body)
+        raise FakeError(404, 'Not found: /%s' % '/'.join(parts))
+
+    def _discovery(self):
+        with open(DISCOVERY_PATH) as f:
+            doc = json.load(f)
+        doc['rootUrl'] = self.url
+        doc['baseUrl'] = self.url + doc['servicePath']
+        return 200, {}, doc
+
+    def _json(self, method, parts, query, headers, body):
+        route = (method, len(parts))
+        if route == ('POST', 0):
+            return 200, {}, self.add_bucket(json.loads(body)['name']).resource
+        if route == ('GET', 1):
+            return 200, {}, self._bucket(parts[0]).resource
+        if route == ('DELETE', 1):
+            with self._lock:
+                if self._bucket(parts[0]).names:
+                    raise FakeError(409, 'Bucket %s not empty' % parts[0])
+                del self.buckets[parts[0]]
+            return 204, {}, ''
+
+        bucket = parts[0]
+        if route == ('GET', 2):
+            return 200, {}, self._list(bucket, query)
+
+        name = parts[2]
+        if route == ('GET', 3):
+            resource, data = self.get_object(
+                bucket, name, query.get('generation')
+            )
+            if query.get('alt') == 'media':
+                return self._media(resource, data, headers)
+            return 200, {}, resource
+        if route == ('DELETE', 3):
+            with self._lock:
+                self.get_object(bucket, name, query.get('generation'))
+                self._bucket(bucket).remove(name)
+            return 204, {}, ''
+        if route == ('PATCH', 3):
+            return 200, {}, self._patch(bucket, name, json.loads(body))
+        if route == ('POST', 4) and parts[3] == 'compose':
+            return 200, {}, self._compose(bucket, name, json.loads(body))
+        if method == 'POST' and len(parts) == 8 and parts[3] == 'rewriteTo':
+            return 200, {}, self._rewrite(
+                bucket, name, parts[5], parts[7], query
+            )
+        raise FakeError(404, 'Not found')
+
+    def _list(self, bucket, query):
+        b = self._bucket(bucket)
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        max_results = int(query.get('maxResults') or PAGE_SIZE)
+        start = query.get('pageToken') or prefix
+
+        items = []
+        prefixes = []
+        token = None
+        with self._lock:
+            i = bisect.bisect_left(b.names, start)
+            while i < len(b.names):
+                name = b.names[i]
+                if not name.startswith(prefix):
+                    break
+                if len(items) + len(prefixes) >= max_results:
+                    token = name
+                    break
+                rest = name[len(prefix):]
+                if delimiter and delimiter in rest:
+                    group = prefix + rest[:rest.index(delimiter) + 1]
+                    prefixes.append(group)
+                    i = bisect.bisect_left(
+                        b.names, group[:-1] + chr(ord(group[-1]) + 1)
+                    )
+                    continue
+                items.append(b.objects[name][0])
+                i += 1
+
+        resp = {'kind': 'storage#objects'}
+        if items:
+            resp['items'] = items
+        if prefixes:
+            resp['prefixes'] = prefixes
+        if token:
+            resp['nextPageToken'] = token
+        return resp
+
+    def _media(self, resource, data, headers):
+        size = len(data)
+        out = {
+            'content-type': resource['contentType'],
+            'x-goog-generation': resource['generation'],
+        }
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('range', ''))
+        if not match or not size:
+            return 200, out, data
+
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        if start >= size:
+            out['content-range'] = 'bytes */%d' % size
+            raise FakeError(416, 'Requested range not satisfiable', out)
+        out['content-range'] = 'bytes %d-%d/%d' % (start, end, size)
+        return 206, out, data[start:end + 1]
+
+    def _patch(self, bucket, name, body):
+        with self._lock:
+            resource, data = self.get_object(bucket, name)
+            resource = dict(resource)
+            metadata = dict(resource.get('metadata', {}))
+            for key, value in body.pop('metadata', {}).iteritems():
+                if value is None:
+                    metadata.pop(key, None)
+                else:
+                    metadata[key] = value
+            if metadata:
+                resource['metadata'] = metadata
+            for key in ('contentType', 'cacheControl', 'contentDisposition',
+                        'contentEncoding', 'contentLanguage'):
+                if key in body:
+                    resource[key] = body[key]
+            resource['metageneration'] = str(
+                int(resource['metageneration']) + 1
+            )
+            resource['updated'] = _now()
+            self._bucket(bucket).put(name, resource, data)
+            return resource
+
+    def _compose(self, bucket, name, body):
+        sources = body.get('sourceObjects', [])
+        if not sources or len(sources) > g.MAX_COMPOSE_SOURCES:
+            raise FakeError(400, 'Invalid number of source objects')
+        data = ''.join(
+            self.get_object(bucket, s['name'], s.get('generation'))[1]
+            for s in sources
+        )
+        destination = body.get('destination', {})
+        resource = self.add_object(
+            bucket, name, data, destination.get('contentType'),
+            destination.get('metadata')
+        )
+        resource['componentCount'] = len(sources)
+        del resource['md5Hash']
+        return resource
+
+    def _rewrite(self, bucket, name, dest_bucket, dest_name, query):
+        resource, data = self.get_object(
+            bucket, name, query.get('sourceGeneration')
+        )
+        size = len(data)
+        done = int(query.get('rewriteToken') or 0)
+        step = int(query.get('maxBytesRewrittenPerCall') or size)
+        done = min(size, done + max(step, 1))
+        resp = {
+            'kind': 'storage#rewriteResponse',
+            'totalBytesRewritten': str(done),
+            'objectSize': str(size),
+            'done': done >= size,
+        }
+        if done < size:
+            resp['rewriteToken'] = str(done)
+        else:
+            resp['resource'] = self.add_object(
+                dest_bucket, dest_name, data, resource['contentType'],
+                resource.get('metadata')
+            )
+        return resp
+
+    def _upload(self, method, parts, query, headers, body):
+        upload_type = query.get('uploadType')
+        if method == 'PUT' or 'upload_id' in query:
+            return self._upload_chunk(query['upload_id'], headers, body)
+        if len(parts) != 3 or parts[0] != 'b' or parts[2] != 'o':
+            raise FakeError(404, 'Not found')
+        bucket = parts[1]
+        self._bucket(bucket)
+
+        if upload_type == 'media':
+            return 200, {}, self.add_object(
+                bucket, query['name'], body, headers.get('content-type')
+            )
+        if upload_type == 'multipart':
+            meta, content_type, data = self._parse_related(headers, body)
+            return 200, {}, self.add_object(
+                bucket, meta.get('name') or query['name'], data,
+                meta.get('contentType') or content_type, meta.get('metadata')
+            )
+        if upload_type == 'resumable':
+            meta = json.loads(body) if body else {}
+            upload_id = os.urandom(8).encode('hex')
+            with self._lock:
+                self._uploads[upload_id] = {
+                    'bucket': bucket,
+                    'name': meta.get('name') or query['name'],
+                    'content_type': (
+                        meta.get('contentType') or
+                        headers.get('x-upload-content-type')
+                    ),
+                    'metadata': meta.get('metadata'),
+                    'chunks': [],
+                    'received': 0,
+                }
+            location = '%supload/storage/v1/b/%s/o?%s' % (
+                self.url, bucket, urllib.urlencode({
+                    'uploadType': 'resumable', 'upload_id': upload_id
+                })
+            )
+            return 200, {'location': location}, ''
+        raise FakeError(400, 'Unknown uploadType: %s' % upload_type)
+
+    def _parse_related(self, headers, body):
+        boundary = re.search(
+            r'boundary="?([^";]+)"?', headers.get('content-type', '')
+        ).group(1)
+        parts = body.split('--' + boundary)[1:-1]
+        out = []
+        for part in parts:
+            part = part.lstrip('\r\n')
+            sep = '\r\n\r\n' if '\r\n\r\n' in part.split('\n\n')[0] else '\n\n'
+            head, data = part.split(sep, 1)
+            if data.endswith('\r\n'):
+                data = data[:-2]
+            elif data.endswith('\n'):
+                data = data[:-1]
+            content_type = re.search(
+                r'(?im)^content-type:\s*(\S+)', head
+            ).group(1)
+            out.append((content_type, data))
+        return json.loads(out[0][1]), out[1][0], out[1][1]
+
+    def _upload_chunk(self, upload_id, headers, body):
+        with self._lock:
+            try:
+                upload = self._uploads[upload_id]
+            except KeyError:
+                raise FakeError(404, 'No such upload: %s' % upload_id)
+
+            match = re.match(
+                r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)',
+                headers.get('content-range', 'bytes */*')
+            )
+            start, total = match.group(1), match.group(3)
+            if start is not None:
+                start = int(start)
+                if start > upload['received']:
+                    raise FakeError(400, 'Upload chunk out of order')
+                data = body[upload['received'] - start:]
+                upload['chunks'].append(data)
+                upload['received'] += len(data)
+
+            if total != '*' and upload['received'] >= int(total):
+                del self._uploads[upload_id]
+                return 200, {}, self.add_object(
+                    upload['bucket'], upload['name'],
+                    ''.join(upload['chunks']), upload['content_type'],
+                    upload['metadata']
+                )
+
+            out = {}
+            if upload['received']:
+                out['range'] = 'bytes=0-%d' % (upload['received'] - 1)
+            return 308, out, ''
+
+    def _batch(self, headers, body):
+        parser = FeedParser()
+        parser.feed('content-type: %s\r\n\r\n' % headers['content-type'])
+        parser.feed(body)
+        message = parser.close()
+
+        boundary = 'batch_%s' % os.urandom(8).encode('hex')
+        out = []
+        for part in message.get_payload():
+            request_line, payload = part.get_payload().split('\n', 1)
+            method, url, _ = request_line.split(' ', 2)
+            head, _, sub_body = payload.replace('\r\n', '\n').partition(
+                '\n\n'
+            )
+            sub_headers = dict(
+                (k.strip().lower(), v.strip()) for k, v in (
+                    line.split(':', 1) for line in head.split('\n') if line
+                )
+            )
+            status, resp_headers, content = self.dispatch(
+                method, url, sub_headers, sub_body
+            )
+            resp_headers.setdefault('content-type', 'application/json')
+            out.append(
+                '--%s\r\nContent-Type: application/http\r\n'
+                'Content-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %d %s\r\n%s\r\ncontent-length: %d\r\n\r\n%s\r\n' % (
+                    boundary, part['Content-ID'][1:-1], status,
+                    STATUS_REASONS.get(status, ('Error',))[0],
+                    '\r\n'.join(
+                        '%s: %s' % kv for kv in resp_headers.iteritems()
+                    ),
+                    len(content), content
+                )
+            )
+        out.append('--%s--\r\n' % boundary)
+        return 200, {
+            'content-type': 'multipart/mixed; boundary=%s' % boundary
+        }, ''.join(out)
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Unbuffered header lines sent as separate segments stall every
+    # response on delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.fake._lock:
+            self.server.fake.stats['connections'] += 1
+
+    def _handle(self):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        fake._throttle(len(body))
+
+        headers = dict(
+            (k.lower(), v) for k, v in self.headers.items()
+        )
+        status, out_headers, content = fake.dispatch(
+            self.command, self.path, headers, body
+        )
+
+        self.send_response(status)
+        for key, value in out_headers.iteritems():
+            self.send_header(key, value)
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        fake._throttle(len(content))
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
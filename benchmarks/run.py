@@ -0,0 +1,510 @@
+'''Benchmarks of GSStorageHandler and Base against the in-process fake GCS.
+
+    python -m benchmarks.run --latency 0.02 --output results.json
+
+Results are written as JSON, one entry per benchmark with the median time
+of all runs, throughput and number of HTTP requests served.
+'''
+import os
+import csv
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import contextlib
+
+from collections import OrderedDict
+
+import google_storage
+import google_storage.core.utils as g
+
+from google_storage.core.handlers import Base
+from google_storage.core.metrics import InMemoryMetrics
+
+from benchmarks.fakegcs import FakeGCS
+
+logger = logging.getLogger(__name__)
+
+BUCKET = 'bench-bucket'
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    '''Register benchmark function. It gets Context, times the measured part
+    with ctx.timed() and returns number of operations and bytes moved.
+    '''
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class Bench(Base):
+    '''Base pointed at the fake server.
+    '''
+    bucket = BUCKET
+    mimetype = 'text/plain'
+
+
+class Context(object):
+    '''Fresh bucket and scratch directory for a single benchmark run.
+    '''
+
+    def __init__(self, fake, gs, scale):
+        self.fake = fake
+        self.gs = gs
+        self.scale = scale
+        self.seconds = None
+        self.tmpdir = tempfile.mkdtemp(prefix='gsbench-')
+        self.fake.buckets.pop(BUCKET, None)
+        self.fake.add_bucket(BUCKET)
+
+    def count(self, n):
+        return max(1, int(n * self.scale))
+
+    def make_file(self, size, name=None):
+        path = os.path.join(self.tmpdir, name or 'file-%s' % size)
+        with open(path, 'wb') as f:
+            left = size
+            while left:
+                block = os.urandom(min(left, 1024 * 1024))
+                f.write(block)
+                left -= len(block)
+        return path
+
+    def make_tree(self, path, files, size):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for i in xrange(files):
+            with open(os.path.join(path, 'part-%05d.csv' % i), 'wb') as f:
+                f.write(('%08d,' % i) * (size // 9) + '\n')
+
+    def base(self, archived=False):
+        base = Bench(
+            'bench', None, tmpdir=tempfile.mkdtemp(dir=self.tmpdir),
+            archived=archived
+        )
+        base._gs = self.gs
+        return base
+
+    @contextlib.contextmanager
+    def timed(self):
+        self.fake.reset_stats()
+        start = time.time()
+        yield
+        self.seconds = time.time() - start
+        self.stats = dict(self.fake.stats)
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def _upload_small(ctx, max_workers):
+    n = ctx.count(500)
+    base = ctx.base()
+    files = [
+        ('small', ctx.make_file(4096, 'small-%05d' % i)) for i in xrange(n)
+    ]
+    with ctx.timed():
+        base.upload(files, max_workers=max_workers)
+    return n, n * 4096
+
+
+@benchmark('upload_small_serial')
+def upload_small_serial(ctx):
+    return _upload_small(ctx, 1)
+
+
+@benchmark('upload_small_concurrent')
+def upload_small_concurrent(ctx):
+    return _upload_small(ctx, 8)
+
+
+@benchmark('put_object_small')
+def put_object_small(ctx):
+    n = ctx.count(500)
+    base = ctx.base()
+    row = [['%08d' % i, 'x' * 32] for i in xrange(100)]
+    with ctx.timed():
+        for i in xrange(n):
+            base.put_object('lookup-%05d.csv' % i, row, 'small')
+    return n, n * len('%08d,%s\r\n' % (0, 'x' * 32)) * 100
+
+
+@benchmark('upload_large')
+def upload_large(ctx):
+    size = ctx.count(64 * 1024 * 1024)
+    path = ctx.make_file(size)
+    with ctx.timed():
+        with open(path, 'rb') as f:
+            ctx.gs.upload(BUCKET, f, 'large')
+    return 1, size
+
+
+@benchmark('upload_large_composite')
+def upload_large_composite(ctx):
+    size = ctx.count(64 * 1024 * 1024)
+    path = ctx.make_file(size)
+    with ctx.timed():
+        with open(path, 'rb') as f:
+            ctx.gs.upload(BUCKET, f, 'large', composite_threshold=size // 2)
+    return 1, size
+
+
+def _download_large(ctx, sliced_threshold):
+    size = ctx.count(64 * 1024 * 1024)
+    with open(ctx.make_file(size), 'rb') as f:
+        ctx.fake.add_object(BUCKET, 'large', f.read())
+    with tempfile.NamedTemporaryFile(dir=ctx.tmpdir) as out:
+        with ctx.timed():
+            ctx.gs.download(
+                BUCKET, 'large', out, sliced_threshold=sliced_threshold
+            )
+    return 1, size
+
+
+@benchmark('download_large')
+def download_large(ctx):
+    return _download_large(ctx, None)
+
+
+@benchmark('download_large_sliced')
+def download_large_sliced(ctx):
+    return _download_large(ctx, 1)
+
+
+@benchmark('download_large_into')
+def download_large_into(ctx):
+    size = ctx.count(64 * 1024 * 1024)
+    with open(ctx.make_file(size), 'rb') as f:
+        ctx.fake.add_object(BUCKET, 'large', f.read())
+    buf = bytearray(size)
+    with ctx.timed():
+        ctx.gs.download_into(BUCKET, 'large', buf)
+    return 1, size
+
+
+def _csv_object(ctx):
+    rows = ctx.count(1000000)
+    data = ''.join('%08d,%s\n' % (i, 'x' * 40) for i in xrange(rows))
+    ctx.fake.add_object(BUCKET, 'rows.csv', data)
+    return rows, len(data)
+
+
+@benchmark('open_first_row')
+def open_first_row(ctx):
+    rows, size = _csv_object(ctx)
+    with ctx.timed():
+        f = ctx.gs.open(BUCKET, 'rows.csv')
+        row = next(csv.reader(f))
+        f.close()
+    return 1, len(','.join(row))
+
+
+@benchmark('read_csv_open')
+def read_csv_open(ctx):
+    rows, size = _csv_object(ctx)
+    with ctx.timed():
+        f = ctx.gs.open(BUCKET, 'rows.csv')
+        assert sum(1 for row in csv.reader(f)) == rows
+        f.close()
+    return rows, size
+
+
+@benchmark('read_csv_download')
+def read_csv_download(ctx):
+    rows, size = _csv_object(ctx)
+    with tempfile.NamedTemporaryFile(dir=ctx.tmpdir) as out:
+        with ctx.timed():
+            ctx.gs.download(BUCKET, 'rows.csv', out)
+            out.seek(0)
+            assert sum(1 for row in csv.reader(out)) == rows
+    return rows, size
+
+
+@benchmark('list_100k')
+def list_100k(ctx):
+    n = ctx.count(100000)
+    for i in xrange(n):
+        ctx.fake.add_object(BUCKET, 'list/%02d/%08d' % (i % 100, i), '')
+    with ctx.timed():
+        listed = sum(1 for _ in ctx.gs.iter_bucket_content(
+            BUCKET, prefix='list/', fields='name'
+        ))
+    assert listed == n, listed
+    return n, 0
+
+
+@benchmark('delete_batch')
+def delete_batch(ctx):
+    n = ctx.count(10000)
+    for i in xrange(n):
+        ctx.fake.add_object(BUCKET, 'delete/%08d' % i, '')
+    with ctx.timed():
+        summary = ctx.gs.delete_bucket_content(BUCKET, prefix='delete/')
+    assert summary['deleted'] == n, summary
+    return n, 0
+
+
+@benchmark('stat_many')
+def stat_many(ctx):
+    n = ctx.count(5000)
+    names = ['stat/%08d' % i for i in xrange(n)]
+    for name in names[::2]:
+        ctx.fake.add_object(BUCKET, name, '')
+    with ctx.timed():
+        exists = ctx.gs.exists_many(BUCKET, names)
+    assert sum(exists.values()) == len(names[::2])
+    return n, 0
+
+
+def _copy_objects(ctx):
+    n = ctx.count(100)
+    size = 256 * 1024
+    block = os.urandom(size)
+    for i in xrange(n):
+        ctx.fake.add_object(BUCKET, 'copy/%05d' % i, block)
+    return n, n * size
+
+
+@benchmark('copy_prefix')
+def copy_prefix(ctx):
+    n, size = _copy_objects(ctx)
+    with ctx.timed():
+        copies = ctx.gs.copy_prefix(BUCKET, 'copy/', BUCKET, 'copied/')
+    assert len(copies) == n
+    return n, size
+
+
+@benchmark('copy_prefix_download')
+def copy_prefix_download(ctx):
+    n, size = _copy_objects(ctx)
+
+    def copy_one(item):
+        # Whole object like copy_prefix, length comes from the listing
+        data = ctx.gs.download_range(
+            BUCKET, item['name'], 0, int(item['size'])
+        )
+        ctx.gs.upload(
+            BUCKET, data, name=item['name'].replace('copy/', 'copied/')
+        )
+
+    with ctx.timed():
+        items = list(ctx.gs.iter_bucket_content(
+            BUCKET, prefix='copy/', fields='name,size'
+        ))
+        for _, error in g.thread_map(copy_one, items, max_workers=8):
+            if error is not None:
+                raise error
+    assert len(items) == n
+    return n, size
+
+
+def _store_gs(ctx, archived, stream=False):
+    n = ctx.count(200)
+    base = ctx.base(archived)
+    path = base.archive_path() if archived else base.tmpdir
+    ctx.make_tree(path, n, 16 * 1024)
+    with ctx.timed():
+        base.store_gs(max_workers=8, stream=stream)
+    return n, n * 16 * 1024
+
+
+@benchmark('store_gs')
+def store_gs(ctx):
+    return _store_gs(ctx, False)
+
+
+@benchmark('store_gs_archived')
+def store_gs_archived(ctx):
+    return _store_gs(ctx, True)
+
+
+@benchmark('store_gs_archived_stream')
+def store_gs_archived_stream(ctx):
+    return _store_gs(ctx, True, stream=True)
+
+
+def _archived(ctx, indexed=False):
+    n = ctx.count(64)
+    base = ctx.base(archived=True)
+    base.index_archive = indexed
+    os.makedirs(base.archive_path())
+    for i in xrange(n):
+        ctx.make_file(1024 * 1024, os.path.join(
+            base.archive_path(), 'part-%05d' % i
+        ))
+    base.store_gs(stream=True)
+    return base, n
+
+
+@benchmark('restore_archived')
+def restore_archived(ctx):
+    base, n = _archived(ctx)
+    with ctx.timed():
+        base.restore(tempfile.mkdtemp(dir=ctx.tmpdir))
+    return n, n * 1024 * 1024
+
+
+@benchmark('restore_archived_download')
+def restore_archived_download(ctx):
+    base, n = _archived(ctx)
+    with ctx.timed():
+        with contextlib.closing(base.download_archive()) as tar:
+            tar.extractall(tempfile.mkdtemp(dir=ctx.tmpdir))
+    return n, n * 1024 * 1024
+
+
+def _read_archived(ctx, indexed):
+    base, n = _archived(ctx, indexed)
+    with ctx.timed():
+        base.read_archived('part-%05d' % (n // 2))
+    return 1, 1024 * 1024
+
+
+@benchmark('read_archived_member')
+def read_archived_member(ctx):
+    return _read_archived(ctx, False)
+
+
+@benchmark('read_archived_member_indexed')
+def read_archived_member_indexed(ctx):
+    return _read_archived(ctx, True)
+
+
+def run(names, fake, scale=1.0, repeat=3, metrics=False):
+    '''Run benchmarks.
+    :param names: Names of benchmarks to run
+    :type names: list
+    :param fake: Started fake server
+    :type fake: FakeGCS
+    :param scale: Multiplier of number of objects and sizes
+    :type scale: float
+    :param repeat: Number of runs of every benchmark
+    :type repeat: int
+    :param metrics: Add per operation metrics of the median run
+    :type metrics: bool
+    :returns: Results, one dict per benchmark
+    :rtype: list
+    '''
+    gs = fake.handler()
+    results = []
+    for name in names:
+        runs = []
+        for i in xrange(repeat):
+            ctx = Context(fake, gs, scale)
+            gs.metrics = InMemoryMetrics() if metrics else g.NULL_METRICS
+            try:
+                ops, nbytes = BENCHMARKS[name](ctx)
+            finally:
+                ctx.close()
+            runs.append((ctx.seconds, ctx.stats, gs.metrics))
+            logger.info("%s #%d: %.3fs" % (name, i + 1, ctx.seconds))
+
+        runs.sort(key=lambda r: r[0])
+        seconds, stats, run_metrics = runs[len(runs) // 2]
+        result = OrderedDict([
+            ('name', name),
+            ('seconds', seconds),
+            ('runs', [r[0] for r in runs]),
+            ('ops', ops),
+            ('bytes', nbytes),
+            ('ops_per_sec', ops / seconds if seconds else None),
+            ('mb_per_sec', nbytes / seconds / 2**20 if seconds else None),
+            ('requests', stats['requests']),
+            ('errors', stats['errors']),
+        ])
+        if metrics:
+            result['metrics'] = run_metrics.summary()
+        results.append(result)
+    gs.close()
+    return results
+
+
+def compare(previous, results):
+    '''Log change of median time against previous results.
+    '''
+    before = dict((r['name'], r['seconds']) for r in previous['results'])
+    for r in results:
+        if before.get(r['name']):
+            logger.info("%-28s %8.3fs -> %8.3fs  x%.2f" % (
+                r['name'], before[r['name']], r['seconds'],
+                before[r['name']] / r['seconds']
+            ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='NAME',
+                        help='Benchmarks to run, all by default: %s' %
+                        ', '.join(BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every request')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bytes per second per connection')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Probability of a request failing with 503')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier of object counts and sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', action='store_true',
+                        help='Add per operation latency percentiles')
+    parser.add_argument('--output', help='JSON file, stdout if not set')
+    parser.add_argument('--compare', help='Previous JSON results')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr, format='%(message)s'
+    )
+    logging.getLogger('google_storage').setLevel(logging.WARNING)
+    logging.getLogger('googleapiclient').setLevel(logging.WARNING)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    config = OrderedDict([
+        ('latency', args.latency),
+        ('bandwidth', args.bandwidth),
+        ('error_rate', args.error_rate),
+        ('scale', args.scale),
+        ('repeat', args.repeat),
+        ('chunksize', g.CHUNKSIZE),
+    ])
+    with FakeGCS(
+        args.latency, args.bandwidth, args.error_rate, seed=args.seed
+    ) as fake:
+        results = run(
+            names, fake, args.scale, args.repeat, args.metrics
+        )
+
+    report = OrderedDict([
+        ('version', google_storage.__version__),
+        ('timestamp', datetime.datetime.utcnow().isoformat() + 'Z'),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('config', config),
+        ('results', results),
+    ])
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
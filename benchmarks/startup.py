@@ -0,0 +1,136 @@
+'''Startup cost of google_storage: import plus first handler and first call,
+each measured in a fresh interpreter against the in-process fake GCS.
+
+    python -m benchmarks.startup --latency 0.05 --output startup.json
+
+Mode bundled builds the handler from the discovery document shipped with
+the package, mode discovery fetches it from the server as handlers did
+before and eager imports the API client up front.
+'''
+import os
+import sys
+import json
+import logging
+import argparse
+import platform
+import datetime
+import subprocess
+
+from collections import OrderedDict
+
+import google_storage
+
+from benchmarks.fakegcs import FakeGCS
+from benchmarks.run import compare
+
+logger = logging.getLogger(__name__)
+
+BUCKET = 'bench-bucket'
+MODES = ('bundled', 'discovery')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import sys, json, time
+start = time.time()
+if sys.argv[1] == 'discovery':
+    import googleapiclient.discovery, googleapiclient.http
+import google_storage.core.handlers
+import google_storage.core.utils as g
+imported = time.time()
+modules = len(sys.modules)
+from oauth2client.client import AccessTokenCredentials
+credentials = AccessTokenCredentials('fake-token', 'fakegcs')
+if sys.argv[1] == 'discovery':
+    gs = g.GSStorageHandler(credentials=credentials, discovery_url=sys.argv[3])
+else:
+    gs = g.GSStorageHandler(credentials=credentials, root_url=sys.argv[2])
+assert gs.bucket_exists(sys.argv[4])
+done = time.time()
+json.dump({
+    'import': imported - start,
+    'first_call': done - imported,
+    'modules': modules,
+}, sys.stdout)
+'''
+
+
+def measure(fake, mode):
+    '''Run single fresh interpreter.
+    :retunrs: Seconds of import and of first handler call and number of
+              modules imported by the package.
+    :rtype: dict
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [env.get('PYTHONPATH')])
+    )
+    out = subprocess.check_output([
+        sys.executable, '-c', CHILD, mode, fake.url, fake.discovery_url,
+        BUCKET
+    ], env=env)
+    return json.loads(out)
+
+
+def run(fake, repeat=5):
+    '''Measure every mode repeat times.
+    :retunrs: Results with median of every measurement, one dict per mode
+    :rtype: list
+    '''
+    results = []
+    for mode in MODES:
+        runs = [measure(fake, mode) for i in xrange(repeat)]
+        result = OrderedDict([('name', 'startup_%s' % mode)])
+        for key in ('import', 'first_call'):
+            values = sorted(r[key] for r in runs)
+            result[key] = values[len(values) // 2]
+        result['seconds'] = result['import'] + result['first_call']
+        result['modules'] = runs[0]['modules']
+        logger.info("%-20s import %.3fs first call %.3fs" % (
+            result['name'], result['import'], result['first_call']
+        ))
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every request')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='JSON file, stdout if not set')
+    parser.add_argument('--compare', help='Previous JSON results')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr, format='%(message)s'
+    )
+
+    with FakeGCS(args.latency) as fake:
+        fake.add_bucket(BUCKET)
+        results = run(fake, args.repeat)
+
+    report = OrderedDict([
+        ('version', google_storage.__version__),
+        ('timestamp', datetime.datetime.utcnow().isoformat() + 'Z'),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('config', OrderedDict([
+            ('latency', args.latency), ('repeat', args.repeat)
+        ])),
+        ('results', results),
+    ])
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+import google_storage.core.utils as g
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = 16
+# Lazy iterators, wrapping them would only queue creating the iterator
+SYNC_ONLY = frozenset([
+    'iter_bucket_pages', 'iter_bucket_content', 'iter_stat_many'
+])
+
+
+def _async_method(name):
+    '''Create method running GSStorageHandler method of the same name on the
+    pool and returning its AsyncResult.
+    '''
+
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.handler, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = (
+        'Non blocking GSStorageHandler.%s, returns AsyncResult.' % name
+    )
+    return method
+
+
+def _add_async_methods(cls):
+    '''Add wrapper of every public GSStorageHandler method to cls, except
+    SYNC_ONLY ones.
+    '''
+    for name, value in vars(g.GSStorageHandler).iteritems():
+        if name.startswith('_') or name in SYNC_ONLY or not callable(value):
+            continue
+        setattr(cls, name, _async_method(name))
+    return cls
+
+
+@_add_async_methods
+class AsyncGSStorageHandler(object):
+    '''Non blocking counterpart of GSStorageHandler. Every call is queued on
+    a bounded pool of worker threads and returns an AsyncResult right away.
+    Workers keep their own persistent authorized connection, so the pool is
+    also the connection pool and its size limits concurrency no matter how
+    many calls are queued. It has a method for every public
+    GSStorageHandler method except SYNC_ONLY iterators.
+    '''
+
+    def __init__(
+        self, json_key_path=None, max_concurrency=MAX_CONCURRENCY,
+        handler=None
+    ):
+        '''Constructor
+        :param json_key_path: path to the stored json_key
+        :type json_key_path: str
+        :param max_concurrency: Maximum number of calls running at once
+        :type max_concurrency: int
+        :param handler: Handler to use, shared one from registry if None
+        :type handler: GSStorageHandler
+        '''
+        self.handler = handler or g.registry.get(json_key_path)
+        self.max_concurrency = max_concurrency
+        self._pool = ThreadPool(max_concurrency)
+
+    def submit(self, func, *args, **kwargs):
+        '''Queue any callable on the pool.
+        :retunrs: Result available once the call finishes
+        :rtype: multiprocessing.pool.AsyncResult
+        '''
+        return self._pool.apply_async(func, args, kwargs)
+
+    def close(self):
+        '''Wait for queued calls and stop the workers.
+        '''
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def gather(results, return_exceptions=False, timeout=None):
+    '''Wait for all results.
+    :param results: AsyncResults to wait for
+    :type results: iterable
+    :param return_exceptions: Put exceptions in place of failed results
+                              instead of raising the first one.
+    :type return_exceptions: bool
+    :param timeout: Seconds to wait for every single result
+    :type timeout: float
+    :retunrs: Results in input order
+    :rtype: list
+    '''
+    out = []
+    for result in results:
+        try:
+            out.append(result.get(timeout))
+        except Exception, e:
+            if not return_exceptions:
+                raise
+            out.append(e)
+    return out
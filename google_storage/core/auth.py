@@ -0,0 +1,156 @@
+import os
+import json
+import logging
+import threading
+
+import httplib2
+
+from oauth2client.client import SignedJwtAssertionCredentials
+
+logger = logging.getLogger(__name__)
+
+SCOPE_URI = 'https://www.googleapis.com/auth/%s'
+# Tokens expiring sooner are refreshed in the background
+REFRESH_MARGIN = 300
+# Tokens expiring sooner are refreshed before the request is sent
+MIN_TOKEN_LIFETIME = 30
+
+
+class SharedToken(object):
+    '''Mixin of oauth2client credentials for a single instance shared by
+    many threads and handlers. Refreshes are single-flight: threads
+    needing a new token wait for the one refreshing it instead of exchanging
+    their own. A token close to expiry is refreshed by a background thread
+    while requests keep using the current one.
+    '''
+    refresh_margin = REFRESH_MARGIN
+    min_token_lifetime = MIN_TOKEN_LIFETIME
+
+    def _init_shared(self):
+        self._refresh_lock = threading.Lock()
+        self._background_lock = threading.Lock()
+        self._refreshing = False
+
+    def _to_json(self, strip):
+        return super(SharedToken, self)._to_json(
+            list(strip) + ['_refresh_lock', '_background_lock', '_refreshing']
+        )
+
+    def __getstate__(self):
+        state = super(SharedToken, self).__getstate__()
+        for name in ('_refresh_lock', '_background_lock', '_refreshing'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        super(SharedToken, self).__setstate__(state)
+        self._init_shared()
+
+    def _refresh(self, http_request):
+        token = self.access_token
+        with self._refresh_lock:
+            if self.access_token != token and not self._expiring(
+                self.min_token_lifetime
+            ):
+                # Another thread refreshed while this one waited
+                return
+            super(SharedToken, self)._refresh(http_request)
+
+    def _expiring(self, seconds):
+        expires_in = self._expires_in()
+        return expires_in is not None and expires_in < seconds
+
+    def _refresh_in_background(self):
+        with self._background_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(
+            target=self._background_refresh, name='token-refresh'
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            self._refresh(httplib2.Http().request)
+        except Exception, e:
+            logger.warning("Background token refresh failed: %s" % e)
+        finally:
+            self._refreshing = False
+
+    def apply(self, headers):
+        if self.access_token:
+            if self._expiring(self.min_token_lifetime):
+                self._refresh(httplib2.Http().request)
+            elif self._expiring(self.refresh_margin):
+                self._refresh_in_background()
+        super(SharedToken, self).apply(headers)
+
+
+class CachedCredentials(SharedToken, SignedJwtAssertionCredentials):
+    '''Service account credentials shared through TokenCache.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(CachedCredentials, self).__init__(*args, **kwargs)
+        self._init_shared()
+
+
+class TokenCache(object):
+    '''Process wide cache of credentials keyed by client_email and scope.
+    Handlers of the same service account share one access token, which
+    outlives the handlers, so a recreated handler doesn't sign and exchange
+    a new JWT. Key files are parsed again only when they change.
+    '''
+
+    def __init__(self, credentials_class=CachedCredentials):
+        '''Constructor
+        :param credentials_class: Class constructed with client_email,
+                                  private_key and scope.
+        :type credentials_class: type
+        '''
+        self.credentials_class = credentials_class
+        self._keys = {}
+        self._credentials = {}
+        self._lock = threading.Lock()
+
+    def _read_key(self, json_key_path):
+        path = os.path.abspath(json_key_path)
+        mtime = os.stat(path).st_mtime
+        key = self._keys.get(path)
+        if key is None or key[0] != mtime:
+            with open(path, 'r') as f:
+                json_key = json.load(f)
+            key = (mtime, json_key['client_email'], json_key['private_key'])
+            self._keys[path] = key
+        return key[1:]
+
+    def get(self, json_key_path, service):
+        '''Credentials of the service account stored in json key.
+        :param json_key_path: path to the stored json_key
+        :type json_key_path: str
+        :param service: scope suffix to authenticate with
+        :type service: str
+        :retunrs: Credentials shared with other callers
+        :rtype: oauth2client.client.Credentials
+        '''
+        scope = SCOPE_URI % service
+        with self._lock:
+            client_email, private_key = self._read_key(json_key_path)
+            cached = self._credentials.get((client_email, scope))
+            if cached is None or cached[0] != private_key:
+                credentials = self.credentials_class(
+                    client_email, private_key, [scope]
+                )
+                cached = (private_key, credentials)
+                self._credentials[(client_email, scope)] = cached
+            return cached[1]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self._credentials.clear()
+
+
+TOKEN_CACHE = TokenCache()
@@ -0,0 +1,179 @@
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+LOCK_NAME = '.lock'
+
+
+class DownloadCache(object):
+    '''Local cache of downloaded objects keyed by bucket, name and
+    generation. Safe to share between processes: entries are written to a
+    temporary file and renamed into place, inserts and evictions hold an
+    exclusive lock on the cache directory.
+    '''
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        '''Constructor
+        :param path: Cache directory, created if missing
+        :type path: str
+        :param max_bytes: Size above which least recently used entries are
+                          evicted.
+        :type max_bytes: int
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _object_dir(self, bucket, name):
+        key = '%s/%s' % (bucket, name)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def entry_path(self, bucket, name, generation):
+        '''Path of the cached copy of given object generation.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param name: path to the item in google storage
+        :type name: str
+        :param generation: Object generation
+        :type generation: str
+        :retunrs: Path to the entry, which may not exist
+        :rtype: str
+        '''
+        return os.path.join(self._object_dir(bucket, name), str(generation))
+
+    def _lock(self):
+        fd = os.open(
+            os.path.join(self.path, LOCK_NAME), os.O_RDWR | os.O_CREAT
+        )
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def get(self, gs, bucket, name, fileout=None, details=None, **kwargs):
+        '''Return object from cache, downloading it on miss. Cached copy is
+        revalidated with a metadata call for the current generation.
+        :param gs: Handler used for metadata and download calls
+        :type gs: GSStorageHandler
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param name: path to the item in google storage
+        :type name: str
+        :param fileout: File to copy the object into. If None read only file
+                        opened on the cached copy is returned.
+        :type fileout: file
+        :param details: Object resource with generation, fetched if None
+        :type details: dict
+        :param kwargs: Passed to GSStorageHandler.download on miss
+        :retunrs: File object positioned at the beginning
+        :rtype: file
+        '''
+        if details is None or 'generation' not in details:
+            details = gs.object_details(bucket, name, fields='generation')
+        generation = details['generation']
+        path = self.entry_path(bucket, name, generation)
+
+        try:
+            cached = open(path, 'rb')
+        except IOError:
+            logger.debug("Cache miss %s/%s#%s" % (bucket, name, generation))
+            cached = self._insert(gs, bucket, name, generation, kwargs)
+        else:
+            logger.debug("Cache hit %s/%s#%s" % (bucket, name, generation))
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+        if fileout is None:
+            return cached
+
+        with cached:
+            fileout.seek(0)
+            fileout.truncate()
+            shutil.copyfileobj(cached, fileout)
+        fileout.flush()
+        fileout.seek(0)
+        return fileout
+
+    def _insert(self, gs, bucket, name, generation, kwargs):
+        object_dir = self._object_dir(bucket, name)
+        if not os.path.exists(object_dir):
+            try:
+                os.makedirs(object_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        tmp = tempfile.NamedTemporaryFile(
+            dir=self.path, prefix='.download-', delete=False
+        )
+        try:
+            with tmp:
+                gs.download(bucket, name, tmp, generation=generation, **kwargs)
+            cached = open(tmp.name, 'rb')
+        except Exception:
+            os.unlink(tmp.name)
+            raise
+
+        fd = self._lock()
+        try:
+            for old in os.listdir(object_dir):
+                os.unlink(os.path.join(object_dir, old))
+            os.rename(tmp.name, self.entry_path(bucket, name, generation))
+            self._evict()
+        finally:
+            self._unlock(fd)
+        return cached
+
+    def _entries(self):
+        for object_dir in os.listdir(self.path):
+            path = os.path.join(self.path, object_dir)
+            if not os.path.isdir(path):
+                continue
+            for generation in os.listdir(path):
+                entry = os.path.join(path, generation)
+                try:
+                    st = os.stat(entry)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, entry
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            logger.debug("Evicting %s from cache" % entry)
+            try:
+                os.unlink(entry)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        '''Remove all entries.
+        '''
+        fd = self._lock()
+        try:
+            for _, _, entry in list(self._entries()):
+                os.unlink(entry)
+        finally:
+            self._unlock(fd)
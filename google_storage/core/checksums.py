@@ -0,0 +1,245 @@
+import base64
+import hashlib
+import struct
+
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
+
+READ_SIZE = 1024 * 1024
+CHECKSUM_FIELDS = ('md5Hash', 'crc32c')
+# Without crcmod's C extension CRC32C is computed in python at a few MB/s
+FAST_CRC32C = crcmod is not None and crcmod.crcmod._usingExtension
+
+
+class ChecksumError(IOError):
+    '''Raised when local and remote checksums don't match.
+    '''
+
+
+def _crc32c_table():
+    '''Lookup table for the Castagnoli polynomial (reflected).
+    '''
+    table = []
+    for i in xrange(256):
+        crc = i
+        for _ in xrange(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82F63B78
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+class Crc32c(object):
+    '''CRC32C as used by google storage. Uses crcmod C extension when
+    installed, pure python implementation otherwise.
+    '''
+
+    def __init__(self, data=''):
+        '''Constructor
+        :param data: Initial data
+        :type data: str
+        '''
+        if crcmod:
+            self._crc = crcmod.predefined.Crc('crc-32c')
+        else:
+            self._crc = None
+            self._value = 0xFFFFFFFF
+        self.update(data)
+
+    def update(self, data):
+        '''Feed data into checksum.
+        :param data: Data
+        :type data: str
+        '''
+        if self._crc is not None:
+            self._crc.update(data)
+            return
+
+        crc = self._value
+        table = _CRC32C_TABLE
+        for ch in bytearray(data):
+            crc = table[(crc ^ ch) & 0xFF] ^ (crc >> 8)
+        self._value = crc
+
+    def value(self):
+        '''Checksum as integer.
+        '''
+        if self._crc is not None:
+            return self._crc.crcValue
+        return self._value ^ 0xFFFFFFFF
+
+    def digest(self):
+        '''Checksum as big endian bytes.
+        '''
+        return struct.pack('>I', self.value())
+
+    def b64digest(self):
+        '''Checksum in the format of object's crc32c field.
+        '''
+        return base64.b64encode(self.digest())
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32c_combine(crc1, crc2, length2):
+    '''CRC32C of two concatenated blocks computed from their checksums,
+    as zlib's crc32_combine does for CRC32.
+    :param crc1: CRC32C of the first block
+    :type crc1: int
+    :param crc2: CRC32C of the second block
+    :type crc2: int
+    :param length2: Length of the second block
+    :type length2: int
+    :retunrs: CRC32C of the first block followed by the second
+    :rtype: int
+    '''
+    if length2 <= 0:
+        return crc1
+
+    # Operator appending one zero bit, then two and four zero bits
+    odd = [0x82F63B78] + [1 << n for n in xrange(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+
+    # Append length2 zero bytes to crc1, squaring operator for every bit
+    while True:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+def crc32c_b64digest(value):
+    '''CRC32C value in the format of object's crc32c field.
+    :param value: Checksum as integer
+    :type value: int
+    :retunrs: Base64 encoded big endian checksum
+    :rtype: str
+    '''
+    return base64.b64encode(struct.pack('>I', value))
+
+
+def checksum_field(resource):
+    '''Field to verify the object with, MD5 unless the object has only
+    CRC32C as composite objects do.
+    :param resource: Object resource
+    :type resource: dict
+    :retunrs: 'md5Hash', 'crc32c' or None if resource has neither
+    :rtype: str
+    '''
+    for field in CHECKSUM_FIELDS:
+        if field in resource:
+            return field
+    return None
+
+
+def _digests(md5, crc):
+    out = {}
+    if md5 is not None:
+        out['md5Hash'] = base64.b64encode(md5.digest())
+    if crc is not None:
+        out['crc32c'] = crc.b64digest()
+    return out
+
+
+def file_checksums(fileobject, offset=0, length=None, fields=CHECKSUM_FIELDS):
+    '''Compute MD5 and CRC32C of a file or its part.
+    :param fileobject: File opened in binary mode
+    :type fileobject: file
+    :param offset: Position of the first byte
+    :type offset: int
+    :param length: Number of bytes, till the end of file if None
+    :type length: int
+    :param fields: Checksums to compute, only those are returned
+    :type fields: tuple
+    :retunrs: Base64 encoded md5 and crc32c as in object resource
+    :rtype: dict {'md5Hash': str, 'crc32c': str}
+    '''
+    md5 = hashlib.md5() if 'md5Hash' in fields else None
+    crc = Crc32c() if 'crc32c' in fields else None
+    fileobject.seek(offset)
+    while length is None or length > 0:
+        size = READ_SIZE if length is None else min(READ_SIZE, length)
+        data = fileobject.read(size)
+        if not data:
+            break
+        if md5 is not None:
+            md5.update(data)
+        if crc is not None:
+            crc.update(data)
+        if length is not None:
+            length -= len(data)
+
+    return _digests(md5, crc)
+
+
+def path_checksums(path, fields=CHECKSUM_FIELDS):
+    '''Compute MD5 and CRC32C of a file under path.
+    :param path: Path to the file
+    :type path: str
+    :param fields: Checksums to compute, only those are returned
+    :type fields: tuple
+    :retunrs: Base64 encoded md5 and crc32c as in object resource
+    :rtype: dict {'md5Hash': str, 'crc32c': str}
+    '''
+    with open(path, 'rb') as f:
+        return file_checksums(f, fields=fields)
+
+
+def data_checksums(data, offset=0, length=None, fields=CHECKSUM_FIELDS):
+    '''Compute MD5 and CRC32C of data in memory without copying it.
+    :param data: str, bytearray, mmap, memoryview or other buffer
+    :type data: buffer
+    :param offset: Position of the first byte
+    :type offset: int
+    :param length: Number of bytes, till the end of data if None
+    :type length: int
+    :param fields: Checksums to compute, only those are returned
+    :type fields: tuple
+    :retunrs: Base64 encoded md5 and crc32c as in object resource
+    :rtype: dict {'md5Hash': str, 'crc32c': str}
+    '''
+    md5 = hashlib.md5() if 'md5Hash' in fields else None
+    crc = Crc32c() if 'crc32c' in fields else None
+    end = len(data) if length is None else offset + length
+    for start in xrange(offset, end, READ_SIZE):
+        size = min(READ_SIZE, end - start)
+        if isinstance(data, memoryview):
+            block = data[start:start + size].tobytes()
+        else:
+            block = buffer(data, start, size)
+        if md5 is not None:
+            md5.update(block)
+        if crc is not None:
+            crc.update(block)
+
+    return _digests(md5, crc)
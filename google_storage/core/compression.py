@@ -0,0 +1,614 @@
+import os
+import zlib
+import bisect
+import struct
+import tarfile
+import logging
+import importlib
+import multiprocessing
+
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+BLOCK_SIZE = 1024 * 1024
+CHECKPOINT_SIZE = 1024 * 1024
+INDEX_EXTENSION = '.index.json'
+
+_modules = {}
+
+
+def _optional(name):
+    '''Import optional codec module on first use, they are slow to import.
+    :retunrs: Module or None if it isn't installed
+    :rtype: module
+    '''
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module(name)
+        except ImportError:
+            _modules[name] = None
+    return _modules[name]
+
+
+class CompressedWriter(object):
+    '''Write only file object compressing data into fileobj. Closing it
+    flushes the compressor but leaves fileobj open.
+    '''
+
+    def __init__(self, fileobj, compressobj, header=''):
+        '''Constructor
+        :param fileobj: Object with write method
+        :type fileobj: file
+        :param compressobj: Object with compress and flush methods
+        :type compressobj: object
+        :param header: Data written before compressed output
+        :type header: str
+        '''
+        self.fileobj = fileobj
+        self._compressobj = compressobj
+        if header:
+            fileobj.write(header)
+
+    def write(self, data):
+        out = self._compressobj.compress(data)
+        if out:
+            self.fileobj.write(out)
+
+    def close(self):
+        if self._compressobj is not None:
+            self.fileobj.write(self._compressobj.flush())
+            self._compressobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
+
+class ParallelGzipWriter(object):
+    '''Write only file object producing standard single member gzip. Input is
+    split into blocks compressed independently in threads and joined with
+    sync flushes, so any gunzip can read the result. Header has no mtime,
+    same input always gives the same output.
+    '''
+
+    def __init__(
+        self, fileobj, level=6, workers=None, block_size=BLOCK_SIZE,
+        pool=None
+    ):
+        '''Constructor
+        :param fileobj: Object with write method
+        :type fileobj: file
+        :param level: Compression level 1-9
+        :type level: int
+        :param workers: Number of compressing threads, CPU count if None
+        :type workers: int
+        :param block_size: Size of independently compressed block
+        :type block_size: int
+        :param pool: Thread pool with workers threads shared with other
+                     writers, left running on close. Own pool if None.
+        :type pool: ThreadPool
+        '''
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self._owns_pool = pool is None
+        self._pool = ThreadPool(self.workers) if pool is None else pool
+        self._pending = []
+        self._buffer = []
+        self._buffered = 0
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+        fileobj.write(
+            '\x1f\x8b\x08\x00' + struct.pack('<I', 0) + '\x00\xff'
+        )
+
+    def _compress(self, block, last):
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return c.compress(block) + c.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        )
+
+    def _submit(self, block, last=False):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(
+            self._pool.apply_async(self._compress, (block, last))
+        )
+        while len(self._pending) > 2 * self.workers or (
+            last and self._pending
+        ):
+            self.fileobj.write(self._pending.pop(0).get())
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = ''.join(self._buffer)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._submit(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self._buffer = [data[offset:]]
+            self._buffered = len(data) - offset
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit(''.join(self._buffer), last=True)
+            self.fileobj.write(struct.pack(
+                '<II', self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF
+            ))
+        finally:
+            self._terminate()
+
+    def _terminate(self):
+        if self._owns_pool:
+            self._pool.terminate()
+            self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self._terminate()
+
+
+class _CountingWriter(object):
+    '''Pass writes to fileobj counting bytes written.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.fileobj.write(data)
+
+
+class CheckpointWriter(object):
+    '''Write only file object compressing into fileobj as a series of
+    independent frames, members for gzip. A new frame is started on every
+    checkpoint, so decompression can start there. Decompressors of the
+    codec read the frames one after another as a single stream. Codec's
+    thread pool, if it uses one, is shared by all frames.
+    '''
+
+    def __init__(self, fileobj, codec, level=None):
+        '''Constructor
+        :param fileobj: Object with write method
+        :type fileobj: file
+        :param codec: Codec compressing the frames
+        :type codec: Codec
+        :param level: Compression level, codec's default if None
+        :type level: int
+        '''
+        self.codec = codec
+        self.level = level
+        self.checkpoints = [(0, 0)]
+        self._out = _CountingWriter(fileobj)
+        self._offset = 0
+        self._pool = codec.pool()
+        self._compressor = codec.compressor(self._out, level, self._pool)
+
+    @property
+    def compressed_size(self):
+        return self._out.bytes
+
+    def tell(self):
+        return self._offset
+
+    def write(self, data):
+        self._offset += len(data)
+        self._compressor.write(data)
+
+    def checkpoint(self):
+        '''Finish the frame and start a new one. Offsets of uncompressed
+        and compressed data where it starts are added to checkpoints.
+        '''
+        if self.checkpoints[-1][0] == self._offset:
+            return
+        self._compressor.close()
+        self.checkpoints.append((self._offset, self._out.bytes))
+        self._compressor = self.codec.compressor(
+            self._out, self.level, self._pool
+        )
+
+    def _terminate(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def close(self):
+        try:
+            if self._compressor is not None:
+                self._compressor.close()
+                self._compressor = None
+        finally:
+            self._terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self._terminate()
+
+
+class DecompressedReader(object):
+    '''Read only file object decompressing a stream on the fly. Concatenated
+    frames or members are read one after another.
+    '''
+
+    def __init__(self, fileobj, decompressobj_factory):
+        '''Constructor
+        :param fileobj: Object with read method
+        :type fileobj: file
+        :param decompressobj_factory: Returns object with decompress method
+        :type decompressobj_factory: callable
+        '''
+        self.fileobj = fileobj
+        self._factory = decompressobj_factory
+        self._decompressobj = decompressobj_factory()
+        self._buffer = ''
+        self._eof = False
+
+    def _unused(self):
+        return getattr(self._decompressobj, 'unused_data', '')
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while not self._eof and (size < 0 or length < size):
+            data = self._unused()
+            if data:
+                self._decompressobj = self._factory()
+            else:
+                data = self.fileobj.read(READ_SIZE)
+                if not data:
+                    self._eof = True
+                    break
+            out = self._decompressobj.decompress(data)
+            parts.append(out)
+            length += len(out)
+
+        data = ''.join(parts)
+        if size < 0:
+            size = length
+        data, self._buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class _FullReader(object):
+    '''Read size bytes or up to the end of data from fileobj whose reads
+    may return less.
+    '''
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.fileobj.read()
+        parts = []
+        length = 0
+        while length < size:
+            data = self.fileobj.read(size - length)
+            if not data:
+                break
+            parts.append(data)
+            length += len(data)
+        return ''.join(parts)
+
+    def close(self):
+        pass
+
+
+class Codec(object):
+    '''Compression codec used for archived snapshots.
+    '''
+    name = None
+    extension = None
+    content_type = None
+    magic = None
+    default_level = None
+
+    def available(self):
+        return True
+
+    def level(self, level):
+        return self.default_level if level is None else level
+
+    def pool(self):
+        '''Returns thread pool compressors can share, None if the codec
+        doesn't use one. Caller terminates it.
+        '''
+        return None
+
+    def compressor(self, fileobj, level=None, pool=None):
+        '''Returns file object compressing into fileobj.
+        :param pool: Thread pool returned by pool method
+        :type pool: ThreadPool
+        '''
+        raise NotImplementedError()
+
+    def decompressor(self, fileobj):
+        '''Returns file object decompressing data read from fileobj.
+        '''
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    name = 'gz'
+    extension = '.tar.gz'
+    content_type = 'application/x-gzip'
+    magic = '\x1f\x8b'
+    default_level = 9
+
+    def compressor(self, fileobj, level=None, pool=None):
+        return CompressedWriter(fileobj, zlib.compressobj(
+            self.level(level), zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        ))
+
+    def decompressor(self, fileobj):
+        return DecompressedReader(
+            fileobj, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        )
+
+
+class ParallelGzipCodec(GzipCodec):
+    name = 'pgz'
+    default_level = 6
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def pool(self):
+        return ThreadPool(self.workers or multiprocessing.cpu_count())
+
+    def compressor(self, fileobj, level=None, pool=None):
+        return ParallelGzipWriter(
+            fileobj, self.level(level), self.workers, pool=pool
+        )
+
+
+class ZstdCodec(Codec):
+    name = 'zst'
+    extension = '.tar.zst'
+    content_type = 'application/zstd'
+    magic = '\x28\xb5\x2f\xfd'
+    default_level = 3
+
+    def available(self):
+        return _optional('zstandard') is not None
+
+    def compressor(self, fileobj, level=None, pool=None):
+        zstandard = _optional('zstandard')
+        return CompressedWriter(fileobj, zstandard.ZstdCompressor(
+            level=self.level(level), threads=-1
+        ).compressobj())
+
+    def decompressor(self, fileobj):
+        # decompressobj drops frames after the first one
+        return _FullReader(
+            _optional('zstandard').ZstdDecompressor().stream_reader(
+                fileobj, read_across_frames=True
+            )
+        )
+
+
+class Lz4Codec(Codec):
+    name = 'lz4'
+    extension = '.tar.lz4'
+    content_type = 'application/x-lz4'
+    magic = '\x04\x22\x4d\x18'
+    default_level = 0
+
+    def available(self):
+        return _optional('lz4.frame') is not None
+
+    def compressor(self, fileobj, level=None, pool=None):
+        c = _optional('lz4.frame').LZ4FrameCompressor(
+            compression_level=self.level(level)
+        )
+        return CompressedWriter(fileobj, c, c.begin())
+
+    def decompressor(self, fileobj):
+        return DecompressedReader(
+            fileobj, _optional('lz4.frame').LZ4FrameDecompressor
+        )
+
+
+CODECS = dict((c.name, c) for c in (
+    GzipCodec(), ParallelGzipCodec(), ZstdCodec(), Lz4Codec()
+))
+
+
+def get_codec(name):
+    '''Get codec by name.
+    :param name: One of CODECS keys
+    :type name: str
+    :retunrs: Codec
+    :rtype: Codec
+    :raises: ValueError if codec is unknown or its library isn't installed
+    '''
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError("Unknown codec: %s" % name)
+    if not codec.available():
+        raise ValueError("Library for codec %s isn't installed" % name)
+    return codec
+
+
+class _Peeked(object):
+    '''File object returning already consumed header before the rest.
+    '''
+
+    def __init__(self, fileobj, head):
+        self.fileobj = fileobj
+        self._head = head
+
+    def read(self, size=-1):
+        if not self._head:
+            return self.fileobj.read(size)
+        if size < 0:
+            data, self._head = self._head + self.fileobj.read(), ''
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+
+def detect_codec(head):
+    '''Find codec by the magic bytes at the beginning of compressed data.
+    :param head: First bytes of the data
+    :type head: str
+    :retunrs: Codec or None for uncompressed data
+    :rtype: Codec
+    '''
+    for name in ('gz', 'zst', 'lz4'):
+        if head.startswith(CODECS[name].magic):
+            return get_codec(name)
+    return None
+
+
+def decompressor(fileobj):
+    '''Detect compression of a stream and return its decompressed view.
+    :param fileobj: Object with read method
+    :type fileobj: file
+    :retunrs: File object with decompressed data
+    :rtype: file
+    '''
+    head = fileobj.read(4)
+    fileobj = _Peeked(fileobj, head)
+    codec = detect_codec(head)
+    if codec is None:
+        return fileobj
+    logger.debug("Detected %s compression" % codec.name)
+    return codec.decompressor(fileobj)
+
+
+def open_tar(fileobj):
+    '''Open compressed tar archive as a stream, detecting the codec.
+    :param fileobj: Object with read method
+    :type fileobj: file
+    :retunrs: Tar archive in stream mode
+    :rtype: tarfile.TarFile
+    '''
+    return tarfile.open(fileobj=decompressor(fileobj), mode='r|')
+
+
+def _walk(path, arcname):
+    yield path, arcname
+    if os.path.isdir(path) and not os.path.islink(path):
+        for entry in sorted(os.listdir(path)):
+            for item in _walk(
+                os.path.join(path, entry), os.path.join(arcname, entry)
+            ):
+                yield item
+
+
+def write_indexed_tar(
+    fileobj, path, arcname, codec, level=None, checkpoint_size=CHECKPOINT_SIZE
+):
+    '''Write compressed tar of path with a checkpoint before every member
+    starting checkpoint_size or more after the previous checkpoint. Single
+    member can then be decompressed out of a range of the archive.
+    :param fileobj: Object with write method
+    :type fileobj: file
+    :param path: File or directory to archive
+    :type path: str
+    :param arcname: Name of path in the archive
+    :type arcname: str
+    :param codec: Codec compressing the archive
+    :type codec: Codec
+    :param level: Compression level, codec's default if None
+    :type level: int
+    :param checkpoint_size: Minimum uncompressed bytes between checkpoints
+    :type checkpoint_size: int
+    :retunrs: Index with codec name and members mapping names of regular
+              files to offset and length of the compressed range holding
+              the file, skip of decompressed bytes before its data and size
+    :rtype: dict
+    '''
+    files = []
+    with CheckpointWriter(fileobj, codec, level) as out:
+        tar = tarfile.open(fileobj=out, mode='w')
+        try:
+            for filepath, name in _walk(path, arcname):
+                tarinfo = tar.gettarinfo(filepath, name)
+                if tarinfo is None:
+                    continue
+                if out.tell() - out.checkpoints[-1][0] >= checkpoint_size:
+                    out.checkpoint()
+                if not tarinfo.isreg():
+                    tar.addfile(tarinfo)
+                    continue
+                with open(filepath, 'rb') as f:
+                    tar.addfile(tarinfo, f)
+                # Data is padded to whole blocks right before the next member
+                blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+                files.append((
+                    tarinfo.name, out.tell() - blocks * tarfile.BLOCKSIZE,
+                    tarinfo.size
+                ))
+        finally:
+            tar.close()
+
+    starts = [offset for offset, compressed in out.checkpoints]
+    members = {}
+    for name, offset, size in files:
+        first = bisect.bisect_right(starts, offset) - 1
+        last = bisect.bisect_left(starts, offset + size)
+        begin = out.checkpoints[first][1]
+        if last < len(starts):
+            end = out.checkpoints[last][1]
+        else:
+            end = out.compressed_size
+        members[name] = {
+            'offset': begin,
+            'length': end - begin,
+            'skip': offset - starts[first],
+            'size': size,
+        }
+    return {'codec': codec.name, 'members': members}
+
+
+def read_member(data, entry):
+    '''Decompress member out of the range of indexed archive.
+    :param data: Compressed range given by offset and length of the entry
+    :type data: str
+    :param entry: Entry of the member in the index
+    :type entry: dict
+    :retunrs: Member data
+    :rtype: str
+    :raises: IOError if the range doesn't hold whole member
+    '''
+    f = decompressor(StringIO(data))
+    f.read(entry['skip'])
+    out = f.read(entry['size'])
+    if len(out) != entry['size']:
+        raise IOError("Range holds %s of %s bytes of the member" % (
+            len(out), entry['size']
+        ))
+    return out
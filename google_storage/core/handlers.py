@@ -6,16 +6,84 @@ import json
 import shutil
 import csv
 import logging
+import functools
+import mimetypes
+import cStringIO
 
 import distutils.dir_util as du
 
+from googleapiclient.errors import HttpError
+
 import google_storage.core.utils as g
+import google_storage.core.compression as compression
+
+from google_storage.core.aio import AsyncGSStorageHandler
+
+from google_storage.core.checksums import FAST_CRC32C
+from google_storage.core.checksums import checksum_field
+from google_storage.core.checksums import path_checksums
+
+from google_storage.core.cache import DownloadCache
+from google_storage.core.cache import CACHE_MAX_BYTES
 
 DATE_FOLDER_FORMAT = '%Y%m%d%H%M%S'
 
 logger = logging.getLogger()
 
 
+def instrumented(name):
+    '''Decorator timing Base method as operation name.
+    '''
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.operation(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def serialize(content, filename, fp):
+    '''Write content into fp as JSON or CSV by extension of filename.
+    :param content: Either list of items for csv or structure for json file
+    :type content: list or dict
+    :param filename: Name with .json or .csv extension
+    :type filename: str
+    :param fp: File object to write to
+    :type fp: file
+    :retunrs: False if the extension isn't supported
+    :rtype: bool
+    '''
+    base, ext = os.path.splitext(filename)
+    if ext == '.json':
+        json.dump(content, fp)
+    elif ext == '.csv':
+        csvw = csv.writer(fp)
+        csvw.writerows(content)
+    else:
+        return False
+    return True
+
+
+class UploadError(Exception):
+    '''Raised when some of the files in a batch failed to upload.
+    '''
+
+    def __init__(self, responses, errors):
+        '''Constructor
+        :param responses: Responses in input order, exceptions for failures
+        :type responses: list
+        :param errors: List of tuples (google_filepath, file, exception)
+        :type errors: list
+        '''
+        super(UploadError, self).__init__(
+            "%s of %s files failed to upload" % (len(errors), len(responses))
+        )
+        self.responses = responses
+        self.errors = errors
+
+
 class Base(object):
     '''
     Base class handling google storage logging and functionality
@@ -23,6 +91,17 @@ class Base(object):
 
     bucket = None
     mimetype = None
+    max_workers = 1
+    composite_threshold = None
+    sliced_threshold = None
+    cache_dir = None
+    cache_max_bytes = CACHE_MAX_BYTES
+    stream_archive = False
+    index_archive = False
+    codec = 'gz'
+    compression_level = None
+    max_concurrency = 16
+    metrics = None
 
     def __init__(
         self,
@@ -51,6 +130,9 @@ class Base(object):
             tmpdir = tempfile.mkdtemp("_%s" % self.__class__.__name__)
         self.tmpdir = tmpdir
         self.archived = archived
+        self._gs = None
+        self._cache = None
+        self._aio = None
 
     def __enter__(self):
         '''With operator handler
@@ -62,7 +144,80 @@ class Base(object):
         '''
         self.clean()
 
-    def download(self, files, bucket=None):
+    @property
+    def gs(self):
+        '''Storage handler shared by all instances using the same json key.
+        Created lazily on first access.
+        '''
+        if self._gs is None:
+            self._gs = g.registry.get(self.json_key_path)
+        return self._gs
+
+    def invalidate_gs(self):
+        '''Close the shared storage handler and drop it from the registry.
+        Next access to gs creates a new handler, which reuses the cached
+        access token.
+        '''
+        self._gs = None
+        g.registry.invalidate(self.json_key_path)
+
+    def operation(self, name, bucket=None):
+        '''Time a Base level call. Operations are named after the class,
+        e.g. Maps.store_gs, and go to metrics or to the handler's metrics if
+        it isn't set.
+        :param name: Name of the operation
+        :type name: str
+        :param bucket: Name of the bucket, class bucket if None
+        :type bucket: str
+        :retunrs: Operation, use as context manager
+        :rtype: google_storage.core.metrics.Operation
+        '''
+        metrics = self.metrics or self.gs.metrics
+        return metrics.operation(
+            '%s.%s' % (self.__class__.__name__, name), bucket or self.bucket
+        )
+
+    @property
+    def aio(self):
+        '''Non blocking handler sharing connection setup with gs. Created
+        lazily and closed by clean.
+        '''
+        if self._aio is None:
+            self._aio = AsyncGSStorageHandler(
+                max_concurrency=self.max_concurrency, handler=self.gs
+            )
+        return self._aio
+
+    @property
+    def cache(self):
+        '''Local download cache, None unless cache_dir is set.
+        '''
+        if self._cache is None and self.cache_dir:
+            self._cache = DownloadCache(self.cache_dir, self.cache_max_bytes)
+        return self._cache
+
+    def _fetch(self, bucket, fpath, f, details=None):
+        '''Download single object, through the cache if enabled.
+        '''
+        with self.operation('fetch', bucket):
+            if self.cache:
+                return self.cache.get(
+                    self.gs, bucket, fpath, f, details=details,
+                    sliced_threshold=self.sliced_threshold
+                )
+
+            if f is None:
+                f = tempfile.NamedTemporaryFile()
+
+            f = self.gs.download(
+                bucket, fpath, f, sliced_threshold=self.sliced_threshold
+            )
+            f.seek(0)
+            return f
+
+    def download(
+        self, files, bucket=None, prefetch=0, ordered=True, max_bytes=None
+    ):
         '''Generator containing downloaded files
         :param files: Lost of tuples where 1st el is a google storage filepath,
                       2nd is a tmp file or None. If file is non temp file will
@@ -70,45 +225,164 @@ class Base(object):
         :type files: list of tuples [(google_filepath, file_object)]
         :param bucket: Name of the bucket in google storage to access
         :type bucket: str
-        :retunrs: Generator with file objects
+        :param prefetch: Number of files downloaded ahead in background
+        :type prefetch: int
+        :param ordered: Yield files in input order, otherwise as downloaded.
+                        Used only with prefetch.
+        :type ordered: bool
+        :param max_bytes: Cap on bytes downloaded but not yet handed over.
+                          Used only with prefetch.
+        :type max_bytes: int
+        :retunrs: Generator with file objects. With cache_dir set and no
+                  file given files are read only and opened on the cache.
         :rtype: generator with file objects
         '''
         if not bucket:
             bucket = self.bucket
 
-        gs = g.GSStorageHandler(self.json_key_path)
-        for fpath, f in files:
-            if f is None:
-                f = tempfile.NamedTemporaryFile()
-
-            f = gs.download(bucket, fpath, f)
-            f.seek(0)
-            yield f
-
-    def upload(self, files, bucket=None, public=False):
+        if not prefetch:
+            for fpath, f in files:
+                yield self._fetch(bucket, fpath, f)
+            return
+
+        budget = g.ByteBudget(max_bytes) if max_bytes else None
+
+        def download_one(item):
+            ticket, (fpath, f) = item
+            size = 0
+            details = None
+            if budget:
+                try:
+                    details = self.gs.object_details(
+                        bucket, fpath, fields='size,generation'
+                    )
+                    size = int(details['size'])
+                finally:
+                    budget.acquire(size, ticket)
+
+            return self._fetch(bucket, fpath, f, details), size
+
+        results = g.prefetch_map(
+            download_one, enumerate(files), prefetch, ordered
+        )
+        size = 0
+        try:
+            while True:
+                if budget:
+                    budget.release(size)
+                try:
+                    f, size = next(results)
+                except StopIteration:
+                    return
+                yield f
+        finally:
+            if budget:
+                budget.close()
+            results.close()
+
+    def upload(
+        self, files, bucket=None, public=False, max_workers=None,
+        raise_errors=True, mimetype=None
+    ):
         '''Uploads files to a bucket in google storage.
         :param files: Lost of tuples where 1st el is a google storage filepath,
-                      2nd is a file to upload.
+                      2nd is a file to upload or a path to it. Paths are
+                      opened only while being uploaded.
         :type files: list of tuples [(google_filepath, file_object)]
         :param bucket: Name of the bucket in google storage to access
         :type bucket: str
         :param public: Flag if file exposed as public
         :type public: bool
-        :retunrs: List of responses from google_storage
-        :rtype: generator with file objects
+        :param max_workers: Number of concurrent uploads
+        :type max_workers: int
+        :param raise_errors: Raise UploadError once the whole batch is done
+                             if any file failed, otherwise failed entries
+                             hold the exception.
+        :type raise_errors: bool
+        :param mimetype: Overrides mimetype of the class
+        :type mimetype: str
+        :retunrs: List of responses from google_storage in input order
+        :rtype: list
         '''
-        r = []
         if not bucket:
             bucket = self.bucket
-
-        gs = g.GSStorageHandler(self.json_key_path)
-        for fpath, map_file in files:
-            f = gs.upload(
-                bucket, map_file, fpath, mimetype=self.mimetype, public=public
+        if not max_workers:
+            max_workers = self.max_workers
+        if not mimetype:
+            mimetype = self.mimetype
+
+        gs = self.gs
+
+        def upload_one(item):
+            fpath, map_file = item
+            if isinstance(map_file, basestring):
+                with open(map_file, 'rb') as f:
+                    return gs.upload(
+                        bucket, f, fpath, mimetype=mimetype, public=public,
+                        composite_threshold=self.composite_threshold
+                    )
+            return gs.upload(
+                bucket, map_file, fpath, mimetype=mimetype, public=public,
+                composite_threshold=self.composite_threshold
             )
-            r.append(f)
+
+        files = list(files)
+        r = []
+        errors = []
+        with self.operation('upload', bucket) as op:
+            results = g.thread_map(upload_one, files, max_workers)
+            for (fpath, map_file), (resp, error) in zip(files, results):
+                if error is not None:
+                    errors.append((fpath, map_file, error))
+                    resp = error
+                else:
+                    op.add_bytes(int(resp.get('size', 0)))
+                r.append(resp)
+            op.add_chunks(len(files))
+
+        if errors and raise_errors:
+            raise UploadError(r, errors)
         return r
 
+    def download_async(self, files, bucket=None):
+        '''Queue downloads without waiting for them.
+        :param files: Lost of tuples where 1st el is a google storage filepath,
+                      2nd is a tmp file or None.
+        :type files: list of tuples [(google_filepath, file_object)]
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: AsyncResults with file objects in input order
+        :rtype: list
+        '''
+        if not bucket:
+            bucket = self.bucket
+
+        return [
+            self.aio.submit(self._fetch, bucket, fpath, f)
+            for fpath, f in files
+        ]
+
+    def upload_async(self, files, bucket=None, public=False, mimetype=None):
+        '''Queue uploads without waiting for them.
+        :param files: Lost of tuples where 1st el is a google storage filepath,
+                      2nd is a file to upload or a path to it.
+        :type files: list of tuples [(google_filepath, file_object)]
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param public: Flag if file exposed as public
+        :type public: bool
+        :param mimetype: Overrides mimetype of the class
+        :type mimetype: str
+        :retunrs: AsyncResults with responses in input order
+        :rtype: list
+        '''
+        def upload_one(item):
+            return self.upload(
+                [item], bucket, public, max_workers=1, mimetype=mimetype
+            )[0]
+
+        return [self.aio.submit(upload_one, item) for item in files]
+
     def store_local(
         self, content, filename
     ):
@@ -128,12 +402,91 @@ class Base(object):
                 os.makedirs(path)
 
         with open(os.path.join(path, filename), 'w') as fp:
-            base, ext = os.path.splitext(filename)
-            if ext == '.json':
-                json.dump(content, fp)
-            elif ext == '.csv':
-                csvw = csv.writer(fp)
-                csvw.writerows(content)
+            serialize(content, filename, fp)
+
+    @instrumented('put_object')
+    def put_object(
+        self, name, content, location=None, bucket=None, public=False,
+        mimetype=None
+    ):
+        '''Upload content straight from memory, it's never written to
+        tmpdir. Content of .json and .csv names is serialized as by
+        store_local, bytes and buffers are uploaded as they are.
+        :param name: Name of the object under location
+        :type name: str
+        :param content: Structure for json, list of rows for csv or bytes
+        :type content: list or dict or str
+        :param location: location in google storage, get_location() if None
+        :type location: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param public: Flag if file exposed as public
+        :type public: bool
+        :param mimetype: Overrides mimetype of the class
+        :type mimetype: str
+        :retunrs: Response from google_storage
+        :rtype: json
+        '''
+        if not location:
+            location = self.get_location()
+        if not bucket:
+            bucket = self.bucket
+        if not mimetype:
+            mimetype = self.mimetype or mimetypes.guess_type(name)[0]
+
+        raw = (basestring, bytearray, memoryview, buffer)
+        if not isinstance(content, raw):
+            fp = cStringIO.StringIO()
+            if not serialize(content, name, fp):
+                raise ValueError(
+                    "Can't serialize %s, use .json or .csv name" % name
+                )
+            content = fp.getvalue()
+
+        return self.gs.upload_data(
+            bucket, content, os.path.join(location, name), mimetype=mimetype,
+            public=public
+        )
+
+    @instrumented('get_object')
+    def get_object(self, name, location=None, bucket=None, buf=None):
+        '''Download object into memory, it's never written to tmpdir.
+        :param name: Name of the object under location
+        :type name: str
+        :param location: location in google storage, get_location() if None
+        :type location: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param buf: Writable buffer to download into, see download_into
+        :type buf: bytearray
+        :retunrs: Memoryview of the object data
+        :rtype: memoryview
+        '''
+        if not location:
+            location = self.get_location()
+        if not bucket:
+            bucket = self.bucket
+        return self.gs.download_into(
+            bucket, os.path.join(location, name), buf
+        )
+
+    def open_object(self, name, location=None, bucket=None):
+        '''Open object for reading without downloading it, see GSStorageHandler
+        open.
+        :param name: Name of the object under location
+        :type name: str
+        :param location: location in google storage, get_location() if None
+        :type location: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: Read-only seekable file object
+        :rtype: google_storage.core.streams.ObjectReader
+        '''
+        if not location:
+            location = self.get_location()
+        if not bucket:
+            bucket = self.bucket
+        return self.gs.open(bucket, os.path.join(location, name))
 
     def copy_into(self, src_path):
         '''Copy contents of the src_path location to temp folder
@@ -149,17 +502,240 @@ class Base(object):
                 os.makedirs(path)
         du.copy_tree(src_path, path)
 
-    def make_tar(self):
-        '''Tar up content of the temporary location.
+    def archive_path(self):
+        '''Path of the folder archived when archived flag is set.
         '''
-        path = os.path.join(
+        return os.path.join(
             self.tmpdir, self.date.strftime(DATE_FOLDER_FORMAT)
         )
-        with tarfile.open("%s.tar.gz" % path, "w:gz") as tar:
-            tar.add(path, arcname=os.path.basename(path))
+
+    def archive_name(self):
+        '''Name of the archive file, extension reflects the codec.
+        '''
+        return "%s%s" % (
+            os.path.basename(self.archive_path()),
+            compression.get_codec(self.codec).extension
+        )
+
+    def index_name(self):
+        '''Name of the archive's member index.
+        '''
+        return self.archive_name() + compression.INDEX_EXTENSION
+
+    def write_tar(self, fileobj):
+        '''Write compressed tar of the archived folder as a stream.
+        :param fileobj: Object with write method
+        :type fileobj: file
+        :retunrs: Index of members when index_archive is set, else None
+        :rtype: dict
+        '''
+        path = self.archive_path()
+        codec = compression.get_codec(self.codec)
+        if self.index_archive:
+            return compression.write_indexed_tar(
+                fileobj, path, os.path.basename(path), codec,
+                self.compression_level
+            )
+        with codec.compressor(fileobj, self.compression_level) as out:
+            with tarfile.open(fileobj=out, mode="w|") as tar:
+                tar.add(path, arcname=os.path.basename(path))
+
+    def make_tar(self):
+        '''Tar up content of the temporary location.
+        '''
+        path = self.archive_path()
+        with open(os.path.join(self.tmpdir, self.archive_name()), 'wb') as f:
+            index = self.write_tar(f)
+        index_path = os.path.join(self.tmpdir, self.index_name())
+        if index is not None:
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+        elif os.path.exists(index_path):
+            os.remove(index_path)
 
         shutil.rmtree(path)
 
+    def find_archive(self, location=None, bucket=None):
+        '''Find archived snapshot in google storage whatever codec it was
+        written with.
+        :param location: location in google storage
+        :type files: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: Name of the archive object
+        :rtype: str
+        :raises: IOError if there is no archive
+        '''
+        return self._archive_object(location, bucket)['name']
+
+    def _archive_object(self, location=None, bucket=None, fields='name'):
+        if not location:
+            location = self.get_location()
+        if not bucket:
+            bucket = self.bucket
+
+        prefix = os.path.join(
+            location, "%s.tar" % os.path.basename(self.archive_path())
+        )
+        for o in self.gs.iter_bucket_content(
+            bucket, prefix=prefix, fields=fields, prefetch=False
+        ):
+            if not o['name'].endswith(compression.INDEX_EXTENSION):
+                return o
+        raise IOError("No archive %s* in %s" % (prefix, bucket))
+
+    def download_archive(self, location=None, bucket=None):
+        '''Download archived snapshot and open it. Decompressor is picked
+        from the content.
+        :param location: location in google storage
+        :type files: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: Tar archive in stream mode
+        :rtype: tarfile.TarFile
+        '''
+        name = self.find_archive(location, bucket)
+        f = next(self.download([(name, None)], bucket))
+        return compression.open_tar(f)
+
+    @instrumented('restore')
+    def restore(self, path=None, location=None, bucket=None, members=None):
+        '''Extract archived snapshot while it's being downloaded. Archive is
+        never written to disk, ranges are fetched in a background thread
+        and extracted as they arrive. Members and links pointing outside of
+        path are skipped.
+        :param path: Directory to extract into, tmpdir if None which puts
+                     the snapshot back to archive_path()
+        :type path: str
+        :param location: location in google storage
+        :type files: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param members: Filter called with every tarfile.TarInfo, only
+                        members it returns True for are extracted.
+        :type members: callable
+        :returns: Names of extracted members
+        :rtype: list
+        '''
+        if not path:
+            path = self.tmpdir
+        if not bucket:
+            bucket = self.bucket
+        name = self.find_archive(location, bucket)
+        root = os.path.realpath(path)
+
+        def copy(pipe):
+            f = self.gs.open(bucket, name)
+            try:
+                shutil.copyfileobj(f, pipe, g.READ_CHUNKSIZE)
+            finally:
+                f.close()
+
+        from google_storage.core.streams import pipe_from
+        pipe = pipe_from(copy)
+        extracted = []
+        try:
+            tar = compression.open_tar(pipe)
+            for member in tar:
+                if members is not None and not members(member):
+                    continue
+                targets = [os.path.join(root, member.name)]
+                if member.issym():
+                    targets.append(os.path.join(
+                        root, os.path.dirname(member.name), member.linkname
+                    ))
+                elif member.islnk():
+                    targets.append(os.path.join(root, member.linkname))
+                if not all(
+                    os.path.realpath(t).startswith(os.path.join(root, ''))
+                    for t in targets
+                ):
+                    logger.warning("Skipping %s outside of %s" % (
+                        member.name, path
+                    ))
+                    continue
+                tar.extract(member, path)
+                extracted.append(member.name)
+        finally:
+            pipe.close()
+        return extracted
+
+    def archive_index(self, name, bucket=None):
+        '''Member index uploaded with the archive.
+        :param name: Name of the archive object
+        :type name: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: Index, None if archive was stored without it
+        :rtype: dict
+        '''
+        if not bucket:
+            bucket = self.bucket
+        try:
+            data = self.gs.download_into(
+                bucket, name + compression.INDEX_EXTENSION
+            )
+        except HttpError, e:
+            if e.resp.status == 404:
+                return None
+            raise
+        return json.loads(data.tobytes())
+
+    @instrumented('read_archived')
+    def read_archived(self, filename, location=None, bucket=None):
+        '''Read single file of archived snapshot. With member index only the
+        range of the archive holding the file is downloaded. Archives
+        without index or overwritten since it was written are streamed
+        until the file is found.
+        :param filename: Path of the file relative to the archived folder,
+                         as stored by store_local
+        :type filename: str
+        :param location: location in google storage
+        :type files: str
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :retunrs: Content of the file
+        :rtype: str
+        :raises: KeyError if there is no such file in the archive
+        '''
+        if not bucket:
+            bucket = self.bucket
+        archive = self._archive_object(location, bucket, 'name,generation')
+        name = archive['name']
+        member = os.path.join(os.path.basename(self.archive_path()), filename)
+
+        index = self.archive_index(name, bucket)
+        if index is not None and (
+            index.get('generation') != archive['generation']
+        ):
+            logger.warning("Index of %s is stale" % name)
+            index = None
+        if index is not None:
+            entry = index['members'].get(member)
+            if entry is None:
+                raise KeyError("No %s in %s" % (member, name))
+            try:
+                data = self.gs.download_range(
+                    bucket, name, entry['offset'], entry['length'],
+                    generation=index['generation']
+                )
+            except HttpError, e:
+                if e.resp.status != 404:
+                    raise
+                logger.warning("Index of %s is stale" % name)
+            else:
+                return compression.read_member(data, entry)
+
+        f = self.gs.open(bucket, name)
+        try:
+            tar = compression.open_tar(f)
+            for tarinfo in tar:
+                if tarinfo.name == member and tarinfo.isreg():
+                    return tar.extractfile(tarinfo).read()
+        finally:
+            f.close()
+        raise KeyError("No %s in %s" % (member, name))
+
     def get_location(self):
         '''Method returning path in google storage. Defined in order to provide
         ability to override in children.
@@ -168,27 +744,224 @@ class Base(object):
             self.sitename, self.date.strftime(DATE_FOLDER_FORMAT)
         )
 
-    def store_gs(self, location=None):
+    @instrumented('store_gs')
+    def store_gs(
+        self, location=None, max_workers=None, stream=None, sync=False,
+        delete=False
+    ):
         '''Store contents of the tmpdir in google storage.
         :param location: location in google storage
         :type files: str
+        :param max_workers: Number of concurrent uploads
+        :type max_workers: int
+        :param stream: Stream the archive straight into the upload instead of
+                       writing it to tmpdir first. Defaults to stream_archive.
+        :type stream: bool
+        :param sync: Upload only files which differ from those already in the
+                     location, see sync_gs.
+        :type sync: bool
+        :param delete: With sync remove files missing locally from location.
+        :type delete: bool
+        :retunrs: Sync summary when sync is set
+        :rtype: dict
         '''
 
         if not location:
             location = self.get_location()
-
-        if self.archived:
+        if sync:
+            return self.sync_gs(location, delete, max_workers)
+        if stream is None:
+            stream = self.stream_archive
+
+        if self.archived and stream:
+            self.store_gs_stream(location)
+        elif self.archived:
             self.make_tar()
+            self.upload_archive(location)
 
+        skip = (
+            os.path.basename(self.archive_path()), self.archive_name(),
+            self.index_name()
+        )
         fmap = [
-            (location, open(os.path.join(self.tmpdir, fpath), 'r'))
+            (location, os.path.join(self.tmpdir, fpath))
             for fpath in os.listdir(self.tmpdir)
+            if fpath not in skip
         ]
-        self.upload(fmap)
+        self.upload(fmap, max_workers=max_workers)
+
+    def upload_archive(self, location):
+        '''Upload archive created by make_tar with codec's content type.
+        :param location: location in google storage
+        :type files: str
+        :retunrs: Response from google_storage
+        :rtype: json
+        '''
+        resp = self.upload(
+            [(location, os.path.join(self.tmpdir, self.archive_name()))],
+            mimetype=compression.get_codec(self.codec).content_type
+        )[0]
+        path = os.path.join(self.tmpdir, self.index_name())
+        if os.path.exists(path):
+            with open(path) as f:
+                self.upload_index(location, json.load(f), resp)
+        return resp
+
+    def upload_index(self, location, index, archive):
+        '''Upload member index of the archive. Index refers to the uploaded
+        generation, it's ignored once the archive is overwritten.
+        :param location: location in google storage
+        :type files: str
+        :param index: Index returned by write_tar
+        :type index: dict
+        :param archive: Response of the archive upload
+        :type archive: json
+        :retunrs: Response from google_storage
+        :rtype: json
+        '''
+        index = dict(index, generation=archive['generation'])
+        return self.gs.upload_data(
+            self.bucket, json.dumps(index),
+            os.path.join(location, self.index_name()), 'application/json'
+        )
+
+    @instrumented('sync_gs')
+    def sync_gs(self, location=None, delete=False, max_workers=None):
+        '''Upload only new or changed files of the tmpdir. Location is listed
+        once and files are compared by size and MD5 (CRC32C for composite
+        objects).
+        :param location: location in google storage
+        :type files: str
+        :param delete: Remove files from location which are missing locally.
+        :type delete: bool
+        :param max_workers: Number of concurrent uploads
+        :type max_workers: int
+        :retunrs: Names of uploaded, skipped and deleted objects and number
+                  of bytes not sent.
+        :rtype: dict
+        '''
+
+        if not location:
+            location = self.get_location()
+        if self.archived:
+            self.make_tar()
+
+        remote = dict(
+            (o['name'], o) for o in self.gs.iter_bucket_content(
+                self.bucket, prefix=location.rstrip('/') + '/',
+                delimiter='/', fields='name,size,md5Hash,crc32c'
+            )
+        )
+
+        # Index is uploaded along with the archive by upload_archive
+        skip = self.index_name() if self.archived else None
+        if skip:
+            remote.pop(os.path.join(location, skip), None)
+
+        summary = {
+            'uploaded': [], 'skipped': [], 'deleted': [], 'skipped_bytes': 0
+        }
+        fmap = []
+        for fpath in sorted(os.listdir(self.tmpdir)):
+            if fpath == skip:
+                continue
+            path = os.path.join(self.tmpdir, fpath)
+            name = os.path.join(location, fpath)
+            if self._unchanged(path, remote.pop(name, None)):
+                summary['skipped'].append(name)
+                summary['skipped_bytes'] += os.path.getsize(path)
+            elif self.archived and fpath == self.archive_name():
+                summary['uploaded'].append(name)
+                self.upload_archive(location)
+            else:
+                summary['uploaded'].append(name)
+                fmap.append((location, path))
+
+        self.upload(fmap, max_workers=max_workers)
+
+        if delete and remote:
+            summary['deleted'] = sorted(remote)
+            self.gs.delete_objects(self.bucket, summary['deleted'])
+
+        logger.info(
+            "Synced %s: uploaded %s, skipped %s (%s bytes), deleted %s" % (
+                location, len(summary['uploaded']), len(summary['skipped']),
+                summary['skipped_bytes'], len(summary['deleted'])
+            )
+        )
+        return summary
+
+    def _unchanged(self, path, remote):
+        '''Check if local file is the same as the remote object.
+        '''
+        if remote is None or int(remote['size']) != os.path.getsize(path):
+            return False
+
+        field = checksum_field(remote)
+        if field is None or (field == 'crc32c' and not FAST_CRC32C):
+            # Without crcmod's C extension uploading again is cheaper
+            return False
+        return remote[field] == path_checksums(path, (field,))[field]
+
+    @instrumented('store_gs_stream')
+    def store_gs_stream(self, location):
+        '''Compress archived folder and upload it as it's being compressed.
+        Archive is never written to disk.
+        :param location: location in google storage
+        :type files: str
+        :retunrs: Response from google_storage
+        :rtype: json
+        '''
+        name = os.path.join(location, self.archive_name())
+        mimetype = compression.get_codec(self.codec).content_type
+
+        from google_storage.core.streams import pipe_from
+        index = []
+        pipe = pipe_from(lambda f: index.append(self.write_tar(f)))
+        try:
+            resp = self.gs.upload_stream(
+                self.bucket, pipe, name, mimetype=mimetype
+            )
+        finally:
+            pipe.close()
+        if index[0] is not None:
+            self.upload_index(location, index[0], resp)
+        return resp
+
+    @instrumented('copy_to')
+    def copy_to(
+        self, other, location=None, dest_location=None, max_workers=8
+    ):
+        '''Copy content of the location in google storage into bucket of
+        other handler class. Objects are copied by google storage, data never
+        passes through this machine.
+        :param other: Base class or instance whose bucket receives the copy
+        :type other: type
+        :param location: location in google storage, get_location() if None
+        :type location: str
+        :param dest_location: location in other's bucket, same as location
+                              if None
+        :type dest_location: str
+        :param max_workers: Number of concurrent copies
+        :type max_workers: int
+        :retunrs: Resources of the copies keyed by source name
+        :rtype: dict
+        '''
+        if not location:
+            location = self.get_location()
+        if not dest_location:
+            dest_location = location
+        return self.gs.copy_prefix(
+            self.bucket, os.path.join(location, ''), other.bucket,
+            os.path.join(dest_location, ''), max_workers
+        )
 
     def clean(self):
         '''Remove temporary location.
         '''
+        if self._aio is not None:
+            self._aio.close()
+            self._aio = None
         logger.info("Removing temp folder: %s" % self.tmpdir)
         if os.path.exists(self.tmpdir):
             shutil.rmtree(self.tmpdir)
@@ -0,0 +1,225 @@
+import math
+import time
+import random
+import threading
+
+from collections import defaultdict
+
+from googleapiclient.errors import HttpError
+
+MAX_SAMPLES = 10000
+PERCENTILES = (50, 95, 99)
+
+
+class NullOperation(object):
+    '''Operation of disabled instrumentation, every call is a no-op.
+    '''
+
+    def add_bytes(self, size):
+        pass
+
+    def add_chunks(self, count=1):
+        pass
+
+    def retry(self, error):
+        pass
+
+    def status(self, code):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NULL_OPERATION = NullOperation()
+
+
+class Operation(object):
+    '''Single timed storage call. Counters may be updated from worker
+    threads of the call.
+    '''
+
+    def __init__(self, metrics, name, bucket=None):
+        '''Constructor
+        :param metrics: Metrics receiving the operation once finished
+        :type metrics: Metrics
+        :param name: Name of the operation
+        :type name: str
+        :param bucket: Name of the bucket
+        :type bucket: str
+        '''
+        self.metrics = metrics
+        self.name = name
+        self.bucket = bucket
+        self.bytes = 0
+        self.chunks = 0
+        self.retries = 0
+        self.statuses = defaultdict(int)
+        self.error = None
+        self.seconds = None
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.bytes += size
+
+    def add_chunks(self, count=1):
+        with self._lock:
+            self.chunks += count
+
+    def retry(self, error):
+        with self._lock:
+            self.retries += 1
+
+    def status(self, code):
+        with self._lock:
+            self.statuses[code] += 1
+
+    def finish(self, error=None):
+        '''Stop the clock and hand the operation over to metrics.
+        '''
+        if self.seconds is not None:
+            return
+        self.seconds = time.time() - self._start
+        self.error = error
+        if isinstance(error, HttpError) and not self.statuses:
+            self.status(error.resp.status)
+        self.metrics.record(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.finish(value)
+        return False
+
+
+class Metrics(object):
+    '''Instrumentation interface of storage calls. This base class is
+    disabled and costs nothing, subclasses set enabled and override record
+    to receive every finished Operation.
+    '''
+    enabled = False
+
+    def operation(self, name, bucket=None):
+        '''Start timing an operation.
+        :param name: Name of the operation
+        :type name: str
+        :param bucket: Name of the bucket
+        :type bucket: str
+        :retunrs: Operation, use as context manager or call finish
+        :rtype: Operation
+        '''
+        if not self.enabled:
+            return NULL_OPERATION
+        return Operation(self, name, bucket)
+
+    def record(self, operation):
+        '''Called with every finished operation.
+        :param operation: Finished operation
+        :type operation: Operation
+        '''
+        pass
+
+
+NULL_METRICS = Metrics()
+
+
+def percentile(samples, p):
+    '''Nearest rank percentile of sorted samples.
+    '''
+    if not samples:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.statuses = defaultdict(int)
+        self.samples = []
+
+
+class InMemoryMetrics(Metrics):
+    '''Aggregates operations in memory per operation name and bucket.
+    Latency percentiles are computed from a uniform sample of at most
+    max_samples operations per key.
+    '''
+    enabled = True
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        '''Constructor
+        :param max_samples: Latencies kept per operation and bucket
+        :type max_samples: int
+        '''
+        self.max_samples = max_samples
+        self._stats = defaultdict(_Stats)
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def record(self, operation):
+        with self._lock:
+            stats = self._stats[(operation.name, operation.bucket)]
+            stats.count += 1
+            stats.errors += operation.error is not None
+            stats.retries += operation.retries
+            stats.bytes += operation.bytes
+            stats.chunks += operation.chunks
+            stats.seconds += operation.seconds
+            stats.max = max(stats.max, operation.seconds)
+            for code, count in operation.statuses.iteritems():
+                stats.statuses[code] += count
+            if len(stats.samples) < self.max_samples:
+                stats.samples.append(operation.seconds)
+            else:
+                i = self._random.randint(0, stats.count - 1)
+                if i < self.max_samples:
+                    stats.samples[i] = operation.seconds
+
+    def summary(self):
+        '''Aggregated metrics.
+        :retunrs: One dict per operation and bucket with count, errors,
+                  retries, bytes, chunks, status counts, mean, max and
+                  p50/p95/p99 latency in seconds.
+        :rtype: list
+        '''
+        out = []
+        with self._lock:
+            items = sorted(self._stats.items())
+            for (name, bucket), stats in items:
+                samples = sorted(stats.samples)
+                row = {
+                    'operation': name,
+                    'bucket': bucket,
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'bytes': stats.bytes,
+                    'chunks': stats.chunks,
+                    'statuses': dict(stats.statuses),
+                    'mean': stats.seconds / stats.count,
+                    'max': stats.max,
+                }
+                for p in PERCENTILES:
+                    row['p%d' % p] = percentile(samples, p)
+                out.append(row)
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,259 @@
+import sys
+import time
+import random
+import socket
+import httplib
+import logging
+import threading
+
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+
+import httplib2
+
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger(__name__)
+
+NUM_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_ERRORS = (
+    socket.error, httplib.HTTPException, httplib2.HttpLib2Error
+)
+
+
+class RetryBudget(object):
+    '''Token bucket limiting retries of all threads. Every retry takes a
+    token, every successful request gives back ratio of one and tokens also
+    refill at min_per_second. When the service browns out and most requests
+    fail, retries stop instead of multiplying the load.
+    '''
+
+    def __init__(self, ratio=0.2, min_per_second=10.0, capacity=100.0):
+        '''Constructor
+        :param ratio: Retries allowed per successful request
+        :type ratio: float
+        :param min_per_second: Retries always allowed per second
+        :type min_per_second: float
+        :param capacity: Maximum number of saved up retries
+        :type capacity: float
+        '''
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens):
+        now = time.time()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + tokens + (now - self._last) * self.min_per_second
+        )
+        self._last = now
+
+    def deposit(self):
+        '''Record successful request.
+        '''
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        '''Take token for a retry.
+        :retunrs: False if budget is exhausted and retry shouldn't be made
+        :rtype: bool
+        '''
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+RETRY_BUDGET = RetryBudget()
+
+
+def retry_after(error):
+    '''Seconds the server asked to wait in Retry-After header.
+    :param error: Failed request error
+    :type error: Exception
+    :retunrs: Seconds or None if not given
+    :rtype: float
+    '''
+    if not isinstance(error, HttpError):
+        return None
+    value = error.resp.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+    '''Decides which failures are retried and how long to wait. Waits use
+    decorrelated jitter, so concurrent workers don't retry in sync, and are
+    never shorter than Retry-After sent by the server.
+    '''
+
+    def __init__(
+        self, max_retries=NUM_RETRIES, base_delay=BASE_DELAY,
+        max_delay=MAX_DELAY, deadline=None, deadlines=None,
+        budget=RETRY_BUDGET, statuses=RETRYABLE_STATUSES,
+        errors=RETRYABLE_ERRORS, sleep=None
+    ):
+        '''Constructor
+        :param max_retries: Retries in a row without progress before giving
+                            up
+        :type max_retries: int
+        :param base_delay: Shortest wait in seconds
+        :type base_delay: float
+        :param max_delay: Longest wait in seconds unless server asks more
+        :type max_delay: float
+        :param deadline: Seconds after which operation isn't retried anymore
+        :type deadline: float
+        :param deadlines: Deadlines overriding deadline by operation name
+        :type deadlines: dict
+        :param budget: Budget shared with other policies, None for unlimited
+        :type budget: RetryBudget
+        :param statuses: Retryable HTTP statuses
+        :type statuses: tuple
+        :param errors: Retryable connection errors
+        :type errors: tuple
+        :param sleep: Function used for waiting, time.sleep if None
+        :type sleep: callable
+        '''
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+        self.budget = budget
+        self.statuses = statuses
+        self.errors = errors
+        self.sleep = sleep
+        self._random = random.Random()
+
+    def is_retryable(self, error):
+        '''Classify failure.
+        :param error: Exception raised by the request
+        :type error: Exception
+        :retunrs: True for throttling, server and connection errors
+        :rtype: bool
+        '''
+        if isinstance(error, HttpError):
+            return error.resp.status in self.statuses
+        return isinstance(error, self.errors)
+
+    def next_delay(self, previous):
+        '''Decorrelated jitter wait following previous wait.
+        '''
+        return min(self.max_delay, self._random.uniform(
+            self.base_delay, max(self.base_delay, previous * 3)
+        ))
+
+    def start(self, name=None, on_retry=None):
+        '''Start retrying single operation.
+        :param name: Operation name looked up in deadlines
+        :type name: str
+        :param on_retry: Called with the error before every retry
+        :type on_retry: callable
+        :retunrs: Retry state of the operation
+        :rtype: Retrying
+        '''
+        deadline = self.deadlines.get(name, self.deadline)
+        return Retrying(self, name, deadline, on_retry)
+
+    def call(self, func, *args, **kwargs):
+        '''Call func retrying its retryable failures.
+        '''
+        retrying = self.start(getattr(func, '__name__', None))
+        while True:
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                retrying.failed(e)
+                continue
+            retrying.succeeded()
+            return result
+
+
+class Retrying(object):
+    '''Retry state of a single operation.
+    '''
+
+    def __init__(self, policy, name=None, deadline=None, on_retry=None):
+        self.policy = policy
+        self.name = name
+        self.on_retry = on_retry
+        self.retries = 0
+        self.delay = 0
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = time.time() + deadline
+
+    def succeeded(self):
+        '''Record progress, retries in a row start again from zero.
+        '''
+        self.retries = 0
+        self.delay = 0
+        if self.policy.budget is not None:
+            self.policy.budget.deposit()
+
+    def failed(self, error):
+        '''Wait before retrying or raise error if it shouldn't be retried.
+        :param error: Exception raised by the request
+        :type error: Exception
+        :raises: error if it isn't retryable, retries are exhausted,
+                 deadline would pass or retry budget is spent
+        '''
+        policy = self.policy
+        if not policy.is_retryable(error):
+            _reraise(error)
+        if self.retries >= policy.max_retries:
+            logger.info(
+                'Failed to make progress for too many consecutive '
+                'iterations.'
+            )
+            _reraise(error)
+
+        self.delay = policy.next_delay(self.delay)
+        delay = max(self.delay, retry_after(error) or 0)
+        if self.deadline is not None and time.time() + delay > self.deadline:
+            logger.info("Deadline of %s passed, not retrying" % self.name)
+            _reraise(error)
+        if policy.budget is not None and not policy.budget.withdraw():
+            logger.warning("Retry budget exhausted, not retrying %s" % (
+                self.name
+            ))
+            _reraise(error)
+
+        self.retries += 1
+        if self.on_retry:
+            self.on_retry(error)
+        logger.info(
+            'Caught exception (%s). Sleeping for %s seconds before retry #%d.'
+            % (str(error), delay, self.retries)
+        )
+        (policy.sleep or time.sleep)(delay)
+
+
+def _reraise(error):
+    '''Raise error keeping its traceback if it's being handled.
+    '''
+    exc_type, exc, tb = sys.exc_info()
+    if exc is error:
+        raise exc_type, exc, tb
+    raise error
+
+
+DEFAULT_POLICY = RetryPolicy()
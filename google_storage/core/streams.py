@@ -0,0 +1,383 @@
+import io
+import os
+import Queue
+import itertools
+import threading
+import logging
+
+from cStringIO import StringIO
+from collections import OrderedDict
+
+from googleapiclient.http import MediaUpload
+
+logger = logging.getLogger(__name__)
+
+PIPE_BLOCKS = 64
+
+
+class PipeClosed(IOError):
+    '''Raised on write when reading end of the pipe has been closed.
+    '''
+
+
+class Pipe(object):
+    '''Bounded in-memory pipe between a writing and a reading thread. Writer
+    blocks when PIPE_BLOCKS writes are waiting to be read.
+    '''
+
+    def __init__(self, blocks=PIPE_BLOCKS):
+        '''Constructor
+        :param blocks: Maximum number of pending writes
+        :type blocks: int
+        '''
+        self._queue = Queue.Queue(blocks)
+        self._buffer = ''
+        self._eof = False
+        self._closed = False
+
+    def write(self, data):
+        '''Writing end. Blocks while the pipe is full.
+        '''
+        if not data:
+            return
+        while True:
+            if self._closed:
+                raise PipeClosed("Reading end of the pipe closed")
+            try:
+                self._queue.put((data, None), timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def close_write(self, error=None):
+        '''Signal end of data to the reader. If error is given reader will
+        raise it instead of reaching end of file.
+        '''
+        while not self._closed:
+            try:
+                self._queue.put(('', error), timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def read(self, size=-1):
+        '''Reading end. Blocks until size bytes or end of data.
+        '''
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while not self._eof and (size < 0 or length < size):
+            data, error = self._queue.get()
+            if error is not None:
+                raise error
+            if not data:
+                self._eof = True
+                break
+            parts.append(data)
+            length += len(data)
+
+        data = ''.join(parts)
+        if size < 0:
+            size = length
+        data, self._buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        '''Close reading end, unblocks and fails the writer.
+        '''
+        self._closed = True
+
+
+def pipe_from(write, blocks=PIPE_BLOCKS):
+    '''Run write(fileobj) in a background thread and return a pipe reading
+    what it writes.
+    :param write: Callable writing data into the file object it receives
+    :type write: callable
+    :param blocks: Maximum number of pending writes
+    :type blocks: int
+    :retunrs: Reading end
+    :rtype: Pipe
+    '''
+    pipe = Pipe(blocks)
+
+    def run():
+        try:
+            write(pipe)
+        except PipeClosed:
+            return
+        except Exception, e:
+            logger.warning("Writer thread failed: %s" % e)
+            pipe.close_write(e)
+            return
+        pipe.close_write()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return pipe
+
+
+class StreamMediaUpload(MediaUpload):
+    '''Resumable media of unknown size read once from a non seekable stream.
+    Keeps only the chunk which may have to be resent plus one chunk of look
+    ahead, so the last chunk can be sent with the total size.
+    '''
+
+    def __init__(self, stream, mimetype, chunksize):
+        '''Constructor
+        :param stream: Object with read(size) method
+        :type stream: file
+        :param mimetype: Mime-type of the data
+        :type mimetype: str
+        :param chunksize: Size of the chunk, multiple of 256KB
+        :type chunksize: int
+        '''
+        super(StreamMediaUpload, self).__init__()
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = ''
+        self._buffer_start = 0
+        self._next = 0
+        self._size = None
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def _fill(self, end):
+        while self._size is None and (
+            self._buffer_start + len(self._buffer) < end
+        ):
+            data = self._stream.read(self._chunksize)
+            if not data:
+                self._size = self._buffer_start + len(self._buffer)
+                break
+            self._buffer += data
+
+    def size(self):
+        '''Total size, known once the end of the stream is within the next
+        chunk.
+        '''
+        self._fill(self._next + self._chunksize + 1)
+        return self._size
+
+    def getbytes(self, begin, length):
+        if begin < self._buffer_start:
+            raise IOError(
+                "Can't rewind stream to %s, data from %s is kept" % (
+                    begin, self._buffer_start
+                )
+            )
+        self._buffer = self._buffer[begin - self._buffer_start:]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        data = self._buffer[:length]
+        self._next = begin + len(data)
+        return data
+
+
+class BufferMediaUpload(MediaUpload):
+    '''Media of data already in memory: str, bytearray, memoryview, mmap or
+    anything else supporting the buffer interface. Chunks sent are views of
+    the data, it's never copied.
+    '''
+
+    def __init__(self, data, mimetype, chunksize, resumable):
+        '''Constructor
+        :param data: Bytes to upload
+        :type data: buffer
+        :param mimetype: Mime-type of the data
+        :type mimetype: str
+        :param chunksize: Size of the chunk, multiple of 256KB
+        :type chunksize: int
+        :param resumable: Upload in chunks
+        :type resumable: bool
+        '''
+        super(BufferMediaUpload, self).__init__()
+        if not isinstance(data, (memoryview, buffer)):
+            data = buffer(data)
+        self._data = data
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._resumable = resumable
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return len(self._data)
+
+    def resumable(self):
+        return self._resumable
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if isinstance(self._data, memoryview):
+            return self._data[begin:begin + length]
+        return buffer(self._data, begin, length)
+
+
+class ObjectReader(io.BufferedIOBase):
+    '''Read-only seekable file of an object fetched in ranges on demand.
+    A miss right after the previous range doubles the number of chunks
+    fetched ahead up to readahead, any other miss fetches a single chunk.
+    Recently used chunks are kept in LRU for reads going back, so memory is
+    bounded by chunksize * (readahead chunks + cache_chunks). The chunks
+    are the read buffer, lines are split by cStringIO when iterating.
+    '''
+
+    def __init__(self, fetch, size, name, chunksize, readahead, cache_chunks):
+        '''Constructor
+        :param fetch: Called with offset and length, returns bytes of range
+        :type fetch: callable
+        :param size: Size of the object
+        :type size: int
+        :param name: Name of the file
+        :type name: str
+        :param chunksize: Size of the cached chunk
+        :type chunksize: int
+        :param readahead: Maximum bytes fetched ahead on sequential reads
+        :type readahead: int
+        :param cache_chunks: Chunks kept besides the readahead ones
+        :type cache_chunks: int
+        '''
+        super(ObjectReader, self).__init__()
+        self._fetch = fetch
+        self._size = size
+        self.name = name
+        self._chunksize = chunksize
+        self._max_window = max(1, readahead // chunksize)
+        self._window = 1
+        self._capacity = self._max_window + max(1, cache_chunks)
+        self._chunks = OrderedDict()
+        self._next = None
+        self._pos = 0
+
+    def __len__(self):
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._size
+        if pos < 0:
+            raise IOError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def _chunk(self, index):
+        data = self._chunks.pop(index, None)
+        if data is None:
+            if index == self._next:
+                self._window = min(2 * self._window, self._max_window)
+            else:
+                self._window = 1
+            offset = index * self._chunksize
+            length = min(self._window * self._chunksize, self._size - offset)
+            fetched = self._fetch(offset, length)
+            for start in xrange(0, length, self._chunksize):
+                self._chunks[index + start // self._chunksize] = fetched[
+                    start:start + self._chunksize
+                ]
+            self._next = index + -(-length // self._chunksize)
+            data = self._chunks.pop(index)
+        self._chunks[index] = data
+        while len(self._chunks) > self._capacity:
+            self._chunks.popitem(last=False)
+        return data
+
+    def read(self, size=-1):
+        self._check_closed()
+        end = self._size
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+        parts = []
+        while self._pos < end:
+            index, start = divmod(self._pos, self._chunksize)
+            data = self._chunk(index)[start:start + end - self._pos]
+            parts.append(data)
+            self._pos += len(data)
+        return ''.join(parts)
+
+    def read1(self, size=-1):
+        self._check_closed()
+        if self._pos >= self._size:
+            return ''
+        index, start = divmod(self._pos, self._chunksize)
+        if size is None or size < 0:
+            size = self._chunksize
+        data = self._chunk(index)[start:start + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        self._check_closed()
+        parts = []
+        while self._pos < self._size and limit != 0:
+            index, start = divmod(self._pos, self._chunksize)
+            data = self._chunk(index)
+            end = data.find('\n', start) + 1 or len(data)
+            if limit is not None and limit > 0:
+                end = min(end, start + limit)
+                limit -= end - start
+            parts.append(data[start:end])
+            self._pos += end - start
+            if data[end - 1] == '\n':
+                break
+        return ''.join(parts)
+
+    def __iter__(self):
+        # Whole lines of a chunk are split by cStringIO, only lines crossing
+        # chunks are joined here. Like with file, tell() is ahead of lines
+        # returned while iterating.
+        self._check_closed()
+        return itertools.chain.from_iterable(self._line_blocks())
+
+    def _line_blocks(self):
+        line = ''
+        while self._pos < self._size:
+            index, start = divmod(self._pos, self._chunksize)
+            data = self._chunk(index)
+            self._pos = index * self._chunksize + len(data)
+            first = data.find('\n', start) + 1
+            if not first:
+                line += data[start:]
+                continue
+            last = data.rfind('\n') + 1
+            yield (line + data[start:first],)
+            if last > first:
+                yield StringIO(data[first:last])
+            line = data[last:]
+        if line:
+            yield (line,)
+
+    def close(self):
+        self._chunks.clear()
+        super(ObjectReader, self).close()
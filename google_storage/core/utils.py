@@ -1,26 +1,379 @@
 import os
+import sys
 import json
+import mmap
+import httplib
 import datetime
 import logging
-import time
-import random
+import threading
+import Queue
+import uuid
+import weakref
+import mimetypes
+import functools
+
+from multiprocessing.pool import ThreadPool
 
 import httplib2
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.http import BatchHttpRequest
 
-from oauth2client.client import SignedJwtAssertionCredentials
+from google_storage.core.checksums import FAST_CRC32C
+from google_storage.core.checksums import ChecksumError
+from google_storage.core.checksums import Crc32c
+from google_storage.core.checksums import checksum_field
+from google_storage.core.checksums import crc32c_combine
+from google_storage.core.checksums import crc32c_b64digest
+from google_storage.core.checksums import data_checksums
+from google_storage.core.metrics import NULL_METRICS
+from google_storage.core.metrics import NULL_OPERATION
+from google_storage.core.retry import DEFAULT_POLICY
+from google_storage.core.retry import NUM_RETRIES
+from google_storage.core.retry import RETRYABLE_STATUSES
+from google_storage.core.retry import RETRYABLE_ERRORS
 
 logger = logging.getLogger(__name__)
 
 CHUNKSIZE = 2 * 1024 * 1024
-NUM_RETRIES = 5
-RETRYABLE_ERRORS = (httplib2.HttpLib2Error, IOError)
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+COMPOSITE_PARTS = 8
+MAX_COMPOSE_SOURCES = 32
+DOWNLOAD_SLICES = 8
+READ_CHUNKSIZE = 256 * 1024
+READAHEAD = 8 * 1024 * 1024
+READ_CACHE_CHUNKS = 8
+BATCH_SIZE = 100
+MAX_IDLE_CHANNELS = 16
 DEFAULT_MIMETYPE = 'application/octet-stream'
+STORAGE_SCOPE = 'devstorage.full_control'
+DISCOVERY_URI = (
+    'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+)
+DISCOVERY_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'discovery'
+)
+
+_documents = {}
+_documents_lock = threading.Lock()
+# Thread locals of handlers used by the prefetch_map worker thread
+_worker = threading.local()
+
+
+def thread_map(func, items, max_workers=1):
+    '''Call func on every item using a bounded pool of threads.
+    Exceptions are captured per item instead of aborting the whole run.
+    Items are pulled lazily whenever a thread is free, so a slow call doesn't
+    hold up the others; results finished ahead of it wait in memory.
+    :param func: Callable taking a single item
+    :type func: callable
+    :param items: Items to process
+    :type items: iterable
+    :param max_workers: Maximum number of concurrent calls
+    :type max_workers: int
+    :retunrs: Generator of (result, exception) tuples in input order
+    :rtype: generator
+    '''
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception, e:
+            logger.warning("Exception in worker thread: %s" % e)
+            return None, e
+
+    if max_workers <= 1:
+        return (call(item) for item in items)
+
+    return prefetch_map(call, items, max_workers, window=sys.maxint)
+
+
+def chunked(items, size):
+    '''Split iterable into lists of at most size elements.
+    :param items: Items to split
+    :type items: iterable
+    :param size: Maximum chunk size
+    :type size: int
+    :retunrs: Generator of lists
+    :rtype: generator
+    '''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prefetch_map(func, items, ahead, ordered=True, window=None):
+    '''Generator calling func on items in background threads, keeping up to
+    ahead calls running while the consumer processes the current result.
+    Threads are joined before the generator finishes, when it's closed early
+    calls already running are waited for.
+    :param func: Callable taking a single item
+    :type func: callable
+    :param items: Items to process
+    :type items: iterable
+    :param ahead: Number of calls kept in flight
+    :type ahead: int
+    :param ordered: Yield results in input order, otherwise as they complete
+    :type ordered: bool
+    :param window: Maximum number of items started but not yet yielded,
+                   ahead if None. Bigger window keeps threads busy while an
+                   earlier call is still running.
+    :type window: int
+    :retunrs: Generator of results, exceptions are raised when reached
+    :rtype: generator
+    '''
+    if window is None:
+        window = ahead
+    items = enumerate(items)
+    tasks = Queue.Queue()
+    done = Queue.Queue()
+    completed = {}
+    threads = []
+    state = {'running': 0, 'started': 0, 'yielded': 0}
+
+    def work():
+        _worker.locals = []
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                index, item = task
+                try:
+                    done.put((index, func(item), None))
+                except Exception, e:
+                    done.put((index, None, e))
+        finally:
+            # Give channels back before join returns, not once thread exits
+            for local in _worker.locals:
+                vars(local).pop('lease', None)
+
+    def fill():
+        while (
+            state['running'] < ahead and
+            state['started'] - state['yielded'] < window
+        ):
+            try:
+                task = next(items)
+            except StopIteration:
+                return
+            if len(threads) == state['running']:
+                thread = threading.Thread(target=work)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            tasks.put(task)
+            state['running'] += 1
+            state['started'] += 1
+
+    def receive():
+        index, result, error = done.get()
+        completed[index] = (result, error)
+        state['running'] -= 1
+        fill()
+
+    try:
+        fill()
+        while True:
+            if ordered:
+                while state['yielded'] not in completed and state['running']:
+                    receive()
+                if state['yielded'] not in completed:
+                    return
+                result, error = completed.pop(state['yielded'])
+            else:
+                if not completed and state['running']:
+                    receive()
+                if not completed:
+                    return
+                result, error = completed.popitem()[1]
+            state['yielded'] += 1
+            if error is not None:
+                raise error
+            fill()
+            yield result
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def instrumented(name):
+    '''Decorator timing a handler method taking bucket as its first
+    argument as operation name.
+    '''
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, bucket, *args, **kwargs):
+            with self.operation(name, bucket):
+                return method(self, bucket, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ByteBudget(object):
+    '''Bounds number of bytes in flight between concurrent workers. Space is
+    granted in ticket order so a large item can't be starved by later ones.
+    Single item larger than the limit is let through when nothing else is in
+    flight.
+    '''
+
+    def __init__(self, limit):
+        '''Constructor
+        :param limit: Maximum number of bytes in flight
+        :type limit: int
+        '''
+        self.limit = limit
+        self.in_flight = 0
+        self.closed = False
+        self._ticket = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size, ticket):
+        '''Block until size bytes can be taken. Every ticket from 0 upwards
+        has to be acquired exactly once, even with size 0.
+        :param size: Number of bytes
+        :type size: int
+        :param ticket: Sequence number of the item
+        :type ticket: int
+        :raises: IOError if budget has been closed
+        '''
+        with self._cond:
+            while not self.closed and (
+                ticket != self._ticket or (
+                    self.in_flight and self.in_flight + size > self.limit
+                )
+            ):
+                self._cond.wait()
+            if self.closed:
+                raise IOError("Byte budget closed")
+            self.in_flight += size
+            self._ticket += 1
+            self._cond.notify_all()
+
+    def release(self, size):
+        '''Give back size bytes.
+        :param size: Number of bytes
+        :type size: int
+        '''
+        with self._cond:
+            self.in_flight -= size
+            self._cond.notify_all()
+
+    def close(self):
+        '''Wake up and fail all waiting workers.
+        '''
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class FileSlice(object):
+    '''Read only file like view of a part of a file on disk.
+    '''
+
+    def __init__(self, path, offset, length):
+        '''Constructor
+        :param path: Path to the file
+        :type path: str
+        :param offset: Position of the first byte of the slice
+        :type offset: int
+        :param length: Number of bytes in the slice
+        :type length: int
+        '''
+        self.name = path
+        self.offset = offset
+        self.length = length
+        self._fp = open(path, 'rb')
+        self._pos = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self._fp.seek(self.offset + self._pos)
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self._pos = max(0, min(pos, self.length))
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class _Crc32cSlice(FileSlice):
+    '''File slice computing CRC32C of the data as it's read. Data read
+    again, e.g. when upload chunk is retried, isn't counted twice.
+    '''
+
+    def __init__(self, path, offset, length):
+        super(_Crc32cSlice, self).__init__(path, offset, length)
+        self.crc = Crc32c()
+        self._hashed = 0
+
+    def read(self, size=-1):
+        start = self._pos
+        data = super(_Crc32cSlice, self).read(size)
+        if start <= self._hashed < start + len(data):
+            self.crc.update(data[self._hashed - start:])
+            self._hashed = start + len(data)
+        return data
+
+    def b64digest(self):
+        '''CRC32C of the whole slice in the format of object's crc32c field,
+        reads the part which hasn't been read yet.
+        '''
+        self.seek(self._hashed)
+        while self.read(CHUNKSIZE):
+            pass
+        return self.crc.b64digest()
+
+
+def is_local_file(fileobject):
+    '''Check if fileobject is a file on disk which can be opened by name.
+    '''
+    name = getattr(fileobject, 'name', None)
+    return isinstance(name, basestring) and os.path.isfile(name)
+
+
+def stream_size(stream):
+    '''Size of a seekable stream.
+    :param stream: Object with read(size) method
+    :type stream: file
+    :retunrs: Size in bytes or None if stream can't seek
+    :rtype: int
+    '''
+    try:
+        pos = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(pos)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return size
 
 
 class OAuth2(object):
@@ -33,11 +386,166 @@ class OAuth2(object):
         :param json_key_path: path to the stored json_key
         :type json_key_path: str
         '''
-        json_key = json.load(open(json_key_path, 'r'))
-        scope = ['https://www.googleapis.com/auth/%s' % service]
-        credentials = SignedJwtAssertionCredentials(
-            json_key['client_email'], json_key['private_key'], scope)
-        return credentials.authorize(httplib2.Http())
+        return OAuth2.credentials(service, json_key_path).authorize(
+            httplib2.Http()
+        )
+
+    @staticmethod
+    def credentials(service, json_key_path):
+        '''Returns credentials which can authorize any number of Http objects.
+        Credentials and their access token are shared by all callers using
+        the same service account and scope.
+        :param service: scope suffix to authenticate with
+        :type service: str
+        :param json_key_path: path to the stored json_key
+        :type json_key_path: str
+        '''
+        from google_storage.core.auth import TOKEN_CACHE
+        return TOKEN_CACHE.get(json_key_path, service)
+
+
+def discovery_document(service, api_ver, discovery_url=None):
+    '''Parsed discovery document of the API. The document bundled with the
+    package is used unless discovery_url is given or there is none for the
+    API, fetched documents are kept for the life of the process.
+    :param service: Name of the API
+    :type service: str
+    :param api_ver: Version of the API
+    :type api_ver: str
+    :param discovery_url: URI template of the discovery service
+    :type discovery_url: str
+    :retunrs: Discovery document shared with other callers, don't modify it
+    :rtype: dict
+    '''
+    path = os.path.join(DISCOVERY_DIR, '%s_%s.json' % (service, api_ver))
+    if discovery_url is None and os.path.exists(path):
+        key = path
+    else:
+        key = (discovery_url or DISCOVERY_URI).format(
+            api=service, apiVersion=api_ver
+        )
+
+    with _documents_lock:
+        document = _documents.get(key)
+        if document is None:
+            if key == path:
+                with open(path, 'r') as f:
+                    document = json.load(f)
+            else:
+                logger.debug("Fetching discovery document %s" % key)
+                resp, content = httplib2.Http().request(key)
+                if resp.status >= 400:
+                    raise HttpError(resp, content, uri=key)
+                document = json.loads(content)
+            _documents[key] = document
+    return document
+
+
+class _CurrentOperation(object):
+    '''Makes operation current in the calling thread while in with block.
+    '''
+
+    def __init__(self, handler, op):
+        self.handler = handler
+        self.op = op
+
+    def __enter__(self):
+        local = self.handler._local
+        self.previous = getattr(local, 'operation', NULL_OPERATION)
+        local.operation = self.op
+        return self.op
+
+    def __exit__(self, type, value, traceback):
+        self.handler._local.operation = self.previous
+        self.op.finish(value)
+        return False
+
+
+class _Channel(object):
+    '''Authorized Http object with service object built on top of it.
+    '''
+
+    def __init__(self, http):
+        self.http = http
+        self.service = None
+
+    def close(self):
+        for conn in self.http.connections.values():
+            conn.close()
+        self.http.connections.clear()
+
+
+class _Lease(object):
+    '''Channel held in thread local storage of a single thread.
+    '''
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class _ChannelPool(object):
+    '''Channels of a handler reused by its threads. A thread keeps the
+    channel it took until it exits, the channel is then given to the next
+    thread, so thread pools started by every call neither open new
+    connections nor build new service objects.
+    '''
+
+    def __init__(self, connect, max_idle=MAX_IDLE_CHANNELS):
+        '''Constructor
+        :param connect: Callable creating new channel
+        :type connect: callable
+        :param max_idle: Channels kept for later threads, more are closed
+        :type max_idle: int
+        '''
+        self.connect = connect
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle = []
+        self._leases = {}
+        self._generation = 0
+        self._lock = threading.RLock()
+
+    def lease(self):
+        '''Take idle channel or connect new one. Channel is returned once
+        the lease is garbage, i.e. when thread holding it exits.
+        :retunrs: Lease of the channel
+        :rtype: _Lease
+        '''
+        with self._lock:
+            channel = self._idle.pop() if self._idle else None
+            generation = self._generation
+        if channel is None:
+            channel = self.connect()
+            with self._lock:
+                self.created += 1
+        lease = _Lease(channel)
+        with self._lock:
+            self._leases[weakref.ref(lease, self._release)] = (
+                channel, generation
+            )
+        return lease
+
+    def _release(self, ref):
+        with self._lock:
+            channel, generation = self._leases.pop(ref)
+            if (
+                generation == self._generation and
+                len(self._idle) < self.max_idle
+            ):
+                self._idle.append(channel)
+                return
+        channel.close()
+
+    def close(self):
+        '''Close connections of all channels, leased ones aren't given out
+        again once returned.
+        '''
+        with self._lock:
+            channels = self._idle + [c for c, _ in self._leases.values()]
+            self._idle = []
+            self._generation += 1
+        for channel in channels:
+            channel.close()
 
 
 class GSHandler(object):
@@ -45,7 +553,8 @@ class GSHandler(object):
     '''
     def __init__(
         self, json_key_path, auth_mode, service, api_ver,
-        project='piinfrastucture'
+        project='piinfrastucture', credentials=None, discovery_url=None,
+        metrics=None, retry_policy=None, root_url=None
     ):
         '''Constructor
         :param json_key_path: path to the stored json_key
@@ -56,13 +565,186 @@ class GSHandler(object):
         :type service: str
         :param service: api version
         :type service: str
+        :param credentials: Use these instead of reading json_key_path
+        :type credentials: oauth2client.client.Credentials
+        :param discovery_url: URI template of the discovery service to fetch
+                              the API description from instead of using the
+                              bundled one.
+        :type discovery_url: str
+        :param metrics: Instrumentation receiving every storage call
+        :type metrics: google_storage.core.metrics.Metrics
+        :param retry_policy: Policy retrying failed calls
+        :type retry_policy: google_storage.core.retry.RetryPolicy
+        :param root_url: Endpoint of the API replacing the one in discovery
+                         document, e.g. of an emulator.
+        :type root_url: str
         '''
 
-        self.http_auth = OAuth2.authenticate(auth_mode, json_key_path)
-        self.service = build(service, api_ver, http=self.http_auth)
+        self.json_key_path = json_key_path
+        self.auth_mode = auth_mode
+        self.service_name = service
+        self.api_ver = api_ver
         self.project = project
+        self.discovery_url = discovery_url
+        self.root_url = root_url
+        if credentials is None:
+            credentials = OAuth2.credentials(auth_mode, json_key_path)
+        self.credentials = credentials
+        self.metrics = metrics or NULL_METRICS
+        self.retry_policy = retry_policy or DEFAULT_POLICY
+
+        # httplib2.Http is not thread safe, so every thread holds its own
+        # authorized connection and service object built on top of it,
+        # taken from the pool and given back when the thread exits.
+        self._local = threading.local()
+        self._channels = _ChannelPool(self._connect)
+        self._document = None
+
+    def _connect(self):
+        return _Channel(self._instrument(
+            self.credentials.authorize(httplib2.Http())
+        ))
+
+    @property
+    def _channel(self):
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            lease = self._channels.lease()
+            self._local.lease = lease
+            locals_ = getattr(_worker, 'locals', None)
+            if locals_ is not None:
+                locals_.append(self._local)
+        return lease.channel
+
+    @property
+    def http_auth(self):
+        '''Authorized Http object held by the calling thread.
+        '''
+        return self._channel.http
+
+    @property
+    def document(self):
+        '''Discovery document the service objects are built from.
+        '''
+        if self._document is None:
+            document = self.retry_policy.call(
+                discovery_document, self.service_name, self.api_ver,
+                self.discovery_url
+            )
+            if self.root_url:
+                document = dict(document)
+                document['rootUrl'] = self.root_url
+                document['baseUrl'] = self.root_url + document['servicePath']
+            self._document = document
+        return self._document
+
+    @property
+    def service(self):
+        '''Service object held by the calling thread.
+        '''
+        channel = self._channel
+        if channel.service is None:
+            from googleapiclient.discovery import build_from_document
+            channel.service = build_from_document(
+                self.document, http=channel.http
+            )
+        return channel.service
+
+    def _instrument(self, http):
+        '''Report status of every response to the operation running in the
+        calling thread.
+        '''
+        request = http.request
+
+        def instrumented_request(*args, **kwargs):
+            resp, content = request(*args, **kwargs)
+            self.current_operation.status(resp.status)
+            return resp, content
+
+        # Batch requests look for credentials on the request method
+        if hasattr(request, 'credentials'):
+            instrumented_request.credentials = request.credentials
+        http.request = instrumented_request
+        return http
+
+    @property
+    def current_operation(self):
+        '''Operation running in the calling thread.
+        '''
+        return getattr(self._local, 'operation', NULL_OPERATION)
+
+    def operation(self, name, bucket=None):
+        '''Time a storage call. Statuses of responses received and retries
+        made by the calling thread are counted in it until it's finished.
+        :param name: Name of the operation
+        :type name: str
+        :param bucket: Name of the bucket
+        :type bucket: str
+        :retunrs: Context manager yielding the operation
+        :rtype: google_storage.core.metrics.Operation
+        '''
+        op = self.metrics.operation(name, bucket)
+        if op is NULL_OPERATION:
+            return op
+        return _CurrentOperation(self, op)
+
+    def bind_operation(self, func):
+        '''Make func count into the operation of the calling thread when
+        it's run in a worker thread.
+        '''
+        op = self.current_operation
+        if op is NULL_OPERATION:
+            return func
+
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            local = self._local
+            previous = getattr(local, 'operation', NULL_OPERATION)
+            local.operation = op
+            try:
+                return func(*args, **kwargs)
+            finally:
+                local.operation = previous
+        return bound
+
+    def retrying(self, name=None):
+        '''Start retrying an operation with the handler's retry policy.
+        Retries are counted in the operation of the calling thread.
+        :param name: Operation name, selects deadline of the policy
+        :type name: str
+        :retunrs: Retry state
+        :rtype: google_storage.core.retry.Retrying
+        '''
+        return self.retry_policy.start(name, self.current_operation.retry)
+
+    def execute(self, request, name=None):
+        '''Execute request, retrying it according to the retry policy.
+        :param request: Request to execute
+        :type request: HttpRequest
+        :param name: Operation name, selects deadline of the policy
+        :type name: str
+        :retunrs: Response
+        :rtype: json
+        '''
+        retrying = self.retrying(name)
+        while True:
+            try:
+                response = request.execute()
+            except Exception, e:
+                retrying.failed(e)
+                continue
+            retrying.succeeded()
+            return response
+
+    def close(self):
+        '''Close all connections opened by this handler. Handler can still be
+        used afterwards, new connections are opened on demand.
+        '''
+        self._channels.close()
+        self._local = threading.local()
 
-    def get_json_key_path(self):
+    @staticmethod
+    def get_json_key_path():
         '''Get path for the json key with credentails.
         :retunrs: Key path
         :rtype: str
@@ -81,21 +763,42 @@ class GSHandler(object):
 class GSStorageHandler(GSHandler):
     '''Rough Google storage wrapper.
     '''
-    def __init__(self, json_key_path=None):
+    def __init__(
+        self, json_key_path=None, auth_mode=STORAGE_SCOPE, credentials=None,
+        discovery_url=None, metrics=None, retry_policy=None, root_url=None
+    ):
         '''Constructor.
         :param json_key_path: path to the stored json_key
         :type json_key_path: str
+        :param auth_mode: authentication scope
+        :type auth_mode: str
+        :param credentials: Use these instead of reading json_key_path
+        :type credentials: oauth2client.client.Credentials
+        :param discovery_url: URI template of the discovery service to fetch
+                              the API description from instead of using the
+                              bundled one.
+        :type discovery_url: str
+        :param metrics: Instrumentation receiving every storage call
+        :type metrics: google_storage.core.metrics.Metrics
+        :param retry_policy: Policy retrying failed calls
+        :type retry_policy: google_storage.core.retry.RetryPolicy
+        :param root_url: Endpoint of the API replacing the one in discovery
+                         document, e.g. of an emulator.
+        :type root_url: str
         :retunrs: Response JSON str listing bucket contents
         :rtype: json
         '''
 
-        if not json_key_path:
+        if not json_key_path and credentials is None:
             json_key_path = self.get_json_key_path()
 
         super(GSStorageHandler, self).__init__(
-            json_key_path, 'devstorage.full_control', 'storage', 'v1'
+            json_key_path, auth_mode, 'storage', 'v1',
+            credentials=credentials, discovery_url=discovery_url,
+            metrics=metrics, retry_policy=retry_policy, root_url=root_url
         )
 
+    @instrumented('details')
     def details(self, bucket):
         '''Get bucket details.
         :param bucket: Name of the bucket in google storage to access
@@ -105,9 +808,36 @@ class GSStorageHandler(GSHandler):
         '''
         logger.info("Pulling info for %s" % bucket)
         req = self.service.buckets().get(bucket=bucket)
-        resp = req.execute()
+        resp = self.execute(req, 'details')
         return resp
 
+    @instrumented('object_details')
+    def object_details(
+        self, bucket, object_name, fields=None, generation=None
+    ):
+        '''Get object metadata.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param fields: Partial response selector e.g. 'size,generation'
+        :type fields: str
+        :param generation: Get this generation instead of the latest
+        :type generation: str
+        :retunrs: Object resource
+        :rtype: dict
+        '''
+        logger.debug("Pulling info for %s/%s" % (bucket, object_name))
+        kwargs = {'bucket': bucket, 'object': object_name}
+        if fields:
+            kwargs['fields'] = fields
+        if generation:
+            kwargs['generation'] = generation
+        return self.execute(
+            self.service.objects().get(**kwargs), 'object_details'
+        )
+
+    @instrumented('bucket_exists')
     def bucket_exists(self, bucket):
         '''Check if bucket exists.
         :param bucket: Name of the bucket in google storage to access
@@ -128,50 +858,370 @@ class GSStorageHandler(GSHandler):
 
         return False
 
-    def list_bucket_content(self, bucket):
+    def iter_bucket_pages(
+        self, bucket, prefix=None, delimiter=None, fields=None,
+        page_size=None, prefetch=True
+    ):
+        '''Generator going through all pages of bucket listing. Next page is
+        requested in background while the current one is being consumed.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param prefix: List only objects with names starting with prefix
+        :type prefix: str
+        :param delimiter: Group names containing delimiter after prefix into
+                          page's 'prefixes' instead of listing them.
+        :type delimiter: str
+        :param fields: Object fields to pull e.g. 'name,size,md5Hash'
+        :type fields: str
+        :param page_size: Maximum number of items per page
+        :type page_size: int
+        :param prefetch: Fetch next page in background
+        :type prefetch: bool
+        :retunrs: Generator with list response pages
+        :rtype: generator
+        '''
+
+        kwargs = {'bucket': bucket}
+        if prefix:
+            kwargs['prefix'] = prefix
+        if delimiter:
+            kwargs['delimiter'] = delimiter
+        if fields:
+            kwargs['fields'] = 'nextPageToken,prefixes,items(%s)' % fields
+        if page_size:
+            kwargs['maxResults'] = page_size
+
+        def fetch(token):
+            with self.operation('list_page', bucket):
+                if token:
+                    request = self.service.objects().list(
+                        pageToken=token, **kwargs
+                    )
+                else:
+                    request = self.service.objects().list(**kwargs)
+                return self.execute(request, 'list_page')
+
+        logger.info("Listing content of bucket %s prefix %s" % (
+            bucket, prefix
+        ))
+        pool = ThreadPool(1) if prefetch else None
+        try:
+            page = fetch(None)
+            pages = 1
+            while True:
+                token = page.get('nextPageToken')
+                pending = None
+                if token and pool:
+                    pending = pool.apply_async(fetch, (token,))
+                logger.debug("Got page %s with %s items" % (
+                    pages, len(page.get('items', []))
+                ))
+                yield page
+                if not token:
+                    break
+                page = pending.get() if pending else fetch(token)
+                pages += 1
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def iter_bucket_content(
+        self, bucket, prefix=None, fields=None, page_size=None,
+        prefetch=True, delimiter=None
+    ):
+        '''Generator going through all objects in the bucket.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param prefix: List only objects with names starting with prefix
+        :type prefix: str
+        :param fields: Object fields to pull e.g. 'name,size,md5Hash'
+        :type fields: str
+        :param page_size: Maximum number of items per page
+        :type page_size: int
+        :param prefetch: Fetch next page in background
+        :type prefetch: bool
+        :param delimiter: Skip objects with names containing delimiter
+                          after prefix.
+        :type delimiter: str
+        :retunrs: Generator with object resources
+        :rtype: generator
+        '''
+        for page in self.iter_bucket_pages(
+            bucket, prefix=prefix, delimiter=delimiter, fields=fields,
+            page_size=page_size, prefetch=prefetch
+        ):
+            for item in page.get('items', []):
+                yield item
+
+    def list_bucket_content(self, bucket, prefix=None, fields=None):
         '''List existing bucket.
         :param bucket: Name of the bucket in google storage to access
         :type bucket: str
+        :param prefix: List only objects with names starting with prefix
+        :type prefix: str
+        :param fields: Object fields to pull e.g. 'name,size,md5Hash'
+        :type fields: str
         :retunrs: Response JSON str listing bucket contents
         :rtype: json
         '''
 
-        logger.info("Getting a list of buckets contents %s" % bucket)
-        resp = self.service.objects().list(bucket=bucket).execute()
-        logger.info("Got the content: %s" % resp)
-        return resp["items"] if "items" in resp else None
+        items = list(self.iter_bucket_content(
+            bucket, prefix=prefix, fields=fields
+        ))
+        logger.info("Got %s objects from %s" % (len(items), bucket))
+        return items or None
+
+    def execute_batch(self, requests):
+        '''Execute requests as a single batch call. Sub-requests failing with
+        retryable errors are sent again in a new batch according to the retry
+        policy.
+        :param requests: Up to BATCH_SIZE requests keyed by any hashable
+        :type requests: dict {key: HttpRequest}
+        :retunrs: Responses and exceptions keyed as requests
+        :rtype: dict {key: (response, exception)}
+        '''
+
+        with self.operation('execute_batch') as op:
+            results = {}
+            pending = dict(requests)
+            retrying = self.retrying('execute_batch')
+            while pending:
+                keys = list(pending)
+                errors = {}
+
+                def callback(request_id, response, exception):
+                    key = keys[int(request_id)]
+                    if isinstance(exception, HttpError):
+                        op.status(exception.resp.status)
+                    if (
+                        exception is not None and
+                        self.retry_policy.is_retryable(exception)
+                    ):
+                        errors[key] = exception
+                    else:
+                        results[key] = (response, exception)
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for i, key in enumerate(keys):
+                    batch.add(pending[key], request_id=str(i))
+                op.add_chunks(len(keys))
+
+                try:
+                    batch.execute(http=self.http_auth)
+                except Exception, e:
+                    if not self.retry_policy.is_retryable(e):
+                        raise
+                    errors = dict((k, e) for k in keys)
+
+                pending = dict((k, pending[k]) for k in errors)
+                if not pending:
+                    break
+                if len(pending) < len(keys):
+                    retrying.succeeded()
+
+                logger.info("%s of %s batched requests failed" % (
+                    len(pending), len(keys)
+                ))
+                try:
+                    retrying.failed(errors.values()[0])
+                except Exception:
+                    for key, error in errors.iteritems():
+                        results[key] = (None, error)
+                    break
+
+            return results
+
+    def __batch_map(self, request, names, max_workers):
+        '''Execute request(objects, name) for every name in batches of
+        BATCH_SIZE executed concurrently. Objects resource is built once per
+        batch, building it takes longer than the request itself.
+        :retunrs: Generator of (name, response) tuples in order of batches,
+                  response is None when the object doesn't exist
+        :rtype: generator
+        :raises: First error other than 404 left after retries
+        '''
+
+        def execute(names):
+            objects = self.service.objects()
+            return self.execute_batch(
+                dict((name, request(objects, name)) for name in names)
+            )
+
+        for results, error in thread_map(
+            self.bind_operation(execute), chunked(names, BATCH_SIZE),
+            max_workers
+        ):
+            if error is not None:
+                raise error
+            for name, (response, exception) in results.iteritems():
+                if exception is not None:
+                    if not (
+                        isinstance(exception, HttpError) and
+                        exception.resp.status == 404
+                    ):
+                        raise exception
+                    response = None
+                yield name, response
 
-    def delete_bucket_content(self, bucket):
-        '''Delete content of existing bucket.
+    def iter_stat_many(self, bucket, names, fields=None, max_workers=4):
+        '''Generator of metadata of many objects, fetched in batches of
+        BATCH_SIZE. Names are consumed lazily so they can come straight from
+        a listing or a file.
         :param bucket: Name of the bucket in google storage to access
         :type bucket: str
-        :retunrs: Response JSON str
-        :rtype: json
+        :param names: Names of the objects
+        :type names: iterable
+        :param fields: Partial response selector e.g. 'size,generation'
+        :type fields: str
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: Generator of (name, resource) tuples, resource is None if
+                  the object doesn't exist
+        :rtype: generator
         '''
 
-        objects = self.list_bucket_content(bucket)
-        if objects:
-            logger.info("Createing batch for objects deletion...")
-            batch = BatchHttpRequest(callback=self.delete_object_cb)
-            for o in objects:
-                logger.debug(
-                    "Adding 'delete request' to batch: %s" % o['name']
-                )
-                batch.add(self.service.objects().delete(
-                    object=o['name'], bucket=bucket
-                ))
-            logger.info("Executing batch...")
-            resp = batch.execute(http=self.http_auth)
-            logger.info("Response content from batch: %s" % resp)
+        def request(objects, name):
+            kwargs = {'bucket': bucket, 'object': name}
+            if fields:
+                kwargs['fields'] = fields
+            return objects.get(**kwargs)
 
-            return resp
+        return self.__batch_map(request, names, max_workers)
 
-        return None
+    @instrumented('stat_many')
+    def stat_many(self, bucket, names, fields=None, max_workers=4):
+        '''Get metadata of many objects in batches, see iter_stat_many.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param names: Names of the objects
+        :type names: iterable
+        :param fields: Partial response selector e.g. 'size,generation'
+        :type fields: str
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: Resources keyed by name, None for missing objects
+        :rtype: dict
+        '''
+        return dict(self.iter_stat_many(bucket, names, fields, max_workers))
+
+    @instrumented('exists_many')
+    def exists_many(self, bucket, names, max_workers=4):
+        '''Check existence of many objects in batches.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param names: Names of the objects
+        :type names: iterable
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: True for existing objects keyed by name
+        :rtype: dict
+        '''
+        return dict(
+            (name, resource is not None)
+            for name, resource in self.iter_stat_many(
+                bucket, names, 'name', max_workers
+            )
+        )
+
+    @instrumented('patch_metadata_many')
+    def patch_metadata_many(
+        self, bucket, metadata, fields='name,metadata', max_workers=4
+    ):
+        '''Update custom metadata of many objects in batches. Keys not
+        given are kept, keys set to None are removed.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param metadata: Metadata to set keyed by object name
+        :type metadata: dict {name: dict}
+        :param fields: Partial response selector
+        :type fields: str
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: Patched resources keyed by name, None for missing objects
+        :rtype: dict
+        '''
+
+        def request(objects, name):
+            kwargs = {
+                'bucket': bucket, 'object': name,
+                'body': {'metadata': metadata[name]}
+            }
+            if fields:
+                kwargs['fields'] = fields
+            return objects.patch(**kwargs)
+
+        return dict(self.__batch_map(request, metadata, max_workers))
+
+    @instrumented('delete_objects')
+    def delete_objects(self, bucket, names, max_workers=4):
+        '''Delete objects in batches of BATCH_SIZE. Names are consumed
+        lazily so they can come straight from a listing.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param names: Names of objects to delete
+        :type names: iterable
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: Number of deleted, missing and failed objects
+        :rtype: dict
+        '''
+
+        def delete_chunk(names):
+            logger.debug("Deleting batch of %s objects" % len(names))
+            objects = self.service.objects()
+            return self.execute_batch(dict(
+                (name, objects.delete(bucket=bucket, object=name))
+                for name in names
+            ))
+
+        summary = {'deleted': 0, 'missing': 0, 'failed': 0}
+        for results, error in thread_map(
+            delete_chunk, chunked(names, BATCH_SIZE), max_workers
+        ):
+            if error is not None:
+                raise error
+            for name, (response, exception) in results.iteritems():
+                if exception is None:
+                    summary['deleted'] += 1
+                elif (
+                    isinstance(exception, HttpError) and
+                    exception.resp.status == 404
+                ):
+                    summary['missing'] += 1
+                else:
+                    logger.warning("Exception while deleting %s: %s" % (
+                        name, exception
+                    ))
+                    summary['failed'] += 1
+
+        return summary
+
+    @instrumented('delete_bucket_content')
+    def delete_bucket_content(self, bucket, prefix=None, max_workers=4):
+        '''Delete content of existing bucket. Objects are deleted in batches
+        of BATCH_SIZE while the listing is still being read.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param prefix: Delete only objects with names starting with prefix
+        :type prefix: str
+        :param max_workers: Number of batches executed concurrently
+        :type max_workers: int
+        :retunrs: Number of deleted, missing and failed objects
+        :rtype: dict
+        '''
+
+        names = (
+            o['name'] for o in self.iter_bucket_content(
+                bucket, prefix=prefix, fields='name'
+            )
+        )
+        summary = self.delete_objects(bucket, names, max_workers)
 
-    def delete_object_cb(self, request_id, response, exception):
-        if exception is not None:
-            logger.warning("Exception while deleting object: %s" % exception)
+        logger.info("Deleted content of bucket %s: %s" % (bucket, summary))
+        return summary
 
+    @instrumented('create_bucket')
     def create_bucket(self, bucket):
         '''Create bucket.
         :param bucket: Name of the bucket in google storage to create
@@ -196,25 +1246,17 @@ class GSStorageHandler(GSHandler):
 
         req = self.service.buckets().insert(project=self.project, body=body)
         resp = None
-        progressless_iters = 0
-        while resp is None:
-            logger.info("Response try: ... %s" % (
-                progressless_iters
-            ))
-            try:
-                resp = req.execute()
-            except HttpError, e:
-                logger.info(e)
-                if e.resp.status == 503:
-                    self.__handle_progressless_iter(e, progressless_iters)
-                    progressless_iters += 1
-                if e.resp.status == 404:
-                    logger.info("Resource not Found! Error: %s" % e)
-                    break
+        try:
+            resp = self.execute(req, 'create_bucket')
+        except HttpError, e:
+            if e.resp.status != 404:
+                raise
+            logger.info("Resource not Found! Error: %s" % e)
 
-        logger.info("Response content: %s" % resp)
+        logger.debug("Response content: %s" % resp)
         return resp
 
+    @instrumented('delete_bucket')
     def delete_bucket(self, bucket, delete_content=False):
         '''Delete existing bucket.
         :param bucket: Name of the bucket in google storage to access
@@ -228,94 +1270,49 @@ class GSStorageHandler(GSHandler):
 
         logger.info("Deleting bucket %s" % bucket)
         resp = None
-        deleting_content = False
         try:
-            resp = None
-            progressless_iters = 0
-            while resp is None:
-                logger.info("Response try: %s ... %s" % (
-                    deleting_content, progressless_iters
-                ))
-                try:
-                    resp = self.service.buckets().delete(
-                        bucket=bucket
-                    ).execute()
-                    return resp
-                except HttpError, e:
-                    logger.info(e)
-                    if e.resp.status == 503:
-                        self.__handle_progressless_iter(e, progressless_iters)
-                        progressless_iters += 1
-                    if e.resp.status == 404:
-                        logger.info("Resource not Found! Error: %s" % e)
-                        break
-
+            resp = self.execute(
+                self.service.buckets().delete(bucket=bucket), 'delete_bucket'
+            )
         except HttpError, e:
-            if e.resp.status == 409 and delete_content:
-                deleting_content = True
+            if e.resp.status == 404:
+                logger.info("Resource not Found! Error: %s" % e)
+            elif e.resp.status == 409 and delete_content:
                 logger.info(
                     "Bucket %s is not empty. Deleteing content..." % bucket
                 )
-                resp = self.delete_bucket_content(bucket)
+                self.delete_bucket_content(bucket)
+                self.execute(
+                    self.service.buckets().delete(bucket=bucket),
+                    'delete_bucket'
+                )
+                resp = 1
             else:
-                raise e
-        if deleting_content:
-            resp = None
-            progressless_iters = 0
-            while resp is None:
-                logger.info("Response try: %s ... %s" % (
-                    deleting_content, progressless_iters
-                ))
-                try:
-                    self.service.buckets().delete(bucket=bucket).execute()
-                    resp = 1
-                except HttpError, e:
-                    logger.info(e)
-                    if e.resp.status == 503:
-                        self.__handle_progressless_iter(e, progressless_iters)
-                        progressless_iters += 1
-                    if e.resp.status == 404:
-                        logger.info("Resource not Found! Error: %s" % e)
-                        break
-
-        logger.info("Response content: %s" % resp)
-        return resp
-
-    def __handle_progressless_iter(self, error, progressless_iters):
-        '''Handle retries when HTTP call fails.
-        :param error: Error to be raised when retry counter hits threshold.
-        :type error: HttpError
-        :param progressless_iters: Numer of iterations
-        :type progressless_iters: int
-        :raises: Error passed as param
-        '''
+                raise
 
-        if progressless_iters > NUM_RETRIES:
-            logger.info(
-                'Failed to make progress for too many consecutive '
-                'iterations.'
-            )
-            raise error
-
-        sleeptime = random.random() * (2**progressless_iters)
-        logger.info(
-            'Caught exception (%s). Sleeping for %s seconds before retry #%d.'
-            % (str(error), sleeptime, progressless_iters)
-        )
-        time.sleep(sleeptime)
+        logger.debug("Response content: %s" % resp)
+        return resp
 
+    @instrumented('upload')
     def upload(
             self,
             bucket,
             fileobject,
             location='',
             mimetype='text/plain',
-            public=False
+            public=False,
+            resumable=None,
+            chunksize=CHUNKSIZE,
+            composite_threshold=None,
+            composite_parts=COMPOSITE_PARTS,
+            name=None
     ):
         '''Uploads files to a bucket in google storage.
         :param bucket: Name of the bucket in google storage to access
         :type bucket: str
-        :param fileobject: File to store in google storage.
+        :param fileobject: File to store in google storage. Bytes, buffers
+                           and streams which aren't files on disk are
+                           uploaded by upload_data and need name.
         :type fileobject: file
         :param location: Location in google storage bucket to store object
         :type location: str
@@ -323,44 +1320,485 @@ class GSStorageHandler(GSHandler):
         :type mimetype: str
         :param public: If you want data to be public or not.
         :type public: bool
+        :param resumable: Upload in chunks which are retried separately. If
+                          None files bigger than RESUMABLE_THRESHOLD are
+                          uploaded in chunks.
+        :type resumable: bool
+        :param chunksize: Size of the chunk, multiple of 256KB.
+        :type chunksize: int
+        :param composite_threshold: Files bigger than this are uploaded as
+                                    parallel composite upload, unless
+                                    crcmod C extension isn't installed.
+        :type composite_threshold: int
+        :param composite_parts: Number of parts for composite upload
+        :type composite_parts: int
+        :param name: Object name, location joined with the file name if None
+        :type name: str
         :retunrs: Response JSON str
         :rtype: json
         '''
 
+        if not is_local_file(fileobject):
+            if name is None:
+                raise ValueError(
+                    "Upload of data which isn't a local file needs name"
+                )
+            return self.upload_data(
+                bucket, fileobject, name, mimetype, public, resumable,
+                chunksize
+            )
+
+        size = os.path.getsize(fileobject.name)
+        composite = composite_threshold and size > composite_threshold
+        if composite and not FAST_CRC32C:
+            logger.warning(
+                "crcmod C extension isn't installed, uploading %s as single "
+                "stream" % fileobject.name
+            )
+            composite = False
+        if composite:
+            return self.upload_composite(
+                bucket, fileobject, location, mimetype, public,
+                parts=composite_parts, chunksize=chunksize, name=name
+            )
+
         logger.info('Building upload request...')
 
-        gs_path = os.path.join(location, os.path.split(fileobject.name)[1])
+        gs_path = name or os.path.join(
+            location, os.path.split(fileobject.name)[1]
+        )
 
         logger.info(gs_path)
 
+        if resumable is None:
+            resumable = size > RESUMABLE_THRESHOLD
+
+        from googleapiclient.http import MediaFileUpload
         media = MediaFileUpload(
-            fileobject.name, mimetype=mimetype
-            # resumable=True
+            fileobject.name, mimetype=mimetype, chunksize=chunksize,
+            resumable=resumable
         )
-        if public:
-            request = self.service.objects().insert(
-                bucket=bucket,
-                name=gs_path,
-                media_body=media,
-                predefinedAcl="publicRead"
-            ).execute()
-        else:
-            request = self.service.objects().insert(
-                bucket=bucket,
-                name=gs_path,
-                media_body=media,
-            ).execute()
-        response = request
 
         logger.info('Uploading file: %s to bucket: %s object: %s ' % (
             fileobject.name, bucket, gs_path
         ))
+        return self.__upload_media(bucket, gs_path, media, public)
+
+    @instrumented('upload_data')
+    def upload_data(
+            self,
+            bucket,
+            data,
+            name,
+            mimetype=DEFAULT_MIMETYPE,
+            public=False,
+            resumable=None,
+            chunksize=CHUNKSIZE
+    ):
+        '''Upload data held in memory or read from a stream, no temporary
+        file is written. Bytes, bytearray, memoryview, mmap and other buffers
+        are sent without being copied. Seekable streams, e.g. BytesIO, are
+        read chunk by chunk and other streams are uploaded by upload_stream.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param data: Buffer or object with read(size) method
+        :type data: buffer
+        :param name: Name of the object in google storage
+        :type name: str
+        :param mimetype: type of the data to store.
+        :type mimetype: str
+        :param public: If you want data to be public or not.
+        :type public: bool
+        :param resumable: Upload in chunks which are retried separately. If
+                          None data bigger than RESUMABLE_THRESHOLD is
+                          uploaded in chunks.
+        :type resumable: bool
+        :param chunksize: Size of the chunk, multiple of 256KB.
+        :type chunksize: int
+        :retunrs: Response JSON str
+        :rtype: json
+        '''
+        mimetype = mimetype or DEFAULT_MIMETYPE
+        if hasattr(data, 'read'):
+            size = stream_size(data)
+            if size is None:
+                return self.upload_stream(
+                    bucket, data, name, mimetype, public, chunksize
+                )
+            from googleapiclient.http import MediaIoBaseUpload
+            if resumable is None:
+                resumable = size > RESUMABLE_THRESHOLD
+            media = MediaIoBaseUpload(
+                data, mimetype=mimetype, chunksize=chunksize,
+                resumable=resumable
+            )
+        else:
+            from google_storage.core.streams import BufferMediaUpload
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            if not isinstance(data, memoryview):
+                data = buffer(data)
+            if resumable is None:
+                resumable = len(data) > RESUMABLE_THRESHOLD
+            media = BufferMediaUpload(data, mimetype, chunksize, resumable)
+
+        logger.info('Uploading data to bucket: %s object: %s' % (
+            bucket, name
+        ))
+        return self.__upload_media(bucket, name, media, public)
+
+    def __upload_media(self, bucket, name, media, public):
+        '''Insert object with media, in chunks if it's resumable.
+        '''
+        kwargs = {}
+        if public:
+            kwargs['predefinedAcl'] = "publicRead"
+        request = self.service.objects().insert(
+            bucket=bucket,
+            name=name,
+            media_body=media,
+            **kwargs
+        )
+
+        op = self.current_operation
+        if media.resumable():
+            response = self.__execute_resumable(request)
+        else:
+            response = self.execute(request, 'upload')
+            op.add_chunks()
+        op.add_bytes(media.size())
+
+        logger.info('Upload complete: %s' % name)
+        return response
+
+    @instrumented('upload_stream')
+    def upload_stream(
+            self,
+            bucket,
+            stream,
+            name,
+            mimetype=DEFAULT_MIMETYPE,
+            public=False,
+            chunksize=CHUNKSIZE
+    ):
+        '''Upload data of unknown size read from a stream as resumable
+        upload. Only a couple of chunks are held in memory at a time.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param stream: Object with read(size) method
+        :type stream: file
+        :param name: Name of the object in google storage
+        :type name: str
+        :param mimetype: type of the data to store.
+        :type mimetype: str
+        :param public: If you want data to be public or not.
+        :type public: bool
+        :param chunksize: Size of the chunk, multiple of 256KB.
+        :type chunksize: int
+        :retunrs: Response JSON str
+        :rtype: json
+        '''
+
+        logger.info('Streaming upload to bucket: %s object: %s' % (
+            bucket, name
+        ))
+        from google_storage.core.streams import StreamMediaUpload
+        media = StreamMediaUpload(
+            stream, mimetype or DEFAULT_MIMETYPE, chunksize
+        )
+        kwargs = {}
+        if public:
+            kwargs['predefinedAcl'] = "publicRead"
+        request = self.service.objects().insert(
+            bucket=bucket,
+            name=name,
+            media_body=media,
+            **kwargs
+        )
+        response = self.__execute_resumable(request)
+        self.current_operation.add_bytes(int(response.get('size', 0)))
+
+        logger.info('Uploaded Object: %s' % name)
+        return response
+
+    @instrumented('upload_composite')
+    def upload_composite(
+            self,
+            bucket,
+            fileobject,
+            location='',
+            mimetype='text/plain',
+            public=False,
+            parts=COMPOSITE_PARTS,
+            chunksize=CHUNKSIZE,
+            name=None
+    ):
+        '''Upload file as parts in parallel and compose them into a single
+        object. Temporary part objects are removed afterwards, also when
+        upload fails. CRC32C of every part is computed while it's uploaded
+        and verified against the stored part, which is slow without crcmod
+        C extension. Composed object is verified with CRC32C combined from
+        the parts and removed when it doesn't match.
+        :param bucket: Name of the bucket in google storage to access
+        :type bucket: str
+        :param fileobject: File to store in google storage.
+        :type fileobject: file
+        :param location: Location in google storage bucket to store object
+        :type location: str
+        :param mimetype: type of the data to store.
+        :type mimetype: str
+        :param public: If you want data to be public or not.
+        :type public: bool
+        :param parts: Number of parts uploaded concurrently.
+        :type parts: int
+        :param chunksize: Size of the chunk for resumable part uploads.
+        :type chunksize: int
+        :param name: Object name, location joined with the file name if None
+        :type name: str
+        :retunrs: Response JSON str
+        :rtype: json
+        :raises: ChecksumError if uploaded part or composed object doesn't
+                 match the file
+        '''
+
+        from googleapiclient.http import MediaIoBaseUpload
+
+        if not FAST_CRC32C:
+            logger.warning(
+                "crcmod C extension isn't installed, CRC32C of %s is "
+                "computed in python" % fileobject.name
+            )
+
+        path = fileobject.name
+        gs_path = name or os.path.join(location, os.path.split(path)[1])
+        size = os.path.getsize(path)
+        parts = max(1, min(parts, MAX_COMPOSE_SOURCES))
+        part_size = max(1, -(-size // parts))
+        if not mimetype:
+            mimetype = mimetypes.guess_type(path)[0] or DEFAULT_MIMETYPE
+
+        prefix = '%s.part-%s' % (gs_path, uuid.uuid4().hex)
+        slices = [
+            ('%s-%03d' % (prefix, i), offset, min(part_size, size - offset))
+            for i, offset in enumerate(xrange(0, size, part_size))
+        ]
+
+        def upload_part(item):
+            name, offset, length = item
+            with _Crc32cSlice(path, offset, length) as part:
+                resumable = length > RESUMABLE_THRESHOLD
+                media = MediaIoBaseUpload(
+                    part, mimetype=DEFAULT_MIMETYPE, chunksize=chunksize,
+                    resumable=resumable
+                )
+                request = self.service.objects().insert(
+                    bucket=bucket, name=name, media_body=media
+                )
+                if resumable:
+                    response = self.__execute_resumable(request)
+                else:
+                    response = self.execute(request, 'upload')
+                    self.current_operation.add_chunks()
+                expected = part.b64digest()
+            if response.get('crc32c') != expected:
+                raise ChecksumError(
+                    "CRC32C mismatch for %s/%s: %s != %s" % (
+                        bucket, name, response.get('crc32c'), expected
+                    )
+                )
+            return part.crc.value()
+
+        logger.info('Uploading %s to %s/%s in %s parts' % (
+            path, bucket, gs_path, len(slices)
+        ))
+        crc = 0
+        try:
+            for (_, _, length), (value, error) in zip(slices, thread_map(
+                self.bind_operation(upload_part), slices, len(slices)
+            )):
+                if error is not None:
+                    raise error
+                crc = crc32c_combine(crc, value, length)
+            self.current_operation.add_bytes(size)
+
+            kwargs = {}
+            if public:
+                kwargs['destinationPredefinedAcl'] = 'publicRead'
+            response = self.execute(self.service.objects().compose(
+                destinationBucket=bucket,
+                destinationObject=gs_path,
+                body={
+                    'sourceObjects': [{'name': n} for n, _, _ in slices],
+                    'destination': {'contentType': mimetype},
+                },
+                **kwargs
+            ), 'compose')
+        finally:
+            try:
+                self.execute_batch(dict(
+                    (name, self.service.objects().delete(
+                        bucket=bucket, object=name
+                    ))
+                    for name, _, _ in slices
+                ))
+            except Exception, e:
+                logger.warning("Failed to remove parts %s*: %s" % (
+                    prefix, e
+                ))
+
+        expected = crc32c_b64digest(crc)
+        if response.get('crc32c') != expected:
+            try:
+                self.execute(self.service.objects().delete(
+                    bucket=bucket, object=gs_path,
+                    generation=response['generation']
+                ), 'delete')
+            except Exception, e:
+                logger.warning("Failed to remove %s/%s: %s" % (
+                    bucket, gs_path, e
+                ))
+            raise ChecksumError(
+                "CRC32C mismatch for %s/%s: %s != %s" % (
+                    bucket, gs_path, response.get('crc32c'), expected
+                )
+            )
 
-        logger.info('\nUpload complete!')
-        logger.info('Uploaded Object: %s' % response)
+        logger.info('Composite upload complete: %s' % gs_path)
         return response
 
-    def download(self, bucket, object_name, fileout):
+    def __execute_resumable(self, request):
+        '''Send resumable upload chunk by chunk. Failed chunks are retried
+        without restarting the upload.
+        :param request: Upload request with resumable media
+        :type request: HttpRequest
+        :retunrs: Response JSON str
+        :rtype: json
+        '''
+
+        retrying = self.retrying('upload')
+        response = None
+        while response is None:
+            try:
+                progress, response = request.next_chunk()
+            except Exception, e:
+                retrying.failed(e)
+                continue
+
+            retrying.succeeded()
+            self.current_operation.add_chunks()
+            if progress:
+                logger.debug(
+                    'Upload %d%%' % (100 * progress.progress())
+                )
+
+        return response
+
+    @instrumented('copy')
+    def copy(
+        self, bucket, object_name, dest_bucket, dest_name=None,
+        generation=None, max_bytes_per_call=None
+    ):
+        '''Copy object inside google storage with rewrite, data never
+        leaves it. Large objects and copies across locations or storage
+        classes take several calls continued with the rewrite token, every
+        call is retried on its own.
+        :param bucket: Name of the source bucket
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param dest_bucket: Name of the destination bucket
+        :type dest_bucket: str
+        :param dest_name: Name of the copy, object_name if None
+        :type dest_name: str
+        :param generation: Copy this generation instead of the latest
+        :type generation: str
+        :param max_bytes_per_call: Bytes rewritten by a single call, chosen
+                                   by google storage if None
+        :type max_bytes_per_call: int
+        :retunrs: Resource of the copy
+        :rtype: json
+        '''
+        kwargs = {
+            'sourceBucket': bucket, 'sourceObject': object_name,
+            'destinationBucket': dest_bucket,
+            'destinationObject': dest_name or object_name, 'body': {},
+        }
+        if generation:
+            kwargs['sourceGeneration'] = generation
+        if max_bytes_per_call:
+            kwargs['maxBytesRewrittenPerCall'] = max_bytes_per_call
+
+        logger.info('Copying %s/%s to %s/%s' % (
+            bucket, object_name, dest_bucket, kwargs['destinationObject']
+        ))
+        op = self.current_operation
+        while True:
+            response = self.execute(
+                self.service.objects().rewrite(**kwargs), 'copy'
+            )
+            op.add_chunks()
+            if response['done']:
+                op.add_bytes(int(response['objectSize']))
+                return response['resource']
+            logger.debug('Copied %s of %s bytes' % (
+                response['totalBytesRewritten'], response['objectSize']
+            ))
+            kwargs['rewriteToken'] = response['rewriteToken']
+
+    @instrumented('copy_prefix')
+    def copy_prefix(
+        self, bucket, prefix, dest_bucket, dest_prefix=None, max_workers=8
+    ):
+        '''Copy all objects with names starting with prefix inside google
+        storage, see copy. Objects are copied concurrently while the listing
+        is still being read.
+        :param bucket: Name of the source bucket
+        :type bucket: str
+        :param prefix: Copy objects with names starting with prefix
+        :type prefix: str
+        :param dest_bucket: Name of the destination bucket
+        :type dest_bucket: str
+        :param dest_prefix: Replaces prefix in names of the copies, prefix
+                            is kept if None
+        :type dest_prefix: str
+        :param max_workers: Number of concurrent copies
+        :type max_workers: int
+        :retunrs: Resources of the copies keyed by source name
+        :rtype: dict
+        '''
+        if dest_prefix is None:
+            dest_prefix = prefix
+
+        def copy_one(item):
+            name = item['name']
+            return name, self.copy(
+                bucket, name, dest_bucket, dest_prefix + name[len(prefix):],
+                generation=item['generation']
+            )
+
+        copies = {}
+        for result, error in thread_map(
+            self.bind_operation(copy_one),
+            self.iter_bucket_content(
+                bucket, prefix=prefix, fields='name,generation'
+            ),
+            max_workers
+        ):
+            if error is not None:
+                raise error
+            name, resource = result
+            copies[name] = resource
+
+        logger.info('Copied %s objects from %s/%s to %s/%s' % (
+            len(copies), bucket, prefix, dest_bucket, dest_prefix
+        ))
+        return copies
+
+    @instrumented('download')
+    def download(
+        self, bucket, object_name, fileout, sliced_threshold=None,
+        slices=DOWNLOAD_SLICES, generation=None
+    ):
         '''Download object from a given bucket and store in fileout..
         :param bucket: Name of the bucket.
         :type bucket: str
@@ -368,41 +1806,441 @@ class GSStorageHandler(GSHandler):
         :type object_name: str
         :param fileout: File to store the object as
         :type fileout: file
+        :param sliced_threshold: Objects bigger than this are downloaded
+                                 as concurrent slices, unless they have
+                                 only CRC32C and crcmod C extension isn't
+                                 installed.
+        :type sliced_threshold: int
+        :param slices: Number of concurrent slices
+        :type slices: int
+        :param generation: Download this generation instead of the latest
+        :type generation: str
         :retunrs: Returnf fileout file object
         :rtype: file
         '''
 
+        kwargs = {}
+        if generation:
+            kwargs['generation'] = generation
+
+        if sliced_threshold:
+            details = self.object_details(
+                bucket, object_name, fields='size,generation,crc32c,md5Hash',
+                **kwargs
+            )
+            sliced = int(details['size']) > sliced_threshold
+            if sliced and checksum_field(details) == 'crc32c' and (
+                not FAST_CRC32C
+            ):
+                logger.warning(
+                    "crcmod C extension isn't installed, downloading %s/%s "
+                    "as single stream" % (bucket, object_name)
+                )
+                sliced = False
+            if sliced:
+                return self.download_sliced(
+                    bucket, object_name, fileout, slices, details
+                )
+
         logger.info('Building download request...')
         request = self.service.objects().get_media(
-            bucket=bucket, object=object_name
+            bucket=bucket, object=object_name, **kwargs
         )
-        logger.info(request)
 
+        from googleapiclient.http import MediaIoBaseDownload
         media = MediaIoBaseDownload(fileout, request, chunksize=CHUNKSIZE)
 
         logger.info('Downloading bucket: %s object: %s to file: %s' % (
             bucket, object_name, fileout.name
         ))
 
-        progressless_iters = 0
+        op = self.current_operation
+        retrying = self.retrying('download')
+        progress = None
         done = False
         while not done:
-            error = None
             try:
-                progress, done = media.next_chunk(num_retries=NUM_RETRIES)
-            except HttpError, err:
-                error = err
-                if err.resp.status < 500 and err.resp.status != 416:
-                    raise
-            except RETRYABLE_ERRORS, err:
-                error = err
-
-            if error:
-                progressless_iters += 1
-                self.__handle_progressless_iter(error, progressless_iters)
-            else:
-                progressless_iters = 0
+                progress, done = media.next_chunk()
+            except HttpError, e:
+                if e.resp.status == 416 and progress is None:
+                    # Range of an empty object isn't satisfiable
+                    break
+                retrying.failed(e)
+                continue
+            except Exception, e:
+                retrying.failed(e)
+                continue
+
+            retrying.succeeded()
+            op.add_chunks()
+
+        op.add_bytes(progress.resumable_progress if progress else 0)
+        logger.info('\nDownload complete!')
+
+        return fileout
+
+    @instrumented('download_sliced')
+    def download_sliced(
+        self, bucket, object_name, fileout, slices=DOWNLOAD_SLICES,
+        details=None
+    ):
+        '''Download object as concurrent byte ranges written straight into
+        their place in fileout. Every range is retried on its own and the
+        whole file is verified with checksum at the end.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param fileout: File on disk to store the object as
+        :type fileout: file
+        :param slices: Number of concurrent slices
+        :type slices: int
+        :param details: Object resource with size, generation and checksums
+        :type details: dict
+        :retunrs: Returnf fileout file object
+        :rtype: file
+        :raises: ChecksumError if downloaded file doesn't match the object
+        '''
 
+        if details is None:
+            details = self.object_details(
+                bucket, object_name, fields='size,generation,crc32c,md5Hash'
+            )
+        size = int(details['size'])
+
+        fileout.seek(0)
+        fileout.truncate(size)
+        fileout.flush()
+
+        logger.info('Downloading bucket: %s object: %s to file: %s in %s '
+                    'slices' % (bucket, object_name, fileout.name, slices))
+
+        if size:
+            fd = os.open(fileout.name, os.O_RDWR)
+            try:
+                mapping = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            try:
+                self.__download_ranges(
+                    bucket, object_name, details, mapping, slices
+                )
+                mapping.flush()
+            finally:
+                mapping.close()
+
+        fileout.seek(0)
         logger.info('\nDownload complete!')
 
         return fileout
+
+    @instrumented('download_into')
+    def download_into(
+        self, bucket, object_name, buf=None, generation=None,
+        slices=DOWNLOAD_SLICES
+    ):
+        '''Download object into memory. Ranges are written straight into
+        their place in buf, the data isn't copied through a file. Checksum
+        is verified at the end.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param buf: Writable bytearray, mmap or memoryview at least as big
+                    as the object, bytearray of object size if None.
+        :type buf: bytearray
+        :param generation: Download this generation instead of the latest
+        :type generation: str
+        :param slices: Number of concurrent ranges
+        :type slices: int
+        :retunrs: Memoryview of the object data in buf, read-only buffer for
+                  mmap which doesn't support memoryview.
+        :rtype: memoryview
+        :raises: ChecksumError if downloaded data doesn't match the object
+        '''
+        kwargs = {}
+        if generation:
+            kwargs['generation'] = generation
+        details = self.object_details(
+            bucket, object_name, fields='size,generation,crc32c,md5Hash',
+            **kwargs
+        )
+        size = int(details['size'])
+        if buf is None:
+            buf = bytearray(size)
+        elif len(buf) < size:
+            raise ValueError(
+                "Buffer of %s bytes is smaller than %s/%s of %s bytes" % (
+                    len(buf), bucket, object_name, size
+                )
+            )
+
+        logger.info('Downloading bucket: %s object: %s to memory' % (
+            bucket, object_name
+        ))
+        self.__download_ranges(bucket, object_name, details, buf, slices)
+
+        if isinstance(buf, mmap.mmap):
+            return buffer(buf, 0, size)
+        return memoryview(buf)[:size]
+
+    @instrumented('download_mmap')
+    def download_mmap(
+        self, bucket, object_name, fileout, generation=None,
+        slices=DOWNLOAD_SLICES
+    ):
+        '''Download object into a file and map it read-only, so it can be
+        parsed straight from the page cache.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param fileout: File on disk to store the object as
+        :type fileout: file
+        :param generation: Download this generation instead of the latest
+        :type generation: str
+        :param slices: Number of concurrent ranges
+        :type slices: int
+        :retunrs: Read-only map of the file, empty str for empty object
+                  which can't be mapped. Close it when done.
+        :rtype: mmap.mmap
+        :raises: ChecksumError if downloaded data doesn't match the object
+        '''
+        kwargs = {}
+        if generation:
+            kwargs['generation'] = generation
+        details = self.object_details(
+            bucket, object_name, fields='size,generation,crc32c,md5Hash',
+            **kwargs
+        )
+        self.download_sliced(bucket, object_name, fileout, slices, details)
+        if not int(details['size']):
+            return ''
+
+        fd = os.open(fileout.name, os.O_RDONLY)
+        try:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+    def __download_ranges(self, bucket, object_name, details, buf, slices):
+        '''Download object as concurrent byte ranges written into their place
+        in buf. Every range is retried on its own and the data is verified
+        at the end with MD5, or with CRC32C for composite objects unless
+        crcmod C extension is missing.
+        '''
+        size = int(details['size'])
+        # Objects smaller than a chunk per slice aren't split further
+        slices = max(1, min(slices, -(-size // CHUNKSIZE)))
+        slice_size = max(1, -(-size // slices))
+
+        def download_slice(offset):
+            end = min(offset + slice_size, size)
+            retrying = self.retrying('download')
+            while offset < end:
+                length = min(CHUNKSIZE, end - offset)
+                buf[offset:offset + length] = self.__fetch_range(
+                    bucket, object_name, details['generation'], offset,
+                    length, retrying
+                )
+                offset += length
+
+        for resp, error in thread_map(
+            self.bind_operation(download_slice), xrange(0, size, slice_size),
+            slices
+        ):
+            if error is not None:
+                raise error
+
+        field = checksum_field(details)
+        if field == 'crc32c' and not FAST_CRC32C:
+            logger.warning(
+                "crcmod C extension isn't installed, %s/%s isn't verified" % (
+                    bucket, object_name
+                )
+            )
+            return
+        if field is not None:
+            checksum = data_checksums(buf, 0, size, (field,))[field]
+            if details[field] != checksum:
+                raise ChecksumError(
+                    "%s mismatch for %s/%s: %s != %s" % (
+                        field, bucket, object_name, details[field], checksum
+                    )
+                )
+
+    def __fetch_range(
+        self, bucket, object_name, generation, offset, length, retrying
+    ):
+        '''Fetch length bytes of the object generation from offset. Response
+        of other length is retried as incomplete.
+        '''
+        op = self.current_operation
+        kwargs = {}
+        if generation:
+            kwargs['generation'] = generation
+        while True:
+            request = self.service.objects().get_media(
+                bucket=bucket, object=object_name, **kwargs
+            )
+            request.headers['range'] = 'bytes=%d-%d' % (
+                offset, offset + length - 1
+            )
+            try:
+                data = request.execute()
+                if len(data) != length:
+                    raise httplib.IncompleteRead(data, length - len(data))
+            except Exception, e:
+                retrying.failed(e)
+                continue
+
+            retrying.succeeded()
+            op.add_chunks()
+            op.add_bytes(length)
+            return data
+
+    @instrumented('download_range')
+    def download_range(
+        self, bucket, object_name, offset, length, generation=None
+    ):
+        '''Download length bytes of the object from offset.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param offset: First byte of the range
+        :type offset: int
+        :param length: Number of bytes, range must be within the object
+        :type length: int
+        :param generation: Download this generation instead of the latest
+        :type generation: str
+        :retunrs: Bytes of the range
+        :rtype: str
+        '''
+        if not length:
+            return ''
+        return self.__fetch_range(
+            bucket, object_name, generation, offset, length,
+            self.retrying('download')
+        )
+
+    @instrumented('open')
+    def open(
+        self, bucket, object_name, generation=None,
+        chunksize=READ_CHUNKSIZE, readahead=READAHEAD,
+        cache_chunks=READ_CACHE_CHUNKS
+    ):
+        '''Open object for reading as a seekable buffered file. Data is
+        fetched in ranges when read, sequential reads fetch ahead. Reads
+        stay on the generation current when opened, once it's overwritten
+        they fail with 404 unless the bucket keeps old versions. Checksum
+        isn't verified, use download_into to verify.
+        :param bucket: Name of the bucket.
+        :type bucket: str
+        :param object_name: path to the item in google storage
+        :type object_name: str
+        :param generation: Read this generation instead of the latest
+        :type generation: str
+        :param chunksize: Size of ranges fetched and cached
+        :type chunksize: int
+        :param readahead: Maximum bytes fetched ahead on sequential reads
+        :type readahead: int
+        :param cache_chunks: Chunks cached for random reads
+        :type cache_chunks: int
+        :retunrs: Read-only file object
+        :rtype: google_storage.core.streams.ObjectReader
+        '''
+        kwargs = {}
+        if generation:
+            kwargs['generation'] = generation
+        details = self.object_details(
+            bucket, object_name, fields='size,generation', **kwargs
+        )
+
+        def fetch(offset, length):
+            with self.operation('read', bucket):
+                return self.__fetch_range(
+                    bucket, object_name, details['generation'], offset,
+                    length, self.retrying('download')
+                )
+
+        from google_storage.core.streams import ObjectReader
+        return ObjectReader(
+            fetch, int(details['size']), '%s/%s' % (bucket, object_name),
+            chunksize, readahead, cache_chunks
+        )
+
+
+class HandlerRegistry(object):
+    '''Process wide registry of storage handlers keyed by json key path and
+    scope. Authentication and service discovery happen once per key.
+    '''
+
+    def __init__(self, handler_class=GSStorageHandler, metrics=None):
+        '''Constructor
+        :param handler_class: Class used to create new handlers
+        :type handler_class: type
+        :param metrics: Instrumentation given to new handlers
+        :type metrics: google_storage.core.metrics.Metrics
+        '''
+        self.handler_class = handler_class
+        self.metrics = metrics
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def get(self, json_key_path=None, scope=STORAGE_SCOPE):
+        '''Get shared handler, creating it on first use.
+        :param json_key_path: path to the stored json_key
+        :type json_key_path: str
+        :param scope: authentication scope
+        :type scope: str
+        :retunrs: Shared handler
+        :rtype: GSStorageHandler
+        '''
+        if not json_key_path:
+            json_key_path = GSHandler.get_json_key_path()
+
+        key = (os.path.abspath(json_key_path), scope)
+        with self._lock:
+            handler = self._handlers.get(key)
+            if handler is None:
+                logger.info("Creating shared handler for %s %s" % key)
+                handler = self.handler_class(
+                    json_key_path, scope, metrics=self.metrics
+                )
+                self._handlers[key] = handler
+            return handler
+
+    def invalidate(self, json_key_path=None, scope=None):
+        '''Close and forget handlers. Next get will create a new handler.
+        :param json_key_path: path to the stored json_key, all if None
+        :type json_key_path: str
+        :param scope: authentication scope, all if None
+        :type scope: str
+        '''
+        with self._lock:
+            keys = [
+                k for k in self._handlers
+                if (
+                    json_key_path is None or
+                    k[0] == os.path.abspath(json_key_path)
+                ) and (scope is None or k[1] == scope)
+            ]
+            handlers = [self._handlers.pop(k) for k in keys]
+
+        for handler in handlers:
+            handler.close()
+
+    def close(self):
+        '''Close and forget all registered handlers.
+        '''
+        self.invalidate()
+
+
+registry = HandlerRegistry()
+
+
+def get_storage_handler(json_key_path=None, scope=STORAGE_SCOPE):
+    '''Shortcut for getting a handler from the process wide registry.
+    '''
+    return registry.get(json_key_path, scope)
@@ -32,11 +32,19 @@ setuptools.setup(
         'google-api-python-client==1.4.1',
         'pycrypto'
     ],
+    extras_require={
+        'crc': ['crcmod'],
+        'zstd': ['zstandard'],
+        'lz4': ['lz4']
+    },
     cmdclass={
         'test': PyTest
     },
     author_email='development@pathintel.com',
     description='Wrapper for python interfaces to GCS',
     include_package_data=True,
+    package_data={
+        'google_storage.core': ['discovery/*.json']
+    },
     packages=setuptools.find_packages()
 )
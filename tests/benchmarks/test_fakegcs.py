@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+import pytest
+
+from googleapiclient.errors import HttpError
+
+TEST_BUCKET_NAME = u"pi-test-bucket"
+
+
+@pytest.mark.parametrize('size', [0, 1000, 9 * 1024 * 1024 + 17])
+def test_upload_download(fake_gcs, size):
+    gs = fake_gcs.handler()
+    data = os.urandom(size)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        resp = gs.upload(TEST_BUCKET_NAME, f, 'dir')
+
+    assert resp['size'] == str(size)
+    assert fake_gcs.get_object(TEST_BUCKET_NAME, resp['name'])[1] == data
+
+    with tempfile.NamedTemporaryFile() as out:
+        gs.download(TEST_BUCKET_NAME, resp['name'], out)
+        out.seek(0)
+        assert out.read() == data
+
+
+def test_upload_composite_download_sliced(fake_gcs):
+    gs = fake_gcs.handler()
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        resp = gs.upload(TEST_BUCKET_NAME, f, composite_threshold=1024)
+
+    assert resp['componentCount'] == 8
+    assert fake_gcs.buckets[TEST_BUCKET_NAME].names == [resp['name']]
+
+    with tempfile.NamedTemporaryFile() as out:
+        gs.download(TEST_BUCKET_NAME, resp['name'], out, sliced_threshold=1)
+        out.seek(0)
+        assert out.read() == data
+
+
+def test_list_pages(fake_gcs):
+    gs = fake_gcs.handler()
+    for i in xrange(25):
+        fake_gcs.add_object(TEST_BUCKET_NAME, 'a/%02d' % i, 'x')
+        fake_gcs.add_object(TEST_BUCKET_NAME, 'a/sub%d/x' % (i % 3), 'x')
+
+    names = [
+        o['name'] for o in gs.iter_bucket_content(
+            TEST_BUCKET_NAME, prefix='a/', delimiter='/', page_size=10
+        )
+    ]
+    assert names == ['a/%02d' % i for i in xrange(25)]
+
+    pages = list(gs.iter_bucket_pages(
+        TEST_BUCKET_NAME, prefix='a/', delimiter='/', fields='name',
+        page_size=10
+    ))
+    assert len(pages) == 3
+    assert pages[-1]['prefixes'] == ['a/sub0/', 'a/sub1/', 'a/sub2/']
+    assert pages[0]['items'][0] == {'name': 'a/00'}
+
+
+def test_injected_errors_retried(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    gs = fake_gcs.handler()
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'x', 'x')
+
+    fake_gcs.inject_errors(3)
+    with tempfile.NamedTemporaryFile() as out:
+        gs.download(TEST_BUCKET_NAME, 'x', out)
+        out.seek(0)
+        assert out.read() == 'x'
+    assert fake_gcs.stats['errors'] == 3
+
+    fake_gcs.inject_errors(1, status=404)
+    with pytest.raises(HttpError):
+        gs.object_details(TEST_BUCKET_NAME, 'x')
+
+
+def test_delete_batches(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    gs = fake_gcs.handler()
+    for i in xrange(250):
+        fake_gcs.add_object(TEST_BUCKET_NAME, 'd/%03d' % i, '')
+
+    fake_gcs.error_rate = 0.05
+    summary = gs.delete_objects(
+        TEST_BUCKET_NAME, ['d/%03d' % i for i in xrange(260)]
+    )
+    assert summary == {'deleted': 250, 'missing': 10, 'failed': 0}
+    assert fake_gcs.buckets[TEST_BUCKET_NAME].names == []
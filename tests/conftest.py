@@ -10,6 +10,8 @@ import pytest
 
 import google_storage.core.utils as gh
 
+from benchmarks.fakegcs import FakeGCS
+
 module_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, module_path + '/../')
 
@@ -57,6 +59,15 @@ def test_bucket(request, google_auth_key_path):
     request.addfinalizer(fin)
 
 
+@pytest.fixture(scope="function")
+def fake_gcs(request):
+    fake = FakeGCS().start()
+    fake.add_bucket(TEST_BUCKET_NAME)
+
+    request.addfinalizer(fake.stop)
+    return fake
+
+
 @pytest.fixture(scope="function")
 def dummy_file(request):
     f = tempfile.NamedTemporaryFile()
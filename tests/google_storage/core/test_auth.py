@@ -0,0 +1,110 @@
+import json
+import time
+import datetime
+import threading
+
+import pytest
+
+from oauth2client.client import OAuth2Credentials
+
+import google_storage.core.auth as auth
+
+
+class FakeCredentials(auth.SharedToken, OAuth2Credentials):
+    '''Credentials exchanging tokens without network.
+    '''
+
+    def __init__(self, client_email, private_key, scope, lifetime=3600):
+        super(FakeCredentials, self).__init__(
+            None, None, None, None, None, None, None
+        )
+        self._init_shared()
+        self.client_email = client_email
+        self.lifetime = lifetime
+        self.exchanges = 0
+
+    def _do_refresh_request(self, http_request):
+        time.sleep(0.05)
+        self.exchanges += 1
+        self.access_token = 'token-%d' % self.exchanges
+        self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=self.lifetime
+        )
+
+
+@pytest.fixture
+def key_path(tmpdir):
+    path = tmpdir.join('key.json')
+    path.write(json.dumps({
+        'client_email': 'svc@example.com', 'private_key': 'pem'
+    }))
+    return str(path)
+
+
+def test_cache_shares_credentials(key_path, monkeypatch):
+    cache = auth.TokenCache(FakeCredentials)
+    opened = []
+    real_open = open
+
+    def counting_open(*args, **kwargs):
+        f = real_open(*args, **kwargs)
+        opened.append(f)
+        return f
+
+    monkeypatch.setattr('__builtin__.open', counting_open)
+    a = cache.get(key_path, 'devstorage.full_control')
+    b = cache.get(key_path, 'devstorage.full_control')
+    c = cache.get(key_path, 'devstorage.read_only')
+    monkeypatch.undo()
+
+    assert a is b
+    assert a is not c
+    assert a.client_email == 'svc@example.com'
+    assert len(opened) == 1
+    assert opened[0].closed
+
+
+def test_single_flight_refresh():
+    credentials = FakeCredentials('svc@example.com', 'pem', 'scope')
+    headers = []
+
+    def request():
+        h = {}
+        if not credentials.access_token:
+            credentials._refresh(None)
+        credentials.apply(h)
+        headers.append(h['Authorization'])
+
+    threads = [threading.Thread(target=request) for i in xrange(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert credentials.exchanges == 1
+    assert set(headers) == set(['Bearer token-1'])
+
+
+def test_refresh_before_expiry():
+    credentials = FakeCredentials(
+        'svc@example.com', 'pem', 'scope', lifetime=auth.REFRESH_MARGIN - 10
+    )
+    credentials._refresh(None)
+
+    # Token still valid long enough is used while refreshed in background
+    headers = {}
+    credentials.apply(headers)
+    assert headers['Authorization'] == 'Bearer token-1'
+    for i in xrange(100):
+        if credentials.exchanges == 2:
+            break
+        time.sleep(0.01)
+    assert credentials.exchanges == 2
+
+    # Token about to expire is refreshed before use
+    credentials.lifetime = auth.MIN_TOKEN_LIFETIME - 10
+    credentials._refresh(None)
+    credentials.lifetime = 3600
+    headers = {}
+    credentials.apply(headers)
+    assert headers['Authorization'] == 'Bearer token-4'
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from google_storage.core.cache import DownloadCache
+
+
+class FakeStorage(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+
+    def object_details(self, bucket, name, fields=None):
+        return {'generation': self.objects[name][0]}
+
+    def download(self, bucket, name, fileout, generation=None, **kwargs):
+        assert generation == self.objects[name][0]
+        self.downloads += 1
+        fileout.write(self.objects[name][1])
+        return fileout
+
+
+@pytest.fixture(scope='function')
+def cache_dir(request):
+    path = tempfile.mkdtemp()
+
+    def fin():
+        shutil.rmtree(path)
+    request.addfinalizer(fin)
+
+    return path
+
+
+def test_cache_hit(cache_dir):
+    gs = FakeStorage({'a.json': ('1', '{"a": 1}')})
+    cache = DownloadCache(cache_dir)
+
+    assert cache.get(gs, 'bucket', 'a.json').read() == '{"a": 1}'
+    assert cache.get(gs, 'bucket', 'a.json').read() == '{"a": 1}'
+    assert gs.downloads == 1
+
+
+def test_cache_new_generation(cache_dir):
+    gs = FakeStorage({'a.json': ('1', 'old')})
+    cache = DownloadCache(cache_dir)
+    cache.get(gs, 'bucket', 'a.json')
+
+    gs.objects['a.json'] = ('2', 'new')
+    with tempfile.NamedTemporaryFile() as f:
+        assert cache.get(gs, 'bucket', 'a.json', f) is f
+        assert f.read() == 'new'
+
+    assert gs.downloads == 2
+    assert not os.path.exists(cache.entry_path('bucket', 'a.json', '1'))
+
+
+def test_cache_eviction(cache_dir):
+    gs = FakeStorage(dict(
+        ('%s.csv' % i, ('1', 'x' * 10)) for i in xrange(3)
+    ))
+    cache = DownloadCache(cache_dir, max_bytes=25)
+
+    cache.get(gs, 'bucket', '0.csv')
+    cache.get(gs, 'bucket', '1.csv')
+    os.utime(cache.entry_path('bucket', '0.csv', '1'), (0, 0))
+    os.utime(cache.entry_path('bucket', '1.csv', '1'), (1, 1))
+    cache.get(gs, 'bucket', '2.csv')
+
+    assert not os.path.exists(cache.entry_path('bucket', '0.csv', '1'))
+    assert os.path.exists(cache.entry_path('bucket', '1.csv', '1'))
+    assert os.path.exists(cache.entry_path('bucket', '2.csv', '1'))
@@ -0,0 +1,160 @@
+import io
+import os
+import gzip
+import tarfile
+import datetime
+import tempfile
+
+import pytest
+
+import google_storage.core.compression as compression
+import google_storage.core.handlers as gs
+
+
+@pytest.mark.parametrize(
+    ('codec', 'size'),
+    [
+        ('gz', 0),
+        ('gz', 3 * 1024 * 1024 + 5),
+        ('pgz', 0),
+        ('pgz', 3 * 1024 * 1024 + 5),
+        ('zst', 3 * 1024 * 1024 + 5),
+        ('lz4', 3 * 1024 * 1024 + 5),
+    ]
+)
+def test_codec_roundtrip(codec, size):
+    if not compression.CODECS[codec].available():
+        pytest.skip("%s not installed" % codec)
+
+    content = (os.urandom(1024) + 'a' * 1024) * (size // 2048) + 'x' * (
+        size % 2048
+    )
+    with tempfile.TemporaryFile() as f:
+        with compression.get_codec(codec).compressor(f) as out:
+            for i in xrange(0, size, 10240):
+                out.write(content[i:i + 10240])
+
+        f.seek(0)
+        reader = compression.decompressor(f)
+        assert reader.read(100) + reader.read() == content
+
+        if codec in ('gz', 'pgz'):
+            f.seek(0)
+            assert gzip.GzipFile(fileobj=f, mode='rb').read() == content
+
+
+@pytest.mark.parametrize(
+    ('codec', 'expected'),
+    [
+        ('gz', '20140101010101.tar.gz'),
+        ('pgz', '20140101010101.tar.gz'),
+    ]
+)
+def test_make_tar_codec(google_auth_key_path, codec, expected):
+    with gs.Base(
+        "dummysite",
+        google_auth_key_path,
+        datetime.datetime(2014, 01, 01, 01, 01, 01),
+        archived=True
+    ) as gb:
+        gb.codec = codec
+        gb.store_local({"test": 123}, "test_file.json")
+        gb.make_tar()
+
+        assert os.listdir(gb.tmpdir) == [expected]
+
+        path = os.path.join(gb.tmpdir, expected)
+        with tarfile.open(path, "r:gz") as tar:
+            assert tar.getnames() == [
+                '20140101010101', '20140101010101/test_file.json'
+            ]
+
+        with open(path, 'rb') as f:
+            tar = compression.open_tar(f)
+            assert [m.name for m in tar] == [
+                '20140101010101', '20140101010101/test_file.json'
+            ]
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        compression.get_codec('rar')
+
+
+@pytest.mark.parametrize('codec', ['gz', 'pgz', 'zst', 'lz4'])
+def test_indexed_tar(tmpdir, codec):
+    if not compression.CODECS[codec].available():
+        pytest.skip("%s not installed" % codec)
+    root = tmpdir.mkdir('snapshot')
+    files = {
+        'a.csv': os.urandom(3000),
+        'sub/b.json': '{}',
+        'sub/empty': '',
+        'c.bin': os.urandom(9000),
+    }
+    root.mkdir('sub')
+    for name, data in files.items():
+        root.join(name).write(data, 'wb')
+
+    with tempfile.TemporaryFile() as f:
+        index = compression.write_indexed_tar(
+            f, str(root), 'snapshot', compression.get_codec(codec),
+            checkpoint_size=2048
+        )
+        f.seek(0)
+        archive = f.read()
+
+    assert index['codec'] == codec
+    assert sorted(index['members']) == sorted(
+        'snapshot/%s' % name for name in files
+    )
+    for name, data in files.items():
+        entry = index['members']['snapshot/%s' % name]
+        part = archive[entry['offset']:entry['offset'] + entry['length']]
+        assert compression.read_member(part, entry) == data
+        assert entry['length'] < len(archive) or name == 'c.bin'
+
+    # Concatenated frames are still a plain compressed tar
+    tar = compression.open_tar(io.BytesIO(archive))
+    assert sorted(m.name for m in tar if m.isreg()) == sorted(
+        index['members']
+    )
+    if codec in ('gz', 'pgz'):
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz') as tar:
+            assert tar.extractfile('snapshot/a.csv').read() == files['a.csv']
+
+    entry = dict(index['members']['snapshot/c.bin'])
+    with pytest.raises(IOError):
+        compression.read_member(archive[entry['offset']:][:100], entry)
+
+
+def test_parallel_gzip_shared_pool(monkeypatch, tmpdir):
+    pools = []
+
+    def thread_pool(workers):
+        pools.append(workers)
+        return ThreadPool(workers)
+
+    ThreadPool = compression.ThreadPool
+    monkeypatch.setattr(compression, 'ThreadPool', thread_pool)
+    codec = compression.ParallelGzipCodec(workers=2)
+    root = tmpdir.mkdir('snapshot')
+    for i in xrange(10):
+        root.join('%s.bin' % i).write(os.urandom(3000), 'wb')
+
+    archives = []
+    for i in xrange(2):
+        with tempfile.TemporaryFile() as f:
+            index = compression.write_indexed_tar(
+                f, str(root), 'snapshot', codec, checkpoint_size=2048
+            )
+            f.seek(0)
+            archives.append(f.read())
+
+    assert len(index['members']) == 10
+    assert len(set(
+        entry['offset'] for entry in index['members'].values()
+    )) > 5
+    assert pools == [2, 2]
+    assert archives[0] == archives[1]
+    assert archives[0][4:8] == '\x00\x00\x00\x00'
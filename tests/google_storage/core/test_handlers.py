@@ -1,14 +1,18 @@
+import io
 import os
 import urllib
 import datetime
 import logging
 import tempfile
 import json
+import tarfile
+import csv
 
 import pytest
 
 import google_storage.core.utils as gh
 import google_storage.core.handlers as gs
+import google_storage.core.aio as aio
 
 
 TEST_BUCKET_NAME = u"pi-test-bucket"
@@ -444,3 +448,381 @@ def test_store_gs(
         ))
 
         assert json.load(fs[0]) == content
+
+
+@pytest.mark.slow
+def test_shared_handler(google_auth_key_path):
+    with gs.Maps("dummysite", google_auth_key_path) as gm:
+        with gs.Lookups("dummysite", google_auth_key_path) as gl:
+            assert gm.gs is gl.gs
+
+            handler = gm.gs
+            gm.invalidate_gs()
+
+            assert gl.gs is handler
+            assert gm.gs is not handler
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_upload_concurrent(fake_gcs, map_files, max_workers):
+    with gs.Base("dummysite", None) as gm:
+        gm._gs = fake_gcs.handler()
+        gm.mimetype = 'image/svg+xml'
+        files = map_files + [('dummysite/%s/' % ts, '/no/such/file')]
+
+        with pytest.raises(gs.UploadError) as e:
+            gm.upload(files, TEST_BUCKET_NAME, max_workers=max_workers)
+
+        names = [r['name'] for r in e.value.responses[:-1]]
+        assert names == [
+            "dummysite/%s/%s" % (ts, os.path.split(f.name)[1])
+            for _, f in map_files
+        ]
+        assert [i[1] for i in e.value.errors] == ['/no/such/file']
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == sorted(names)
+
+
+@pytest.mark.parametrize(('ordered', 'max_bytes'), [
+    (True, None),
+    (False, 400),
+])
+def test_download_prefetch(fake_gcs, map_files, ordered, max_bytes):
+    expected = [f.read() for _, f in map_files]
+
+    with gs.Base("dummysite", None) as gm:
+        gm._gs = fake_gcs.handler()
+        gm.mimetype = 'image/svg+xml'
+        gm.upload(map_files, TEST_BUCKET_NAME)
+
+        files = [
+            (os.path.join(map_path, os.path.split(map_file.name)[1]), None)
+            for map_path, map_file in map_files
+        ]
+
+        out = [
+            f.read() for f in gm.download(
+                files, TEST_BUCKET_NAME, prefetch=3, ordered=ordered,
+                max_bytes=max_bytes
+            )
+        ]
+
+        if ordered:
+            assert out == expected
+        else:
+            assert sorted(out) == sorted(expected)
+
+
+def test_store_gs_stream(fake_gcs):
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    content = {"test": 123}
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+
+        gb.store_local(content, "test_file.json")
+
+        gb.store_gs(stream=True)
+
+        name = os.path.join(gb.get_location(), '20140101010101.tar.gz')
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == [name]
+        fs = list(gb.download([(name, None)]))
+        with tarfile.open(fileobj=fs[0], mode="r:gz") as tar:
+            f = tar.extractfile('20140101010101/test_file.json')
+            assert json.load(f) == content
+
+
+def test_store_gs_sync(fake_gcs):
+    with gs.Outputs("dummysite", None) as go:
+        go._gs = fake_gcs.handler()
+        go.bucket = TEST_BUCKET_NAME
+
+        go.store_local({"test": 1}, "a.json")
+        go.store_local({"test": 2}, "b.json")
+        go.store_gs()
+
+        go.store_local({"test": 3}, "b.json")
+        go.store_local([[1, 2]], "c.csv")
+        os.remove(os.path.join(go.tmpdir, "a.json"))
+
+        summary = go.store_gs(sync=True, delete=True)
+
+        assert summary['uploaded'] == ['dummysite/b.json', 'dummysite/c.csv']
+        assert summary['skipped'] == []
+        assert summary['deleted'] == ['dummysite/a.json']
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == [
+            'dummysite/b.json', 'dummysite/c.csv'
+        ]
+        assert json.loads(
+            fake_gcs.get_object(TEST_BUCKET_NAME, 'dummysite/b.json')[1]
+        ) == {"test": 3}
+
+        generation = fake_gcs.get_object(
+            TEST_BUCKET_NAME, 'dummysite/b.json'
+        )[0]['generation']
+        summary = go.store_gs(sync=True)
+        assert summary['uploaded'] == []
+        assert summary['skipped'] == ['dummysite/b.json', 'dummysite/c.csv']
+        assert fake_gcs.get_object(
+            TEST_BUCKET_NAME, 'dummysite/b.json'
+        )[0]['generation'] == generation
+
+
+def test_upload_download_async(fake_gcs, map_files):
+    expected = [f.read() for _, f in map_files]
+
+    with gs.Base("dummysite", None) as gm:
+        gm._gs = fake_gcs.handler()
+        gm.mimetype = 'image/svg+xml'
+        responses = aio.gather(gm.upload_async(map_files, TEST_BUCKET_NAME))
+
+        out = aio.gather(gm.download_async(
+            [(r['name'], None) for r in responses], TEST_BUCKET_NAME
+        ))
+
+        assert [f.read() for f in out] == expected
+
+
+def test_async_methods(fake_gcs):
+    for name, value in vars(gh.GSStorageHandler).iteritems():
+        if not name.startswith('_') and callable(value):
+            assert hasattr(aio.AsyncGSStorageHandler, name) == (
+                name not in aio.SYNC_ONLY
+            )
+    assert aio.SYNC_ONLY <= set(vars(gh.GSStorageHandler))
+
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', 'data')
+    with aio.AsyncGSStorageHandler(handler=fake_gcs.handler()) as handler:
+        stats, data = aio.gather([
+            handler.stat_many(TEST_BUCKET_NAME, ['obj', 'missing'], 'size'),
+            handler.download_range(TEST_BUCKET_NAME, 'obj', 1, 2),
+        ])
+    assert stats == {'obj': {'size': '4'}, 'missing': None}
+    assert data == 'at'
+
+
+def test_put_object(fake_gcs):
+    lookup = {'a': [1, 2]}
+    with gs.Lookups("dummysite", None) as gl:
+        gl._gs = fake_gcs.handler()
+        gl.bucket = TEST_BUCKET_NAME
+        json_resp = gl.put_object('lookup.json', lookup, location='loc')
+        csv_resp = gl.put_object('rows.csv', [[1, 'a'], [2, 'b']], 'loc')
+        raw_resp = gl.put_object('raw.bin', bytearray('\x00\x01'), 'loc')
+        with pytest.raises(ValueError):
+            gl.put_object('lookup.yaml', lookup, 'loc')
+
+        assert os.listdir(gl.tmpdir) == []
+
+    assert json_resp['name'] == 'loc/lookup.json'
+    assert json_resp['contentType'] == 'text/json'
+    assert json.loads(
+        fake_gcs.get_object(TEST_BUCKET_NAME, 'loc/lookup.json')[1]
+    ) == lookup
+    assert fake_gcs.get_object(
+        TEST_BUCKET_NAME, 'loc/rows.csv'
+    )[1] == '1,a\r\n2,b\r\n'
+    assert raw_resp['size'] == '2'
+
+    with gs.Lookups("dummysite", None) as gl:
+        gl._gs = fake_gcs.handler()
+        gl.bucket = TEST_BUCKET_NAME
+        view = gl.get_object('lookup.json', 'loc')
+        assert json.loads(view.tobytes()) == lookup
+        with gl.open_object('rows.csv', 'loc') as f:
+            assert list(csv.reader(f)) == [['1', 'a'], ['2', 'b']]
+
+
+@pytest.mark.parametrize('codec', ['gz', 'zst'])
+def test_restore(fake_gcs, tmpdir, codec):
+    if not gs.compression.get_codec(codec).available():
+        pytest.skip("%s isn't installed" % codec)
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        gb.codec = codec
+        gb.store_local({"test": 123}, "test_file.json")
+        gb.store_local([[1, 2]], "rows.csv")
+        gb.store_gs(stream=True)
+
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        assert sorted(gb.restore()) == [
+            '20140101010101', '20140101010101/rows.csv',
+            '20140101010101/test_file.json'
+        ]
+        with open(os.path.join(gb.archive_path(), 'test_file.json')) as f:
+            assert json.load(f) == {"test": 123}
+
+        path = str(tmpdir)
+        extracted = gb.restore(
+            path, members=lambda m: m.name.endswith('.csv')
+        )
+        assert extracted == ['20140101010101/rows.csv']
+        assert os.listdir(os.path.join(path, '20140101010101')) == [
+            'rows.csv'
+        ]
+
+
+def test_restore_skips_outside_members(fake_gcs, tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name in ('../evil', '/abs', 'ok'):
+            info = tarfile.TarInfo(name)
+            info.size = 2
+            tar.addfile(info, io.BytesIO('hi'))
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        fake_gcs.add_object(
+            TEST_BUCKET_NAME,
+            os.path.join(gb.get_location(), '20140101010101.tar.gz'),
+            data.getvalue()
+        )
+        path = str(tmpdir.mkdir('out'))
+        assert gb.restore(path) == ['ok']
+    assert os.listdir(str(tmpdir)) == ['out']
+
+
+def test_restore_skips_outside_links(fake_gcs, tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name, type, linkname in (
+            ('ok', tarfile.REGTYPE, ''),
+            ('inner', tarfile.SYMTYPE, 'ok'),
+            ('link', tarfile.SYMTYPE, '..'),
+            ('abs', tarfile.SYMTYPE, '/tmp'),
+            ('sub/up', tarfile.SYMTYPE, '../../x'),
+            ('hard', tarfile.LNKTYPE, '../x'),
+            ('link/pwned', tarfile.REGTYPE, ''),
+        ):
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            if type == tarfile.REGTYPE:
+                info.size = 2
+                tar.addfile(info, io.BytesIO('hi'))
+            else:
+                tar.addfile(info)
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        fake_gcs.add_object(
+            TEST_BUCKET_NAME,
+            os.path.join(gb.get_location(), '20140101010101.tar.gz'),
+            data.getvalue()
+        )
+        path = str(tmpdir.mkdir('out'))
+        assert gb.restore(path) == ['ok', 'inner', 'link/pwned']
+    assert os.listdir(str(tmpdir)) == ['out']
+    assert os.readlink(os.path.join(path, 'inner')) == 'ok'
+    assert not os.path.islink(os.path.join(path, 'link'))
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_read_archived(fake_gcs, stream):
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    big = os.urandom(8 * 1024 * 1024)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        gb.index_archive = True
+        gb.store_local({"test": 123}, "test_file.json")
+        with open(os.path.join(gb.archive_path(), 'big.bin'), 'wb') as f:
+            f.write(big)
+        gb.store_gs(stream=stream)
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == [
+            'dummysite/20140101010101/20140101010101.tar.gz',
+            'dummysite/20140101010101/20140101010101.tar.gz.index.json',
+        ]
+
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        fake_gcs.reset_stats()
+        assert json.loads(gb.read_archived('test_file.json')) == {
+            "test": 123
+        }
+        assert fake_gcs.stats['bytes_out'] < 64 * 1024
+        assert gb.read_archived('big.bin') == big
+        with pytest.raises(KeyError):
+            gb.read_archived('missing.json')
+
+
+def test_read_archived_without_index(fake_gcs):
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        gb.store_local({"test": 123}, "test_file.json")
+        gb.store_gs()
+        assert json.loads(gb.read_archived('test_file.json')) == {
+            "test": 123
+        }
+        with pytest.raises(KeyError):
+            gb.read_archived('missing.json')
+
+        # Archive overwritten without index makes the old index stale
+        gb.index_archive = True
+        gb.store_local({"test": 456}, "test_file.json")
+        gb.store_gs()
+        gb.index_archive = False
+        gb.store_local({"test": 789}, "test_file.json")
+        gb.store_local({"new": 1}, "new.json")
+        gb.store_gs()
+        assert json.loads(gb.read_archived('test_file.json')) == {
+            "test": 789
+        }
+        assert json.loads(gb.read_archived('new.json')) == {"new": 1}
+
+
+def test_read_archived_sync(fake_gcs):
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    with gs.Base("dummysite", None, date, archived=True) as gb:
+        gb._gs = fake_gcs.handler()
+        gb.bucket = TEST_BUCKET_NAME
+        gb.index_archive = True
+        gb.store_local({"test": 123}, "test_file.json")
+        summary = gb.store_gs(sync=True, delete=True)
+        archive_name = 'dummysite/20140101010101/20140101010101.tar.gz'
+        index_name = archive_name + '.index.json'
+        assert summary['uploaded'] == [archive_name]
+        resource, data = fake_gcs.get_object(TEST_BUCKET_NAME, index_name)
+        assert 'generation' in json.loads(data)
+        fake_gcs.reset_stats()
+        assert json.loads(gb.read_archived('test_file.json')) == {
+            "test": 123
+        }
+        assert fake_gcs.stats['bytes_out'] < 4 * 1024
+
+        # Index written without generation is stale, not an error
+        index = json.loads(data)
+        del index['generation']
+        fake_gcs.add_object(TEST_BUCKET_NAME, index_name, json.dumps(index))
+        assert json.loads(gb.read_archived('test_file.json')) == {
+            "test": 123
+        }
+
+
+def test_copy_to(fake_gcs):
+    date = datetime.datetime(2014, 01, 01, 01, 01, 01)
+    fake_gcs.add_bucket(gs.Maps.bucket)
+    with gs.Outputs("dummysite", None, date) as go:
+        go._gs = fake_gcs.handler()
+        go.bucket = TEST_BUCKET_NAME
+        go.store_local({"test": 123}, "test_file.json")
+        go.store_gs()
+        fake_gcs.add_object(
+            TEST_BUCKET_NAME, go.get_location() + '0/other', 'x'
+        )
+
+        copies = go.copy_to(gs.Maps, dest_location='othersite/copy')
+        assert copies.keys() == [
+            os.path.join(go.get_location(), 'test_file.json')
+        ]
+        assert json.loads(fake_gcs.get_object(
+            gs.Maps.bucket, 'othersite/copy/test_file.json'
+        )[1]) == {"test": 123}
@@ -0,0 +1,107 @@
+import tempfile
+
+import pytest
+
+import google_storage.core.metrics as metrics
+
+from google_storage.core.handlers import Base
+
+TEST_BUCKET_NAME = u"pi-test-bucket"
+
+
+@pytest.mark.parametrize(
+    ('samples', 'p', 'expected'),
+    [
+        ([], 50, None),
+        ([1.0], 99, 1.0),
+        (range(1, 101), 50, 50),
+        (range(1, 101), 95, 95),
+        (range(1, 101), 99, 99),
+        (range(1, 11), 99, 10),
+    ]
+)
+def test_percentile(samples, p, expected):
+    assert metrics.percentile(samples, p) == expected
+
+
+def test_null_metrics():
+    op = metrics.NULL_METRICS.operation('upload', 'bucket')
+    assert op is metrics.NULL_OPERATION
+    with op:
+        op.add_bytes(10)
+        op.retry(None)
+
+
+def test_in_memory_metrics():
+    m = metrics.InMemoryMetrics(max_samples=50)
+    for i in xrange(100):
+        with m.operation('upload', 'a') as op:
+            op.add_bytes(10)
+            op.add_chunks(2)
+            op.status(200)
+    with pytest.raises(ValueError):
+        with m.operation('download', 'a') as op:
+            op.retry(IOError())
+            raise ValueError()
+
+    summary = dict((r['operation'], r) for r in m.summary())
+    upload = summary['upload']
+    assert upload['count'] == 100
+    assert upload['bytes'] == 1000
+    assert upload['chunks'] == 200
+    assert upload['statuses'] == {200: 100}
+    assert upload['errors'] == 0
+    assert upload['p50'] <= upload['p95'] <= upload['p99'] <= upload['max']
+
+    download = summary['download']
+    assert download['count'] == download['errors'] == download['retries'] == 1
+
+    m.reset()
+    assert m.summary() == []
+
+
+def test_handler_metrics(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    m = metrics.InMemoryMetrics()
+    gs = fake_gcs.handler()
+    gs.metrics = m
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write('x' * 1000)
+        f.flush()
+        fake_gcs.inject_errors(1)
+        name = gs.upload(TEST_BUCKET_NAME, f, resumable=True)['name']
+
+    with tempfile.NamedTemporaryFile() as out:
+        gs.download(TEST_BUCKET_NAME, name, out)
+
+    gs.delete_objects(TEST_BUCKET_NAME, [name, 'missing'])
+
+    summary = dict((r['operation'], r) for r in m.summary())
+    upload = summary['upload']
+    assert upload['bucket'] == TEST_BUCKET_NAME
+    assert upload['bytes'] == 1000
+    assert upload['retries'] == 1
+    assert upload['statuses'][503] == 1
+    assert summary['download']['bytes'] == 1000
+    assert summary['download']['chunks'] == 1
+    assert summary['execute_batch']['statuses'][404] == 1
+    assert summary['execute_batch']['chunks'] == 2
+
+
+def test_base_metrics(fake_gcs):
+    m = metrics.InMemoryMetrics()
+
+    class Bucketed(Base):
+        bucket = TEST_BUCKET_NAME
+        metrics = m
+
+    with Bucketed('site', None) as base:
+        base._gs = fake_gcs.handler()
+        with open('%s/a.csv' % base.tmpdir, 'w') as f:
+            f.write('1,2,3\n')
+        base.store_gs()
+
+    ops = [r['operation'] for r in m.summary()]
+    assert ops == ['Bucketed.store_gs', 'Bucketed.upload']
+    assert m.summary()[1]['bytes'] == 6
@@ -0,0 +1,132 @@
+import time
+import socket
+
+import httplib2
+import pytest
+
+from email.utils import formatdate
+
+from googleapiclient.errors import HttpError
+
+import google_storage.core.retry as retry
+
+TEST_BUCKET_NAME = u"pi-test-bucket"
+
+
+def http_error(status, **headers):
+    resp = httplib2.Response(dict(headers, status=status))
+    return HttpError(resp, '{}')
+
+
+def policy(**kwargs):
+    sleeps = []
+    kwargs.setdefault('budget', None)
+    return retry.RetryPolicy(sleep=sleeps.append, **kwargs), sleeps
+
+
+@pytest.mark.parametrize(
+    ('error', 'expected'),
+    [
+        (http_error(429), True),
+        (http_error(503), True),
+        (http_error(404), False),
+        (http_error(412), False),
+        (socket.error(), True),
+        (httplib2.ServerNotFoundError(), True),
+        (IOError(), False),
+        (ValueError(), False),
+    ]
+)
+def test_is_retryable(error, expected):
+    assert retry.DEFAULT_POLICY.is_retryable(error) is expected
+
+
+def test_next_delay_bounds():
+    p, _ = policy(base_delay=1.0, max_delay=10.0)
+    delay = 0
+    for i in xrange(1000):
+        previous, delay = delay, p.next_delay(delay)
+        assert 1.0 <= delay <= min(10.0, max(1.0, previous * 3))
+
+
+def test_retry_after():
+    assert retry.retry_after(http_error(503)) is None
+    assert retry.retry_after(http_error(429, **{'retry-after': '7'})) == 7
+    date = formatdate(time.time() + 30, usegmt=True)
+    seconds = retry.retry_after(http_error(503, **{'retry-after': date}))
+    assert 25 < seconds <= 30
+    assert retry.retry_after(socket.error()) is None
+
+
+def test_retrying_gives_up():
+    p, sleeps = policy(max_retries=2, max_delay=2.0)
+    retrying = p.start()
+    error = http_error(503)
+    retrying.failed(error)
+    retrying.failed(error)
+    with pytest.raises(HttpError):
+        retrying.failed(error)
+    assert len(sleeps) == 2
+
+    retrying.succeeded()
+    retrying.failed(error)
+    with pytest.raises(HttpError):
+        retrying.failed(http_error(404))
+
+
+def test_retrying_waits_for_retry_after():
+    p, sleeps = policy(max_delay=1.0)
+    p.start().failed(http_error(429, **{'retry-after': '5'}))
+    assert sleeps == [5.0]
+
+
+def test_deadline():
+    p, sleeps = policy(deadline=60, deadlines={'download': 1})
+    p.start('upload').failed(http_error(429, **{'retry-after': '5'}))
+    with pytest.raises(HttpError):
+        p.start('download').failed(http_error(429, **{'retry-after': '5'}))
+    assert sleeps == [5.0]
+
+
+def test_budget():
+    budget = retry.RetryBudget(ratio=0.5, min_per_second=0, capacity=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+    p, sleeps = policy(budget=retry.RetryBudget(min_per_second=0, capacity=1))
+    p.start().failed(socket.error())
+    with pytest.raises(socket.error):
+        p.start().failed(socket.error())
+    assert len(sleeps) == 1
+
+
+def test_call():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise http_error(500)
+        return 'ok'
+
+    p, sleeps = policy()
+    assert p.call(flaky) == 'ok'
+    assert len(sleeps) == 2
+
+
+def test_handler_honours_retry_after(fake_gcs):
+    p, sleeps = policy(max_delay=1.0)
+    gs = fake_gcs.handler()
+    gs.retry_policy = p
+    fake_gcs.inject_errors(1, status=429, headers={'Retry-After': '3'})
+    assert gs.bucket_exists(TEST_BUCKET_NAME)
+    assert sleeps == [3.0]
+
+    fake_gcs.inject_errors(1, status=403)
+    with pytest.raises(HttpError):
+        gs.create_bucket('other')
+    assert sleeps == [3.0]
@@ -0,0 +1,86 @@
+import os
+
+import httplib2
+import pytest
+
+from googleapiclient.http import HttpRequest
+
+from google_storage.core.streams import StreamMediaUpload
+from google_storage.core.streams import pipe_from
+
+CHUNK = 256 * 1024
+
+
+class FakeResumableHttp(object):
+
+    def __init__(self):
+        self.data = ''
+        self.ranges = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if uri == 'start':
+            return httplib2.Response({'status': 200, 'location': 'put'}), ''
+
+        rng = headers['Content-Range']
+        self.ranges.append(rng)
+        self.data += body
+        total = rng.split('/')[1]
+        if total != '*' and int(total) == len(self.data):
+            return httplib2.Response({'status': 200}), 'done'
+
+        return httplib2.Response({
+            'status': 308, 'range': 'bytes=0-%d' % (len(self.data) - 1)
+        }), ''
+
+
+@pytest.mark.parametrize(
+    ('size', 'expected'),
+    [
+        (
+            CHUNK * 2 + 100,
+            [
+                'bytes 0-262143/*',
+                'bytes 262144-524287/*',
+                'bytes 524288-524387/524388'
+            ]
+        ),
+        (
+            CHUNK * 2,
+            ['bytes 0-262143/*', 'bytes 262144-524287/524288']
+        ),
+        (
+            100,
+            ['bytes 0-99/100']
+        ),
+    ]
+)
+def test_stream_upload(size, expected):
+    content = os.urandom(size)
+
+    def write(fileobj):
+        for i in xrange(0, size, 10240):
+            fileobj.write(content[i:i + 10240])
+
+    http = FakeResumableHttp()
+    media = StreamMediaUpload(pipe_from(write), 'text/plain', CHUNK)
+    request = HttpRequest(
+        http, lambda resp, content: content, 'start', method='POST',
+        headers={}, resumable=media
+    )
+
+    response = None
+    while response is None:
+        status, response = request.next_chunk(http=http)
+
+    assert response == 'done'
+    assert http.data == content
+    assert http.ranges == expected
+
+
+def test_stream_writer_error():
+    def write(fileobj):
+        fileobj.write('some data')
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        pipe_from(write).read()
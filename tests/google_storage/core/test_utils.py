@@ -0,0 +1,565 @@
+import io
+import csv
+import os
+import sys
+import mmap
+import time
+import tarfile
+import tempfile
+import threading
+import subprocess
+
+import pytest
+
+from googleapiclient.errors import HttpError
+
+import google_storage.core.utils as g
+import google_storage.core.checksums as checksums
+
+from google_storage.core.utils import thread_map
+from google_storage.core.streams import BufferMediaUpload
+from google_storage.core.streams import pipe_from
+
+from benchmarks.fakegcs import PAGE_SIZE
+
+TEST_BUCKET_NAME = u"pi-test-bucket"
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)
+))))
+
+
+def test_bundled_discovery(fake_gcs):
+    document = g.discovery_document('storage', 'v1')
+    assert document is g.discovery_document('storage', 'v1')
+
+    gs = fake_gcs.handler()
+    fake_gcs.reset_stats()
+    assert gs.bucket_exists(TEST_BUCKET_NAME)
+    assert fake_gcs.stats['requests'] == 1
+    assert gs.document['rootUrl'] == fake_gcs.url
+    assert document['rootUrl'] == 'https://storage.googleapis.com/'
+    assert document['revision']
+    assert 'objectAccessControls' in document['resources']
+
+
+def test_fetched_discovery_cached(fake_gcs):
+    fake_gcs.reset_stats()
+    handlers = [fake_gcs.handler(discovery=True) for i in xrange(3)]
+    results = thread_map(
+        lambda gs: gs.bucket_exists(TEST_BUCKET_NAME), handlers * 4,
+        max_workers=4
+    )
+    assert all(result for result, error in results)
+    assert fake_gcs.stats['requests'] == 1 + 12
+
+
+def test_thread_map_slow_item():
+    def work(i):
+        time.sleep(0.5 if i == 0 else 0.05)
+        return i
+
+    threads = threading.active_count()
+    start = time.time()
+    results = list(thread_map(work, xrange(80), max_workers=8))
+    assert time.time() - start < 0.85
+    assert results == [(i, None) for i in xrange(80)]
+    assert threading.active_count() == threads
+
+
+def test_connections_reused(fake_gcs, monkeypatch):
+    monkeypatch.setattr(g, 'CHUNKSIZE', 16 * 1024)
+    data = os.urandom(64 * 1024)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    gs = fake_gcs.handler()
+
+    def download():
+        buf = bytearray(len(data))
+        gs.download_into(TEST_BUCKET_NAME, 'obj', buf, slices=4)
+        assert buf == data
+
+    download()
+    connections = fake_gcs.stats['connections']
+    created = gs._channels.created
+    assert created == 1 + 4
+    for i in xrange(20):
+        download()
+    assert fake_gcs.stats['connections'] == connections
+    assert gs._channels.created == created
+
+    gs.close()
+    download()
+    assert fake_gcs.stats['connections'] > connections
+
+
+def test_lazy_imports():
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, google_storage.core.handlers; print(sorted(set(sys.'
+        'modules) & set(["googleapiclient.discovery", "googleapiclient.http",'
+        ' "oauth2client.client", "lz4.frame"])))'
+    ], cwd=ROOT)
+    assert out.strip() == '[]'
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+@pytest.mark.parametrize('kind', [
+    'str', 'bytearray', 'memoryview', 'mmap', 'bytesio', 'pipe'
+])
+def test_upload_data(fake_gcs, kind, resumable):
+    data = os.urandom(3 * 256 * 1024 + 7)
+    if kind == 'str':
+        content = data
+    elif kind == 'bytearray':
+        content = bytearray(data)
+    elif kind == 'memoryview':
+        content = memoryview(data)
+    elif kind == 'mmap':
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+        content = mmap.mmap(f.fileno(), len(data), access=mmap.ACCESS_READ)
+    elif kind == 'bytesio':
+        content = io.BytesIO(data)
+    else:
+        content = pipe_from(lambda fileobj: fileobj.write(data))
+
+    gs = fake_gcs.handler()
+    resp = gs.upload_data(
+        TEST_BUCKET_NAME, content, 'obj/%s' % kind, 'text/plain',
+        resumable=resumable, chunksize=256 * 1024
+    )
+    assert resp['name'] == 'obj/%s' % kind
+    assert fake_gcs.get_object(TEST_BUCKET_NAME, resp['name'])[1] == data
+
+
+def test_upload_resumable(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    data = os.urandom(256 * 1024 * 3 + 17)
+    gs = fake_gcs.handler()
+    dispatch = fake_gcs.dispatch
+    chunks = []
+
+    def flaky_dispatch(method, url, headers, body):
+        if 'content-range' in headers:
+            chunks.append(headers['content-range'])
+            if len(chunks) == 2:
+                fake_gcs.inject_errors(1)
+        return dispatch(method, url, headers, body)
+
+    monkeypatch.setattr(fake_gcs, 'dispatch', flaky_dispatch)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        resp = gs.upload(
+            TEST_BUCKET_NAME, f, name='obj', resumable=True,
+            chunksize=256 * 1024
+        )
+    assert resp['size'] == str(len(data))
+    assert fake_gcs.get_object(TEST_BUCKET_NAME, 'obj')[1] == data
+    assert chunks == [
+        'bytes 0-262143/786449', 'bytes 262144-524287/786449',
+        'bytes */786449', 'bytes 262144-524287/786449',
+        'bytes 524288-786431/786449', 'bytes 786432-786448/786449'
+    ]
+
+
+@pytest.mark.parametrize('crcmod', [True, False])
+def test_crc32c(monkeypatch, crcmod):
+    if not crcmod:
+        monkeypatch.setattr(checksums, 'crcmod', None)
+    assert checksums.Crc32c('123456789').value() == 0xE3069283
+    crc = checksums.Crc32c('1234')
+    crc.update('56789')
+    assert crc.value() == 0xE3069283
+    assert checksums.crc32c_combine(
+        checksums.Crc32c('1234').value(), checksums.Crc32c('56789').value(), 5
+    ) == 0xE3069283
+
+
+def test_upload_composite(fake_gcs, monkeypatch):
+    data = os.urandom(3000)
+    gs = fake_gcs.handler()
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        resp = gs.upload(
+            TEST_BUCKET_NAME, f, name='big', composite_threshold=1000,
+            composite_parts=3
+        )
+        assert resp['componentCount'] == 3
+        assert resp['size'] == str(len(data))
+        assert fake_gcs.get_object(TEST_BUCKET_NAME, 'big')[1] == data
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == ['big']
+        assert gs.download_into(TEST_BUCKET_NAME, 'big').tobytes() == data
+
+        monkeypatch.setattr(
+            g._Crc32cSlice, 'b64digest', lambda self: 'AAAAAA=='
+        )
+        with pytest.raises(g.ChecksumError):
+            gs.upload(
+                TEST_BUCKET_NAME, f, name='bad', composite_threshold=1000
+            )
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == ['big']
+        monkeypatch.undo()
+
+        def corrupt_compose(bucket, name, body):
+            resource = compose(bucket, name, body)
+            resource['crc32c'] = 'AAAAAA=='
+            return resource
+
+        compose = fake_gcs._compose
+        monkeypatch.setattr(fake_gcs, '_compose', corrupt_compose)
+        with pytest.raises(g.ChecksumError):
+            gs.upload(
+                TEST_BUCKET_NAME, f, name='bad', composite_threshold=1000
+            )
+        assert fake_gcs.buckets[TEST_BUCKET_NAME].names == ['big']
+        monkeypatch.undo()
+
+        monkeypatch.setattr(g, 'FAST_CRC32C', False)
+        resp = gs.upload(
+            TEST_BUCKET_NAME, f, name='single', composite_threshold=1000
+        )
+        assert 'componentCount' not in resp
+
+
+def test_buffer_media_views():
+    data = bytearray('0123456789')
+    media = BufferMediaUpload(data, 'text/plain', 4, True)
+    assert media.size() == 10
+    chunk = media.getbytes(8, 4)
+    data[9] = 'x'
+    assert str(chunk) == '8x'
+
+
+def test_upload_needs_name(fake_gcs):
+    gs = fake_gcs.handler()
+    with pytest.raises(ValueError):
+        gs.upload(TEST_BUCKET_NAME, io.BytesIO('abc'), 'dir')
+    resp = gs.upload(TEST_BUCKET_NAME, io.BytesIO('abc'), name='dir/abc')
+    assert resp['size'] == '3'
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write('abcd')
+        f.flush()
+        resp = gs.upload(TEST_BUCKET_NAME, f, name='renamed')
+    assert resp['name'] == 'renamed'
+
+
+@pytest.mark.parametrize('size', [0, 1000, 5 * 1024 * 1024 + 3])
+def test_download_into(fake_gcs, monkeypatch, size):
+    monkeypatch.setattr(g, 'CHUNKSIZE', 1024 * 1024)
+    data = os.urandom(size)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    gs = fake_gcs.handler()
+
+    view = gs.download_into(TEST_BUCKET_NAME, 'obj')
+    assert isinstance(view, memoryview)
+    assert view.tobytes() == data
+
+    buf = bytearray(size + 10)
+    view = gs.download_into(TEST_BUCKET_NAME, 'obj', buf, slices=3)
+    assert view.tobytes() == data
+    assert buf[size:] == bytearray(10)
+
+    if size:
+        mapping = mmap.mmap(-1, size)
+        assert gs.download_into(TEST_BUCKET_NAME, 'obj', mapping)[:] == data
+        with pytest.raises(ValueError):
+            gs.download_into(TEST_BUCKET_NAME, 'obj', bytearray(size - 1))
+
+    with tempfile.NamedTemporaryFile() as f:
+        mapping = gs.download_mmap(TEST_BUCKET_NAME, 'obj', f)
+        assert mapping[:] == data
+        f.seek(0)
+        assert f.read() == data
+        if size:
+            with pytest.raises(TypeError):
+                mapping[0] = 'x'
+            mapping.close()
+
+
+def test_download_sliced(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    data = os.urandom(5 * 1024 * 1024 + 7)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    gs = fake_gcs.handler()
+    dispatch = fake_gcs.dispatch
+    ranges = []
+
+    def flaky_dispatch(method, url, headers, body):
+        if 'range' in headers:
+            with lock:
+                ranges.append(headers['range'])
+                if len(ranges) == 2:
+                    fake_gcs.inject_errors(1)
+        return dispatch(method, url, headers, body)
+
+    lock = threading.Lock()
+    monkeypatch.setattr(fake_gcs, 'dispatch', flaky_dispatch)
+    with tempfile.NamedTemporaryFile() as out:
+        gs.download(
+            TEST_BUCKET_NAME, 'obj', out, sliced_threshold=1024, slices=3
+        )
+        out.seek(0)
+        assert out.read() == data
+    assert sorted(ranges) == sorted([
+        'bytes=0-1747628', 'bytes=1747629-3495257',
+        'bytes=3495258-5242886', ranges[1]
+    ])
+
+
+def test_download_checksum_field(fake_gcs, monkeypatch):
+    data = os.urandom(1000)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    resource = fake_gcs.add_object(TEST_BUCKET_NAME, 'composite', data)
+    del resource['md5Hash']
+    gs = fake_gcs.handler()
+    computed = []
+
+    def data_checksums(data, offset=0, length=None, fields=None):
+        computed.append(fields)
+        return checksums(data, offset, length, fields)
+
+    checksums = g.data_checksums
+    monkeypatch.setattr(g, 'data_checksums', data_checksums)
+    assert gs.download_into(TEST_BUCKET_NAME, 'obj').tobytes() == data
+    assert gs.download_into(TEST_BUCKET_NAME, 'composite').tobytes() == data
+    assert computed == [('md5Hash',), ('crc32c',)]
+
+    monkeypatch.setattr(g, 'FAST_CRC32C', False)
+    del computed[:]
+    assert gs.download_into(TEST_BUCKET_NAME, 'obj').tobytes() == data
+    assert gs.download_into(TEST_BUCKET_NAME, 'composite').tobytes() == data
+    assert computed == [('md5Hash',)]
+
+
+def test_download_into_short_range(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    data = os.urandom(1000)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    media = fake_gcs._media
+    calls = []
+
+    def short_media(resource, content, headers):
+        status, out, body = media(resource, content, headers)
+        calls.append(1)
+        if len(calls) == 1:
+            body = body[:-1]
+        return status, out, body
+
+    monkeypatch.setattr(fake_gcs, '_media', short_media)
+    gs = fake_gcs.handler()
+    view = gs.download_into(TEST_BUCKET_NAME, 'obj', slices=1)
+    assert view.tobytes() == data
+    assert len(calls) == 2
+
+
+def test_open(fake_gcs):
+    data = ''.join('%d,row %d\n' % (i, i) for i in xrange(50000))
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'rows.csv', data)
+    gs = fake_gcs.handler()
+    fake_gcs.reset_stats()
+
+    f = gs.open(TEST_BUCKET_NAME, 'rows.csv', chunksize=4096,
+                readahead=64 * 1024, cache_chunks=2)
+    rows = list(csv.reader(f))
+    assert len(rows) == 50000
+    assert rows[-1] == ['49999', 'row 49999']
+    # Readahead doubles up to 16 chunks per request
+    chunks = -(-len(data) // 4096)
+    assert fake_gcs.stats['requests'] < 1 + 5 + chunks // 16 + 2
+
+    f.seek(-10, os.SEEK_END)
+    assert f.read() == 'row 49999\n'
+    f.seek(100)
+    assert f.read(10) == data[100:110]
+    assert f.tell() == 110
+    f.seek(0)
+    assert f.read() == data
+    f.close()
+    with pytest.raises(ValueError):
+        f.read()
+
+
+def test_open_random_reads(fake_gcs):
+    data = os.urandom(100000)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', data)
+    gs = fake_gcs.handler()
+    f = gs.open(TEST_BUCKET_NAME, 'obj', chunksize=1000, readahead=8000,
+                cache_chunks=4)
+    fake_gcs.reset_stats()
+    for offset in (50000, 90000, 50500, 90100, 10, 99999):
+        f.seek(offset)
+        assert f.read(300) == data[offset:offset + 300]
+    # Single chunk per miss, cached chunks aren't fetched again
+    assert fake_gcs.stats['requests'] == 4
+    assert fake_gcs.stats['bytes_out'] == 4000
+
+    # Data of other generation is never mixed in
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'obj', 'overwritten')
+    f.seek(50100)
+    assert f.read(5) == data[50100:50105]
+    f.seek(20000)
+    with pytest.raises(HttpError) as e:
+        f.read(5)
+    assert e.value.resp.status == 404
+
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'empty', '')
+    assert gs.open(TEST_BUCKET_NAME, 'empty').read() == ''
+
+
+def test_open_lines(fake_gcs):
+    lines = ['short\n', 'x' * 2500 + '\n', '\n', 'y' * 999 + '\n', 'tail']
+    data = ''.join(lines)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'lines', data)
+    gs = fake_gcs.handler()
+    f = gs.open(TEST_BUCKET_NAME, 'lines', chunksize=1000, readahead=2000,
+                cache_chunks=1)
+    assert list(f) == lines
+    f.seek(0)
+    assert [f.readline() for line in lines] == lines
+    assert f.readline() == ''
+    f.seek(3)
+    assert f.readline(2) == 'rt'
+    assert f.read1(100) == '\n' + 'x' * 99
+
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w:gz') as tar:
+        info = tarfile.TarInfo('lines')
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'lines.tgz', tar_data.getvalue())
+    with gs.open(TEST_BUCKET_NAME, 'lines.tgz', chunksize=512) as f:
+        with tarfile.open(fileobj=f) as tar:
+            assert tar.extractfile('lines').read() == data
+
+
+def test_iter_bucket_content(fake_gcs):
+    for i in xrange(5):
+        fake_gcs.add_object(TEST_BUCKET_NAME, 'paged/%s' % i, 'paged')
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'other/obj', 'other')
+    gs = fake_gcs.handler()
+    fake_gcs.reset_stats()
+
+    items = list(gs.iter_bucket_content(
+        TEST_BUCKET_NAME, prefix='paged/', fields='name,size', page_size=2
+    ))
+    assert [i['name'] for i in items] == ['paged/%s' % i for i in xrange(5)]
+    assert all(sorted(i.keys()) == ['name', 'size'] for i in items)
+    assert fake_gcs.stats['requests'] == 3
+
+    pages = list(gs.iter_bucket_pages(TEST_BUCKET_NAME, delimiter='/'))
+    assert pages[0]['prefixes'] == ['other/', 'paged/']
+
+    names = ['bulk/%04d' % i for i in xrange(PAGE_SIZE + 1)]
+    for name in names:
+        fake_gcs.add_object(TEST_BUCKET_NAME, name, name)
+    fake_gcs.reset_stats()
+    items = gs.iter_bucket_content(
+        TEST_BUCKET_NAME, prefix='bulk/', fields='name'
+    )
+    assert [i['name'] for i in items] == names
+    assert fake_gcs.stats['requests'] == 2
+
+
+def test_delete_bucket_content(fake_gcs, monkeypatch):
+    names = ['del/%03d' % i for i in xrange(150)]
+    for name in names:
+        fake_gcs.add_object(TEST_BUCKET_NAME, name, name)
+    gs = fake_gcs.handler()
+    dispatch = fake_gcs.dispatch
+    requests = []
+
+    def recording_dispatch(method, url, headers, body):
+        requests.append((method, url.split('?')[0]))
+        return dispatch(method, url, headers, body)
+
+    monkeypatch.setattr(fake_gcs, 'dispatch', recording_dispatch)
+    summary = gs.delete_bucket_content(TEST_BUCKET_NAME)
+    assert summary == {'deleted': 150, 'missing': 0, 'failed': 0}
+    assert fake_gcs.buckets[TEST_BUCKET_NAME].names == []
+    assert gs.list_bucket_content(TEST_BUCKET_NAME) is None
+    assert requests.count(('POST', '/batch/storage/v1')) == 2
+    assert len([r for r in requests if r[0] == 'DELETE']) == 150
+
+    summary = gs.delete_objects(TEST_BUCKET_NAME, names[:1])
+    assert summary == {'deleted': 0, 'missing': 1, 'failed': 0}
+
+
+def test_stat_many(fake_gcs, monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    names = ['obj/%04d' % i for i in xrange(250)]
+    for name in names:
+        fake_gcs.add_object(TEST_BUCKET_NAME, name, name)
+    gs = fake_gcs.handler()
+    missing = ['obj/missing-%d' % i for i in xrange(3)]
+
+    fake_gcs.inject_errors(3)
+    stats = gs.stat_many(
+        TEST_BUCKET_NAME, iter(names + missing), fields='name,size'
+    )
+    assert len(stats) == 253
+    assert stats['obj/0042'] == {'name': 'obj/0042', 'size': '8'}
+    assert all(stats[name] is None for name in missing)
+
+    exists = gs.exists_many(TEST_BUCKET_NAME, ['obj/0001', 'obj/missing-0'])
+    assert exists == {'obj/0001': True, 'obj/missing-0': False}
+
+    streamed = list(gs.iter_stat_many(TEST_BUCKET_NAME, names, 'name'))
+    assert sorted(name for name, resource in streamed) == names
+
+    fake_gcs.inject_errors(2, status=500)
+    patched = gs.patch_metadata_many(TEST_BUCKET_NAME, dict(
+        (name, {'checked': 'yes'}) for name in names[:150] + missing[:1]
+    ))
+    assert patched['obj/0149'] == {
+        'name': 'obj/0149', 'metadata': {'checked': 'yes'}
+    }
+    assert patched['obj/missing-0'] is None
+    resource = fake_gcs.get_object(TEST_BUCKET_NAME, 'obj/0000')[0]
+    assert resource['metadata'] == {'checked': 'yes'}
+    assert 'metadata' not in fake_gcs.get_object(
+        TEST_BUCKET_NAME, 'obj/0200'
+    )[0]
+
+    fake_gcs.inject_errors(1, status=403)
+    with pytest.raises(HttpError):
+        gs.stat_many(TEST_BUCKET_NAME, names[:1])
+
+
+def test_copy(fake_gcs):
+    data = os.urandom(3500)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'src/a', data, 'text/plain')
+    fake_gcs.add_bucket('other-bucket')
+    gs = fake_gcs.handler()
+    fake_gcs.reset_stats()
+
+    resource = gs.copy(
+        TEST_BUCKET_NAME, 'src/a', 'other-bucket', 'dst/a',
+        max_bytes_per_call=1000
+    )
+    assert resource['name'] == 'dst/a'
+    assert resource['contentType'] == 'text/plain'
+    assert fake_gcs.stats['requests'] == 4
+    assert fake_gcs.get_object('other-bucket', 'dst/a')[1] == data
+
+
+def test_copy_prefix(fake_gcs):
+    names = ['src/%02d' % i for i in xrange(20)]
+    for name in names:
+        fake_gcs.add_object(TEST_BUCKET_NAME, name, name)
+    fake_gcs.add_object(TEST_BUCKET_NAME, 'srcx/skipped', 'x')
+    fake_gcs.add_bucket('other-bucket')
+    gs = fake_gcs.handler()
+
+    copies = gs.copy_prefix(TEST_BUCKET_NAME, 'src/', 'other-bucket', 'dst/')
+    assert sorted(copies) == names
+    assert copies['src/07']['name'] == 'dst/07'
+    assert fake_gcs.buckets['other-bucket'].names == [
+        'dst/%02d' % i for i in xrange(20)
+    ]
+    assert fake_gcs.get_object('other-bucket', 'dst/07')[1] == 'src/07'
+
+    with pytest.raises(HttpError):
+        gs.copy_prefix(TEST_BUCKET_NAME, 'src/', 'missing-bucket')